@@ -0,0 +1,58 @@
+import sumpy.symbolic as sym
+from sumpy.kernel import LaplaceKernel, HelmholtzKernel
+from sumpy.expansion import (
+        FullDerivativeWrangler, LaplaceDerivativeWrangler,
+        HelmholtzDerivativeWrangler)
+
+from pytools import generate_nonnegative_integer_tuples_summing_to_at_most
+
+
+class DerivativeTakerBenchmarkSuite:
+
+    params = [2, 4, 6, 8]
+    param_names = ["order"]
+
+    def make_derivative_taker(self, order):
+        raise NotImplementedError
+
+    def setup(self, order):
+        if self.__class__ == DerivativeTakerBenchmarkSuite:
+            raise NotImplementedError
+
+    def time_all_derivatives(self, order):
+        taker = self.make_derivative_taker(order)
+        for mi in generate_nonnegative_integer_tuples_summing_to_at_most(
+                order, self.dim):
+            taker.diff(mi)
+
+    time_all_derivatives.timeout = 300.0
+
+
+class LaplaceFullDerivativeTaker(DerivativeTakerBenchmarkSuite):
+    dim = 3
+
+    def make_derivative_taker(self, order):
+        knl = LaplaceKernel(self.dim)
+        dvec = sym.make_sym_vector("d", self.dim)
+        return FullDerivativeWrangler(order, self.dim).get_derivative_taker(
+                knl.get_expression(dvec), dvec)
+
+
+class LaplaceRecurrenceDerivativeTaker(DerivativeTakerBenchmarkSuite):
+    dim = 3
+
+    def make_derivative_taker(self, order):
+        knl = LaplaceKernel(self.dim)
+        dvec = sym.make_sym_vector("d", self.dim)
+        return LaplaceDerivativeWrangler(order, self.dim).get_derivative_taker(
+                knl.get_expression(dvec), dvec)
+
+
+class HelmholtzRecurrenceDerivativeTaker(DerivativeTakerBenchmarkSuite):
+    dim = 3
+
+    def make_derivative_taker(self, order):
+        knl = HelmholtzKernel(self.dim)
+        dvec = sym.make_sym_vector("d", self.dim)
+        return HelmholtzDerivativeWrangler(order, self.dim, "k") \
+                .get_derivative_taker(knl.get_expression(dvec), dvec)
@@ -0,0 +1,62 @@
+import numpy as np
+
+import pyopencl as cl
+import pyopencl.array  # noqa
+
+from sumpy.kernel import LaplaceKernel
+from sumpy.expansion.multipole import VolumeTaylorMultipoleExpansion
+from sumpy.expansion.local import VolumeTaylorLocalExpansion
+
+
+class ExpansionLayoutBenchmark:
+    """Times a full FMM evaluation for each expansion layout, on the default
+    OpenCL device.
+    """
+
+    params = [
+        ["box_major", "coeff_major", "blocked"],
+        [2, 3],
+    ]
+    param_names = ["layout", "dim"]
+
+    nsources = 20000
+    order = 6
+
+    def setup(self, layout, dim):
+        from functools import partial
+        from boxtree import TreeBuilder
+        from boxtree.traversal import FMMTraversalBuilder
+        from boxtree.tools import make_normal_particle_array
+        from sumpy.fmm import SumpyExpansionWranglerCodeContainer
+
+        self.ctx = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(self.ctx)
+
+        sources = make_normal_particle_array(
+                self.queue, self.nsources, dim, np.float64, seed=15)
+        tree, _ = TreeBuilder(self.ctx)(
+                self.queue, sources, max_particles_in_box=30)
+        self.trav, _ = FMMTraversalBuilder(self.ctx)(self.queue, tree)
+
+        knl = LaplaceKernel(dim)
+        wcc = SumpyExpansionWranglerCodeContainer(
+                self.ctx,
+                partial(VolumeTaylorMultipoleExpansion, knl),
+                partial(VolumeTaylorLocalExpansion, knl),
+                [knl],
+                expansion_layout=layout)
+        self.wrangler = wcc.get_wrangler(self.queue, tree, np.float64,
+                fmm_level_to_order=lambda kernel, kernel_args, tree, lev:
+                    self.order)
+
+        self.weights = cl.array.zeros(self.queue, self.nsources, np.float64) + 1
+
+        # compile all kernels
+        self.time_fmm(layout, dim)
+
+    def time_fmm(self, layout, dim):
+        from boxtree.fmm import drive_fmm
+        pot, = drive_fmm(self.trav, self.wrangler, self.weights)
+        pot.finish()
+
+    time_fmm.timeout = 600.0
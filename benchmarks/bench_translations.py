@@ -59,7 +59,7 @@ class TranslationBenchmarkSuite:
         if param.order == 3 and H2DMultipoleExpansion == mpole_expn_class:
             raise NotImplementedError
 
-    def track_m2l_op_count(self, param):
+    def get_m2l_assignments(self, param):
         knl = self.knl(param.dim)
         m_expn = self.mpole_expn_class(knl, order=param.order)
         l_expn = self.local_expn_class(knl, order=param.order)
@@ -75,7 +75,10 @@ class TranslationBenchmarkSuite:
         for i, expr in enumerate(result):
             sac.assign_unique("coeff%d" % i, expr)
         sac.run_global_cse()
-        insns = to_loopy_insns(six.iteritems(sac.assignments))
+        return list(six.iteritems(sac.assignments))
+
+    def track_m2l_op_count(self, param):
+        insns = to_loopy_insns(self.get_m2l_assignments(param))
         counter = pymbolic.mapper.flop_counter.CSEAwareFlopCounter()
 
         return sum([counter.rec(insn.expression)+1 for insn in insns])
@@ -83,6 +86,16 @@ class TranslationBenchmarkSuite:
     track_m2l_op_count.unit = "ops"
     track_m2l_op_count.timeout = 200.0
 
+    def setup_m2l_loopy_insns(self, param):
+        self.setup(param)
+        self.m2l_assignments = self.get_m2l_assignments(param)
+
+    def time_m2l_loopy_insns(self, param):
+        to_loopy_insns(self.m2l_assignments, vector_names=set(["d"]))
+
+    time_m2l_loopy_insns.setup = setup_m2l_loopy_insns
+    time_m2l_loopy_insns.timeout = 200.0
+
 
 class LaplaceVolumeTaylorTranslation(TranslationBenchmarkSuite):
     knl = LaplaceKernel
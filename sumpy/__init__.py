@@ -24,20 +24,36 @@ THE SOFTWARE.
 
 import os
 from sumpy.p2p import P2P, P2PFromCSR
-from sumpy.p2e import P2EFromSingleBox, P2EFromCSR
-from sumpy.e2p import E2PFromSingleBox, E2PFromCSR
-from sumpy.e2e import E2EFromCSR, E2EFromChildren, E2EFromParent
+from sumpy.p2e import (P2EFromSingleBox, P2EFromCSR,
+        P2EMatrixFromSingleBox)
+from sumpy.e2p import (E2PFromSingleBox, E2PFromCSR,
+        E2PMatrixFromSingleBox, E2PFromSingleBoxAndP2PFromCSR)
+from sumpy.e2e import (E2EFromCSR, E2EFromChildren, E2EFromParent,
+        E2EFromChildrenLooped, E2EFromParentLooped)
 from sumpy.version import VERSION_TEXT
 from pytools.persistent_dict import WriteOncePersistentDict
 
 __all__ = [
     "P2P", "P2PFromCSR",
     "P2EFromSingleBox", "P2EFromCSR",
+    "P2EMatrixFromSingleBox",
     "E2PFromSingleBox", "E2PFromCSR",
-    "E2EFromCSR", "E2EFromChildren", "E2EFromParent"]
+    "E2PMatrixFromSingleBox",
+    "E2PFromSingleBoxAndP2PFromCSR",
+    "E2EFromCSR", "E2EFromChildren", "E2EFromParent",
+    "E2EFromChildrenLooped", "E2EFromParentLooped"]
 
 
-code_cache = WriteOncePersistentDict("sumpy-code-cache-v6-"+VERSION_TEXT)
+code_cache = WriteOncePersistentDict("sumpy-code-cache-v7-"+VERSION_TEXT)
+
+# Post-CSE symbolic assignments. Unlike code_cache, these do not depend on
+# the version of loopy or on the kernel templates.
+symbolic_cache = WriteOncePersistentDict(
+        "sumpy-symbolic-cache-v2-"+VERSION_TEXT)
+
+# Stored identifiers and coefficient matrices of derivative wranglers.
+derivative_recurrence_cache = WriteOncePersistentDict(
+        "sumpy-derivative-recurrence-cache-v1-"+VERSION_TEXT)
 
 
 # {{{ optimization control
@@ -91,3 +107,36 @@ class CacheMode(object):
         del self.previous_mode
 
 # }}}
+
+
+# {{{ kernel splitting control
+
+MAX_KERNEL_INSNS = int(os.environ.get("SUMPY_MAX_KERNEL_INSNS", "5000")) or None
+
+
+def set_max_kernel_insns(max_insns):
+    """Set the number of instructions above which generated expansion kernels
+    are split into several smaller kernels, each computing a subset of the
+    outputs. *None* disables splitting.
+    """
+    global MAX_KERNEL_INSNS
+    MAX_KERNEL_INSNS = max_insns
+
+# }}}
+
+
+# {{{ CSE chunking control
+
+CSE_MAX_CHUNK_SIZE = int(os.environ.get("SUMPY_CSE_MAX_CHUNK_SIZE", "0")) or None
+
+
+def set_cse_max_chunk_size(max_chunk_size):
+    """Set the number of distinct subexpressions above which
+    :meth:`sumpy.assignment_collection.SymbolicAssignmentCollection.run_global_cse`
+    processes assignments in chunks, bounding its memory use at the expense of
+    missing some common subexpressions. *None* (the default) disables chunking.
+    """
+    global CSE_MAX_CHUNK_SIZE
+    CSE_MAX_CHUNK_SIZE = max_chunk_size
+
+# }}}
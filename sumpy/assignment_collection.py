@@ -94,7 +94,8 @@ class SymbolicAssignmentCollection(object):
 
     This is a stateful object, but the only state changes allowed
     are additions to *assignments*, and corresponding updates of
-    its lookup tables.
+    its lookup tables, as well as the rewriting and removal of assignments
+    by :meth:`eliminate_dead_assignments` and :meth:`run_global_cse`.
 
     Note that user code is *only* allowed to hold on to *names* generated
     by this class, but not expressions using names defined in this collection.
@@ -165,14 +166,124 @@ class SymbolicAssignmentCollection(object):
         self.user_symbols.add(new_name)
         return new_name
 
-    def run_global_cse(self, extra_exprs=[]):
+    def get_dependency_ordered_names(self):
+        """Return the names of all assignments, ordered so that each
+        assignment comes after those it depends on.
+        """
+        result = []
+        done = set()
+
+        for root_name in sorted(self.assignments):
+            stack = [(root_name, False)]
+            while stack:
+                name, deps_done = stack.pop()
+                if name in done:
+                    continue
+
+                if deps_done:
+                    done.add(name)
+                    result.append(name)
+                    continue
+
+                stack.append((name, True))
+                stack.extend(
+                        (dep.name, False)
+                        for dep in sorted(
+                            self.assignments[name].free_symbols, key=str,
+                            reverse=True)
+                        if dep.name in self.assignments)
+
+        return result
+
+    def eliminate_dead_assignments(self, retain_names):
+        """Remove assignments that do not contribute to any of the assignments
+        named in *retain_names*, and substitute assignments whose value is
+        zero into their users.
+
+        :returns: the number of assignments removed.
+        """
+        retain_names = set(retain_names)
+        nassignments = len(self.assignments)
+
+        zero_symbols = {}
+        for name in self.get_dependency_ordered_names():
+            expr = self.assignments[name]
+            if zero_symbols:
+                expr = expr.xreplace(zero_symbols)
+                self.assignments[name] = expr
+
+            if expr == 0 and name not in retain_names:
+                zero_symbols[sym.Symbol(name)] = sym.sympify(0)
+
+        live_names = set()
+        stack = [name for name in retain_names if name in self.assignments]
+        while stack:
+            name = stack.pop()
+            if name in live_names:
+                continue
+
+            live_names.add(name)
+            stack.extend(
+                    dep.name for dep in self.assignments[name].free_symbols
+                    if dep.name in self.assignments)
+
+        for name in list(self.assignments):
+            if name not in live_names:
+                del self.assignments[name]
+
+        self.user_symbols &= live_names
+        self.all_dependencies_cache.clear()
+
+        ndead = nassignments - len(self.assignments)
+        logger.info("dead assignment elimination: {ndead} of {nassignments} "
+                "assignments removed".format(
+                    ndead=ndead, nassignments=nassignments))
+
+        return ndead
+
+    def run_global_cse(self, extra_exprs=[], max_chunk_size=None):
+        """Perform common subexpression elimination on all assignments, and on
+        *extra_exprs*, which are returned in reduced form.
+
+        :arg max_chunk_size: If given (or set via
+            :func:`sumpy.set_cse_max_chunk_size`), the assignments are
+            processed in dependency order, in chunks with no more than about
+            this many distinct subexpressions each, to bound memory use.
+            Subexpressions eliminated in earlier chunks are reused in later
+            ones, but common subexpressions that only appear in parts of
+            expressions in different chunks are not found.
+        """
         import time
         start_time = time.time()
 
         logger.info("common subexpression elimination: start")
 
-        assign_names = sorted(self.assignments)
+        if max_chunk_size is None:
+            from sumpy import CSE_MAX_CHUNK_SIZE
+            max_chunk_size = CSE_MAX_CHUNK_SIZE
+
+        if max_chunk_size is None:
+            new_extra_exprs = self._run_cse_on_chunk(
+                    sorted(self.assignments), extra_exprs)
+        else:
+            new_extra_exprs = self._run_chunked_cse(extra_exprs, max_chunk_size)
+
+        logger.info("common subexpression elimination: done after {dur:.2f} s"
+                    .format(dur=time.time() - start_time))
+        return new_extra_exprs
+
+    def _run_cse_on_chunk(self, assign_names, extra_exprs, subexpr_table=None):
         assign_exprs = [self.assignments[name] for name in assign_names]
+        extra_exprs = [sym.sympify(expr) for expr in extra_exprs]
+
+        if subexpr_table is not None:
+            assign_exprs = [
+                    subexpr_table.reduce(expr, name)
+                    for name, expr in zip(assign_names, assign_exprs)]
+            extra_exprs = [subexpr_table.reduce(expr) for expr in extra_exprs]
+            orig_subexprs = {}
+        else:
+            orig_subexprs = None
 
         # Options here:
         # - checked_cse: if you mistrust the result of the cse.
@@ -183,7 +294,11 @@ class SymbolicAssignmentCollection(object):
 
         from sumpy.cse import cse
         new_assignments, new_exprs = cse(assign_exprs + extra_exprs,
-                symbols=self.symbol_generator)
+                symbols=self.symbol_generator, subexpr_table=orig_subexprs)
+
+        if subexpr_table is not None:
+            new_assignments, new_exprs = subexpr_table.add_replacements(
+                    new_assignments, new_exprs, orig_subexprs)
 
         new_assign_exprs = new_exprs[:len(assign_exprs)]
         new_extra_exprs = new_exprs[len(assign_exprs):]
@@ -195,10 +310,118 @@ class SymbolicAssignmentCollection(object):
             assert isinstance(name, sym.Symbol)
             self.add_assignment(name.name, value)
 
-        logger.info("common subexpression elimination: done after {dur:.2f} s"
-                    .format(dur=time.time() - start_time))
         return new_extra_exprs
 
+    def _run_chunked_cse(self, extra_exprs, max_chunk_size):
+        subexpr_table = _SubexpressionTable()
+
+        # Chunk the assignments as given, so that no CSE pass ever looks
+        # at more than one chunk at a time.
+        chunks = []
+        chunk = []
+        seen_subexprs = set()
+
+        for name in self.get_dependency_ordered_names():
+            if chunk and len(seen_subexprs) > max_chunk_size:
+                chunks.append(chunk)
+                chunk = []
+                seen_subexprs = set()
+
+            chunk.append(name)
+            stack = [self.assignments[name]]
+            while stack:
+                expr = stack.pop()
+                if expr not in seen_subexprs:
+                    seen_subexprs.add(expr)
+                    stack.extend(expr.args)
+
+        if chunk:
+            chunks.append(chunk)
+
+        logger.info("common subexpression elimination: processing %d "
+                "assignments in %d chunks"
+                % (sum(len(chunk) for chunk in chunks), len(chunks)))
+
+        for chunk in chunks:
+            self._run_cse_on_chunk(chunk, [], subexpr_table)
+
+        return self._run_cse_on_chunk([], extra_exprs, subexpr_table)
+
+
+class _SubexpressionTable(object):
+    """Keeps track of the subexpressions eliminated by chunked CSE, so that
+    later chunks can reuse them.
+    """
+
+    def __init__(self):
+        self.subexpr_to_symbol = {}
+
+    def reduce(self, expr, name=None):
+        """Replace known subexpressions of *expr* by their symbols, from the
+        leaves up, so that subexpressions are found even if they were recorded
+        in terms of other known subexpressions. If *expr* is the value of the
+        assignment to *name*, it is not itself replaced.
+        """
+        reduced = {}
+        stack = [(expr, False)]
+
+        while stack:
+            subexpr, args_done = stack.pop()
+
+            if args_done:
+                new_args = tuple(reduced.get(arg, arg) for arg in subexpr.args)
+                if new_args != subexpr.args:
+                    new_subexpr = subexpr.func(*new_args)
+                else:
+                    new_subexpr = subexpr
+
+                reduced[subexpr] = self.subexpr_to_symbol.get(
+                        new_subexpr, new_subexpr)
+
+            elif subexpr.args and subexpr not in reduced:
+                stack.append((subexpr, True))
+                stack.extend((arg, False) for arg in subexpr.args)
+
+        result = reduced.get(expr, expr)
+        if name is not None and result == sym.Symbol(name):
+            return expr
+
+        return result
+
+    def add_replacements(self, replacements, reduced_exprs, orig_subexprs):
+        """Record *replacements* as returned by :func:`sumpy.cse.cse`.
+        Replacements whose value is already known are dropped in favor of the
+        known symbol.
+
+        :arg orig_subexprs: a mapping from subexpressions as they appeared in
+            the input of the CSE to their replacement symbols.
+        :returns: a tuple of the remaining replacements and *reduced_exprs*,
+            updated to use only those.
+        """
+        aliases = {}
+        new_replacements = []
+
+        for symbol, value in replacements:
+            if aliases:
+                value = value.xreplace(aliases)
+
+            reduced_value = self.reduce(value)
+            if reduced_value != value and isinstance(reduced_value, sym.Symbol):
+                aliases[symbol] = reduced_value
+                continue
+
+            self.subexpr_to_symbol[reduced_value] = symbol
+            new_replacements.append((symbol, value))
+
+        for subexpr, symbol in six.iteritems(orig_subexprs):
+            self.subexpr_to_symbol.setdefault(
+                    subexpr, aliases.get(symbol, symbol))
+
+        if aliases:
+            reduced_exprs = [expr.xreplace(aliases) for expr in reduced_exprs]
+
+        return new_replacements, reduced_exprs
+
 # }}}
 
 # vim: fdm=marker
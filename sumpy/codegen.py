@@ -400,6 +400,7 @@ class BesselTopOrderGatherer(CSECachingMapperMixin, WalkMapper):
     """
     def __init__(self):
         self.bessel_j_arg_to_top_order = {}
+        self.bessel_derivative_replacer = BesselDerivativeReplacer()
 
     def map_call(self, expr):
         if isinstance(expr.function, prim.Variable) \
@@ -413,6 +414,11 @@ class BesselTopOrderGatherer(CSECachingMapperMixin, WalkMapper):
         else:
             return WalkMapper.map_call(self, expr)
 
+    def map_substitution(self, expr):
+        # Derivatives of Bessel functions are rewritten in terms of Bessel
+        # functions of other orders, which need to be accounted for.
+        self.rec(self.bessel_derivative_replacer(expr))
+
     map_common_subexpression_uncached = WalkMapper.map_common_subexpression
 
 
@@ -495,7 +501,7 @@ class PowerRewriter(CSECachingMapperMixin, IdentityMapper):
                 p *= -1
 
             if q == 1:
-                return self.rec(new_base**p)
+                return self.rec(prim.wrap_in_cse(expr.base)**p)
 
             if q == 2:
                 assert p != 0
@@ -665,6 +671,110 @@ class SumSignGrouper(CSECachingMapperMixin, IdentityMapper):
 # }}}
 
 
+# {{{ fused rewriter
+
+class ExpressionRewriter(CSECachingMapperMixin, IdentityMapper):
+    """Applies the rewriting rules of :class:`BesselDerivativeReplacer`,
+    :class:`BesselSubstitutor`, :class:`VectorComponentRewriter`,
+    :class:`PowerRewriter`, :class:`FractionKiller`, :class:`SumSignGrouper`,
+    :class:`BigIntegerKiller` and :class:`ComplexRewriter` in a single
+    traversal of the expression.
+
+    The power and fraction rules are implemented here directly. Each of the
+    others is applied by the corresponding mapper to the node it matches,
+    after which the result is rewritten further by this mapper, so that the
+    individual mappers never traverse the whole expression.
+    """
+
+    def __init__(self, bessel_getter, vector_names=set()):
+        IdentityMapper.__init__(self)
+        self.bessel_derivative_replacer = BesselDerivativeReplacer()
+        self.bessel_substitutor = BesselSubstitutor(bessel_getter)
+        self.vector_component_rewriter = VectorComponentRewriter(vector_names)
+        self.sum_sign_grouper = SumSignGrouper()
+        self.big_integer_killer = BigIntegerKiller()
+        self.complex_rewriter = ComplexRewriter()
+
+    def map_substitution(self, expr):
+        return self.rec(self.bessel_derivative_replacer(expr))
+
+    def map_call(self, expr):
+        if (isinstance(expr.function, prim.Variable)
+                and expr.function.name in ["hankel_1", "bessel_j"]):
+            return self.rec(self.bessel_substitutor(expr))
+
+        return IdentityMapper.map_call(self, expr)
+
+    def map_variable(self, expr):
+        return self.vector_component_rewriter(expr)
+
+    def map_power(self, expr):
+        # same rules as PowerRewriter.map_power
+        exp = expr.exponent
+        if isinstance(exp, int):
+            new_base = prim.wrap_in_cse(expr.base)
+
+            if exp > 1 and exp % 2 == 0:
+                square = prim.wrap_in_cse(new_base*new_base)
+                return self.rec(prim.wrap_in_cse(square**(exp//2)))
+            elif exp > 1 and exp % 2 == 1:
+                square = prim.wrap_in_cse(new_base*new_base)
+                return self.rec(prim.wrap_in_cse(square**((exp-1)//2))*new_base)
+            elif exp == 1:
+                return self.rec(new_base)
+            elif exp < 0:
+                return self.rec((1/new_base)**(-exp))
+
+        if (isinstance(exp, prim.Quotient)
+                and isinstance(exp.numerator, int)
+                and isinstance(exp.denominator, int)):
+
+            p, q = exp.numerator, exp.denominator
+            if q < 0:
+                q *= -1
+                p *= -1
+
+            if q == 1:
+                return self.rec(prim.wrap_in_cse(expr.base)**p)
+
+            if q == 2:
+                assert p != 0
+
+                if p > 0:
+                    orig_base = prim.wrap_in_cse(expr.base)
+                    new_base = prim.wrap_in_cse(prim.Variable("sqrt")(orig_base))
+                else:
+                    new_base = prim.wrap_in_cse(prim.Variable("rsqrt")(expr.base))
+                    p *= -1
+
+                return self.rec(new_base**p)
+
+        return IdentityMapper.map_power(self, expr)
+
+    def map_quotient(self, expr):
+        # same rules as FractionKiller.map_quotient
+        num = expr.numerator
+        denom = expr.denominator
+
+        if isinstance(num, int) and isinstance(denom, int):
+            if num % denom == 0:
+                return num // denom
+            return int(num) / int(denom)
+
+        return IdentityMapper.map_quotient(self, expr)
+
+    def map_sum(self, expr):
+        return self.sum_sign_grouper(
+                prim.Sum(tuple(self.rec(child) for child in expr.children)))
+
+    def map_constant(self, expr):
+        return self.complex_rewriter(self.big_integer_killer(expr))
+
+    map_common_subexpression_uncached = IdentityMapper.map_common_subexpression
+
+# }}}
+
+
 class MathConstantRewriter(CSECachingMapperMixin, IdentityMapper):
     def map_variable(self, expr):
         if expr.name == "pi":
@@ -686,9 +796,6 @@ def to_loopy_insns(assignments, vector_names=set(), pymbolic_expr_maps=[],
 
     assignments = kill_trivial_assignments(assignments, retain_names)
 
-    bdr = BesselDerivativeReplacer()
-    assignments = [(name, bdr(expr)) for name, expr in assignments]
-
     btog = BesselTopOrderGatherer()
     for name, expr in assignments:
         btog(expr)
@@ -700,24 +807,12 @@ def to_loopy_insns(assignments, vector_names=set(), pymbolic_expr_maps=[],
     #cse_tag = CSETagMapper(cse_walk)
 
     # do the rest of the conversion
-    bessel_sub = BesselSubstitutor(BesselGetter(btog.bessel_j_arg_to_top_order))
-    vcr = VectorComponentRewriter(vector_names)
-    pwr = PowerRewriter()
-    ssg = SumSignGrouper()
-    fck = FractionKiller()
-    bik = BigIntegerKiller()
-    cmr = ComplexRewriter()
+    rewriter = ExpressionRewriter(
+            BesselGetter(btog.bessel_j_arg_to_top_order), vector_names)
 
     def convert_expr(name, expr):
         logger.debug("generate expression for: %s" % name)
-        expr = bdr(expr)
-        expr = bessel_sub(expr)
-        expr = vcr(expr)
-        expr = pwr(expr)
-        expr = fck(expr)
-        expr = ssg(expr)
-        expr = bik(expr)
-        expr = cmr(expr)
+        expr = rewriter(expr)
         #expr = cse_tag(expr)
         for m in pymbolic_expr_maps:
             expr = m(expr)
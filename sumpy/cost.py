@@ -0,0 +1,462 @@
+from __future__ import division, absolute_import
+
+__copyright__ = "Copyright (C) 2026 The sumpy authors"
+
+__license__ = """
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import numpy as np
+from pytools.persistent_dict import PersistentDict
+
+from sumpy.version import VERSION_TEXT
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__doc__ = """
+Cost model
+----------
+
+Predicts the time spent in each stage of an FMM driven by
+:class:`sumpy.fmm.SumpyExpansionWrangler`. Each stage is modeled as a
+calibration constant (seconds per operation) times an operation count
+obtained from the tree, the traversal and the per-level expansion orders.
+The calibration constants are measured once per device by timing actual
+FMM runs and can be kept in an on-disk cache.
+
+.. autodata:: FMM_STAGES
+
+.. autoclass:: FMMCostModel
+
+.. autoclass:: DirectEvaluationSelector
+"""
+
+
+FMM_STAGES = ("p2m", "m2m", "m2l", "m2p", "p2l", "l2l", "l2p", "p2p")
+"""The stages of the FMM whose cost is modeled, in the order in which
+:func:`boxtree.fmm.drive_fmm` runs them.
+"""
+
+# Names under which boxtree.fmm.drive_fmm records the timing of each stage
+_STAGE_TO_TIMING_NAME = {
+        "p2m": "form_multipoles",
+        "m2m": "coarsen_multipoles",
+        "m2l": "multipole_to_local",
+        "m2p": "eval_multipoles",
+        "p2l": "form_locals",
+        "l2l": "refine_locals",
+        "l2p": "eval_locals",
+        "p2p": "eval_direct",
+        }
+
+# Maps a calibration key to a dictionary of seconds per operation by stage.
+# Unlike the code caches, entries here may be overwritten by recalibrating.
+calibration_cache = PersistentDict(
+        "sumpy-cost-model-calibration-v1-"+VERSION_TEXT)
+
+
+# {{{ helpers
+
+def _csr_sums(starts, lists, values):
+    """Return, for each row of the CSR structure *starts*, *lists*, the sum
+    of *values* over the entries of that row.
+    """
+    starts = np.asarray(starts)
+    cumsum = np.zeros(len(lists) + 1, dtype=np.float64)
+    np.cumsum(values[np.asarray(lists)], out=cumsum[1:])
+    return cumsum[starts[1:]] - cumsum[starts[:-1]]
+
+
+def get_device_key(device):
+    """Return a hashable identifier of *device* suitable as part of a
+    calibration cache key.
+    """
+    return (device.platform.name, device.platform.version,
+            device.name, device.driver_version)
+
+# }}}
+
+
+# {{{ cost model
+
+class FMMCostModel(object):
+    """Per-stage and per-box cost estimates for FMMs using a
+    :class:`sumpy.fmm.SumpyExpansionWranglerCodeContainer`.
+
+    All methods taking a *tree* and a *traversal* expect them on the host,
+    e.g. as obtained from :meth:`boxtree.Tree.get`.
+
+    .. attribute:: calibration_params
+
+        A dictionary mapping each entry of :data:`FMM_STAGES` to its cost in
+        seconds per operation, or *None* if the model is not yet calibrated.
+
+    .. automethod:: get_box_op_counts
+    .. automethod:: predict_stage_times
+    .. automethod:: get_box_costs
+    .. automethod:: calibrate
+    .. automethod:: load_calibration
+    """
+
+    def __init__(self, code_container, calibration_params=None):
+        """
+        :arg code_container: a
+            :class:`sumpy.fmm.SumpyExpansionWranglerCodeContainer`
+        :arg calibration_params: see :attr:`calibration_params`
+        """
+        self.code = code_container
+        self.calibration_params = calibration_params
+
+    def calibration_key(self, device, dtype):
+        code = self.code
+        return (get_device_key(device),
+                np.dtype(dtype).name,
+                code.get_base_kernel(),
+                tuple(code.out_kernels),
+                type(code.multipole_expansion(1)).__name__,
+                type(code.local_expansion(1)).__name__,
+                # options changing the kernels run by each stage
+                code.looped_translations,
+                code.fused_l2p_p2p,
+                code.reorder_in_kernels,
+                code.compact_expansions,
+                code.expansion_layout)
+
+    # {{{ operation counts
+
+    def get_box_op_counts(self, tree, traversal, level_orders):
+        """Return a dictionary mapping each entry of :data:`FMM_STAGES` to an
+        array of length *tree.nboxes* holding the number of operations that
+        stage performs on behalf of each box. Work is attributed to the box
+        whose expansion or potential it produces.
+
+        An operation is one coefficient of output per coefficient (or
+        particle) of input, e.g. M2L between two boxes costs the product of
+        the number of multipole and local coefficients.
+
+        :arg level_orders: a sequence of expansion orders, one per level,
+            e.g. :attr:`sumpy.fmm.SumpyExpansionWrangler.level_orders`.
+        """
+        nboxes = tree.nboxes
+        box_levels = np.asarray(tree.box_levels)
+        nsources = np.asarray(tree.box_source_counts_nonchild).astype(np.float64)
+        ntargets = np.asarray(tree.box_target_counts_nonchild).astype(np.float64)
+
+        mpole_ncoeffs = np.array([
+            len(self.code.multipole_expansion(order)) for order in level_orders],
+            dtype=np.float64)
+        local_ncoeffs = np.array([
+            len(self.code.local_expansion(order)) for order in level_orders],
+            dtype=np.float64)
+
+        result = dict(
+                (stage, np.zeros(nboxes, dtype=np.float64))
+                for stage in FMM_STAGES)
+
+        # {{{ p2m
+
+        boxes = np.asarray(traversal.source_boxes)
+        result["p2m"][boxes] += (
+                nsources[boxes] * mpole_ncoeffs[box_levels[boxes]])
+
+        # }}}
+
+        # {{{ m2m
+
+        boxes = np.asarray(traversal.source_parent_boxes)
+        levels = box_levels[boxes]
+        nchildren = np.sum(np.asarray(tree.box_child_ids)[:, boxes] != 0, axis=0)
+        result["m2m"][boxes] += (
+                nchildren * mpole_ncoeffs[levels + 1] * mpole_ncoeffs[levels])
+
+        # }}}
+
+        # {{{ m2l, p2l, l2l
+
+        boxes = np.asarray(traversal.target_or_target_parent_boxes)
+        levels = box_levels[boxes]
+
+        starts = np.asarray(traversal.from_sep_siblings_starts)
+        result["m2l"][boxes] += (
+                np.diff(starts) * mpole_ncoeffs[levels] * local_ncoeffs[levels])
+
+        result["p2l"][boxes] += (
+                _csr_sums(
+                    traversal.from_sep_bigger_starts,
+                    traversal.from_sep_bigger_lists,
+                    nsources)
+                * local_ncoeffs[levels])
+
+        nonroot = levels > 0
+        result["l2l"][boxes[nonroot]] += (
+                local_ncoeffs[levels[nonroot] - 1] * local_ncoeffs[levels[nonroot]])
+
+        # }}}
+
+        # {{{ m2p
+
+        for isrc_level, ssn in enumerate(traversal.from_sep_smaller_by_level):
+            boxes = np.asarray(
+                    traversal.target_boxes_sep_smaller_by_source_level[isrc_level])
+            result["m2p"][boxes] += (
+                    ntargets[boxes]
+                    * np.diff(np.asarray(ssn.starts))
+                    * mpole_ncoeffs[isrc_level])
+
+        # }}}
+
+        # {{{ l2p, p2p
+
+        boxes = np.asarray(traversal.target_boxes)
+        result["l2p"][boxes] += ntargets[boxes] * local_ncoeffs[box_levels[boxes]]
+
+        p2p_nsources = _csr_sums(
+                traversal.neighbor_source_boxes_starts,
+                traversal.neighbor_source_boxes_lists,
+                nsources)
+
+        # With target extents, parts of lists 3 and 4 become direct
+        # interactions.
+        for close_starts, close_lists in [
+                (getattr(traversal, "from_sep_close_smaller_starts", None),
+                    getattr(traversal, "from_sep_close_smaller_lists", None)),
+                (getattr(traversal, "from_sep_close_bigger_starts", None),
+                    getattr(traversal, "from_sep_close_bigger_lists", None)),
+                ]:
+            if close_starts is not None:
+                p2p_nsources = p2p_nsources + _csr_sums(
+                        close_starts, close_lists, nsources)
+
+        result["p2p"][boxes] += ntargets[boxes] * p2p_nsources
+
+        # }}}
+
+        return result
+
+    # }}}
+
+    # {{{ predictions
+
+    def _get_calibration_params(self):
+        if self.calibration_params is None:
+            raise ValueError("cost model is not calibrated: call calibrate() "
+                    "or load_calibration() first")
+        return self.calibration_params
+
+    def predict_stage_times(self, tree, traversal, level_orders):
+        """Return a dictionary mapping each entry of :data:`FMM_STAGES` to its
+        predicted time in seconds.
+        """
+        params = self._get_calibration_params()
+        op_counts = self.get_box_op_counts(tree, traversal, level_orders)
+
+        return dict(
+                (stage, params[stage] * np.sum(op_counts[stage]))
+                for stage in FMM_STAGES)
+
+    def get_box_costs(self, tree, traversal, level_orders, stages=FMM_STAGES):
+        """Return an array of length *tree.nboxes* holding the predicted time
+        in seconds spent on behalf of each box in *stages*. These are suitable
+        as weights for partitioning the tree across devices or ranks.
+        """
+        params = self._get_calibration_params()
+        op_counts = self.get_box_op_counts(tree, traversal, level_orders)
+
+        result = np.zeros(tree.nboxes, dtype=np.float64)
+        for stage in stages:
+            result += params[stage] * op_counts[stage]
+
+        return result
+
+    # }}}
+
+    # {{{ calibration
+
+    def calibrate(self, problems, nruns=3, store=False):
+        """Measure :attr:`calibration_params` by running the FMM on each of
+        *problems* and fitting one constant per stage by least squares.
+
+        :arg problems: a sequence of tuples *(traversal, wrangler,
+            src_weights)* as accepted by :func:`boxtree.fmm.drive_fmm`. The
+            wranglers must belong to this model's code container and use a
+            command queue with profiling enabled. They should not use fused
+            stages, since their timings cannot be attributed to a single
+            stage.
+        :arg nruns: the number of timed runs per problem. An additional
+            untimed run is done first to exclude compilation time.
+        :arg store: whether to save the result in the (persistent)
+            calibration cache, from which :meth:`load_calibration` retrieves
+            it.
+        :returns: :attr:`calibration_params`
+        """
+        from boxtree.fmm import drive_fmm
+
+        if not problems:
+            raise ValueError("at least one problem is needed for calibration")
+
+        op_count_sq_sums = dict((stage, 0.) for stage in FMM_STAGES)
+        op_count_time_sums = dict((stage, 0.) for stage in FMM_STAGES)
+
+        for traversal, wrangler, src_weights in problems:
+            queue = wrangler.queue
+            host_traversal = traversal.get(queue=queue)
+            op_counts = self.get_box_op_counts(
+                    host_traversal.tree, host_traversal, wrangler.level_orders)
+
+            # Warm-up run to compile all kernels
+            drive_fmm(traversal, wrangler, src_weights)
+
+            for irun in range(nruns):
+                timing_data = {}
+                drive_fmm(traversal, wrangler, src_weights,
+                        timing_data=timing_data)
+
+                for stage in FMM_STAGES:
+                    timing_name = _STAGE_TO_TIMING_NAME[stage]
+                    if timing_name not in timing_data:
+                        continue
+
+                    elapsed = timing_data[timing_name]["wall_elapsed"]
+                    if elapsed is None:
+                        raise RuntimeError("no timing data collected: "
+                                "calibration requires a command queue with "
+                                "profiling enabled")
+
+                    nops = np.sum(op_counts[stage])
+                    op_count_sq_sums[stage] += nops**2
+                    op_count_time_sums[stage] += nops*elapsed
+
+        self.calibration_params = dict(
+                (stage,
+                    op_count_time_sums[stage] / op_count_sq_sums[stage]
+                    if op_count_sq_sums[stage] else 0.)
+                for stage in FMM_STAGES)
+
+        logger.info("cost model calibration: %s", self.calibration_params)
+
+        if store:
+            wrangler = problems[0][1]
+            calibration_cache.store(
+                    self.calibration_key(wrangler.queue.device, wrangler.dtype),
+                    self.calibration_params)
+
+        return self.calibration_params
+
+    def load_calibration(self, device, dtype):
+        """Set :attr:`calibration_params` from a previous :meth:`calibrate`
+        on *device* with wranglers of type *dtype*.
+
+        :returns: *True* if stored calibration data was found, else *False*.
+        """
+        from pytools.persistent_dict import NoSuchEntryError
+
+        try:
+            self.calibration_params = calibration_cache.fetch(
+                    self.calibration_key(device, dtype))
+        except NoSuchEntryError:
+            return False
+
+        return True
+
+    # }}}
+
+# }}}
+
+
+# {{{ direct evaluation selector
+
+class DirectEvaluationSelector(object):
+    r"""Decide, for each interaction in list 3 (evaluated by M2P) and in
+    list 4 (evaluated by P2L), whether evaluating it directly from the
+    source particles to the target particles is cheaper. Since direct
+    evaluation is exact, this does not reduce accuracy.
+
+    The costs compared are those of :class:`FMMCostModel`. An M2P
+    interaction from a source box to a target box with :math:`n_t` targets
+    costs :math:`c_\text{m2p} n_t N_c`, with :math:`N_c` the number of
+    coefficients of the multipole expansion, while its direct evaluation
+    costs :math:`c_\text{p2p} n_t n_s`, with :math:`n_s` the number of
+    sources in the source box and its descendants. Likewise for P2L, with
+    :math:`n_t` the number of targets in the target box and its
+    descendants.
+
+    Instances are suitable as *direct_evaluation_selector* in
+    :meth:`sumpy.fmm.SumpyExpansionWranglerCodeContainer.get_wrangler`.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    """
+
+    def __init__(self, cost_model=None):
+        """
+        :arg cost_model: a calibrated :class:`FMMCostModel` providing the
+            cost per operation of each stage. If *None*, all operations are
+            assumed to cost the same.
+        """
+        self.cost_model = cost_model
+
+    def get_cost_ratio(self, stage):
+        """Return the cost per operation of *stage* relative to that of
+        direct evaluation.
+        """
+        if self.cost_model is None or self.cost_model.calibration_params is None:
+            return 1.
+
+        params = self.cost_model.calibration_params
+        if params[stage] <= 0 or params["p2p"] <= 0:
+            return 1.
+
+        return params[stage] / params["p2p"]
+
+    def __call__(self, tree, stage, ncoeffs, target_boxes,
+            source_box_starts, source_box_lists):
+        """
+        :arg tree: a :class:`boxtree.Tree` on the host
+        :arg stage: ``"m2p"`` for list 3 or ``"p2l"`` for list 4
+        :arg ncoeffs: the number of coefficients of the expansions involved
+        :arg target_boxes: an array of target box numbers
+        :arg source_box_starts: an array of length ``len(target_boxes) + 1``
+            that, with *source_box_lists*, forms a "compressed sparse row"
+            list of the source boxes interacting with each target box
+        :returns: a boolean array, *True* for each entry of
+            ``source_box_lists[source_box_starts[0]:source_box_starts[-1]]``
+            to be evaluated directly
+        """
+        pair_target_boxes = np.repeat(target_boxes, np.diff(source_box_starts))
+        pair_source_boxes = source_box_lists[
+                source_box_starts[0]:source_box_starts[-1]]
+
+        # The number of particles on the side that is not summarized by an
+        # expansion replaces the number of coefficients.
+        if stage == "m2p":
+            nparticles = np.asarray(
+                    tree.box_source_counts_cumul)[pair_source_boxes]
+        elif stage == "p2l":
+            nparticles = np.asarray(
+                    tree.box_target_counts_cumul)[pair_target_boxes]
+        else:
+            raise ValueError("unsupported stage: '%s'" % stage)
+
+        return nparticles < self.get_cost_ratio(stage) * ncoeffs
+
+# }}}
+
+# vim: foldmethod=marker
@@ -184,8 +184,8 @@ class FuncArgTracker(object):
         `argset`. Entries have at least 2 items in common.  All keys have
         value at least `min_func_i`.
         """
-        from collections import defaultdict
-        count_map = defaultdict(lambda: 0)
+        from collections import Counter
+        count_map = Counter()
 
         funcsets = [self.arg_to_funcset[arg] for arg in argset]
         # As an optimization below, we handle the largest funcset separately from
@@ -193,29 +193,24 @@ class FuncArgTracker(object):
         largest_funcset = max(funcsets, key=len)
 
         for funcset in funcsets:
-            if largest_funcset is funcset:
-                continue
-            for func_i in funcset:
-                if func_i >= min_func_i:
-                    count_map[func_i] += 1
+            if largest_funcset is not funcset:
+                count_map.update(funcset)
 
         # We pick the smaller of the two containers (count_map, largest_funcset)
-        # to iterate over to reduce the number of iterations needed.
-        (smaller_funcs_container,
-         larger_funcs_container) = sorted(
-                 [largest_funcset, count_map],
-                 key=len)
-
-        for func_i in smaller_funcs_container:
-            # Not already in count_map? It can't possibly be in the output, so
-            # skip it.
-            if count_map[func_i] < 1:
-                continue
-
-            if func_i in larger_funcs_container:
-                count_map[func_i] += 1
+        # to iterate over to reduce the number of iterations needed. Functions
+        # not already in count_map can't possibly be in the output.
+        if len(count_map) <= len(largest_funcset):
+            for func_i in list(count_map):
+                if func_i in largest_funcset:
+                    count_map[func_i] += 1
+        else:
+            for func_i in largest_funcset:
+                if func_i in count_map:
+                    count_map[func_i] += 1
 
-        return dict((k, v) for k, v in count_map.items() if v >= 2)
+        return dict(
+                (k, v) for k, v in count_map.items()
+                if v >= 2 and k >= min_func_i)
 
     def get_subset_candidates(self, argset, restrict_to_funcset=None):
         """
@@ -223,18 +218,13 @@ class FuncArgTracker(object):
         `argset`, optionally filtered only to contain functions in
         `restrict_to_funcset`.
         """
-        iarg = iter(argset)
-
-        indices = set(
-            fi for fi in self.arg_to_funcset[next(iarg)])
-
+        funcsets = sorted(
+                (self.arg_to_funcset[arg] for arg in argset), key=len)
         if restrict_to_funcset is not None:
-            indices &= restrict_to_funcset
+            funcsets.insert(0, restrict_to_funcset)
 
-        for arg in iarg:
-            indices &= self.arg_to_funcset[arg]
-
-        return indices
+        # Start from the smallest set, so that the intersection is cheap.
+        return set(funcsets[0]).intersection(*funcsets[1:])
 
     def update_func_argset(self, func_i, new_argset):
         """
@@ -293,20 +283,21 @@ def match_common_args(func_class, funcs, opt_subs):
 
     changed = set()
 
-    from sumpy.tools import OrderedSet
-
     for i in range(len(funcs)):
         common_arg_candidates_counts = arg_tracker.get_common_arg_candidates(
                 arg_tracker.func_to_argset[i], min_func_i=i + 1)
 
         # Sort the candidates in order of match size.
         # This makes us try combining smaller matches first.
-        common_arg_candidates = OrderedSet(sorted(
-                common_arg_candidates_counts.keys(),
-                key=lambda k: (common_arg_candidates_counts[k], k)))
+        common_arg_candidates = sorted(
+                common_arg_candidates_counts,
+                key=lambda k: (common_arg_candidates_counts[k], k))
+
+        # Candidates not yet tried
+        remaining_candidates = set(common_arg_candidates)
 
-        while common_arg_candidates:
-            j = common_arg_candidates.pop(last=False)
+        for j in common_arg_candidates:
+            remaining_candidates.remove(j)
 
             com_args = arg_tracker.func_to_argset[i].intersection(
                     arg_tracker.func_to_argset[j])
@@ -344,7 +335,7 @@ def match_common_args(func_class, funcs, opt_subs):
             changed.add(j)
 
             for k in arg_tracker.get_subset_candidates(
-                    com_args, common_arg_candidates):
+                    com_args, remaining_candidates):
                 diff_k = arg_tracker.func_to_argset[k].difference(com_args)
                 arg_tracker.update_func_argset(k, diff_k | set([com_func_number]))
                 changed.add(k)
@@ -374,29 +365,40 @@ def opt_cse(exprs):
 
     # {{{ look for optimization opportunities, clean up minus signs
 
-    def find_opts(expr):
-        if not isinstance(expr, Basic):
-            return
+    def find_opts(root):
+        # This is a depth-first traversal that processes each node after its
+        # children, with an explicit stack to avoid deep recursion.
+        stack = [(root, False)]
 
-        if expr.is_Atom:
-            return
+        while stack:
+            expr, children_done = stack.pop()
 
-        if isinstance(expr, CSE_NO_DESCEND_CLASSES):
-            return
+            if children_done:
+                process_opts(expr)
+                continue
 
-        if iterable(expr):
-            for item in expr:
-                find_opts(item)
-            return
+            if not isinstance(expr, Basic):
+                continue
 
-        if expr in seen_subexp:
-            return expr
+            if expr.is_Atom:
+                continue
+
+            if isinstance(expr, CSE_NO_DESCEND_CLASSES):
+                continue
 
-        seen_subexp.add(expr)
+            if iterable(expr):
+                stack.extend((item, False) for item in reversed(list(expr)))
+                continue
+
+            if expr in seen_subexp:
+                continue
+
+            seen_subexp.add(expr)
 
-        for arg in expr.args:
-            find_opts(arg)
+            stack.append((expr, True))
+            stack.extend((arg, False) for arg in reversed(expr.args))
 
+    def process_opts(expr):
         if _coeff_isneg(expr):
             neg_expr = -expr
             if not neg_expr.is_Atom:
@@ -431,7 +433,7 @@ def opt_cse(exprs):
 
 # {{{ tree cse
 
-def tree_cse(exprs, symbols, opt_subs=None):
+def tree_cse(exprs, symbols, opt_subs=None, subexpr_table=None):
     """
     Perform raw CSE on an expression tree, taking opt_subs into account.
 
@@ -440,6 +442,7 @@ def tree_cse(exprs, symbols, opt_subs=None):
         the common subexpressions which are pulled out.
     :arg opt_subs: A dictionary of expression substitutions to be
         substituted before any CSE action is performed.
+    :arg subexpr_table: see :func:`cse`.
 
     :return: A pair (replacements, reduced exprs)
     """
@@ -453,35 +456,41 @@ def tree_cse(exprs, symbols, opt_subs=None):
     seen_subexp = set()
     excluded_symbols = set()
 
-    def find_repeated(expr):
-        if not isinstance(expr, (Basic, Unevaluated)):
-            return
-
-        if isinstance(expr, Basic) and expr.is_Atom:
-            if expr.is_Symbol:
-                excluded_symbols.add(expr)
-            return
+    def find_repeated(root):
+        # The set of subexpressions reached more than once does not depend on
+        # the traversal order, so any order will do.
+        stack = [root]
 
-        if iterable(expr):
-            args = expr
+        while stack:
+            expr = stack.pop()
 
-        else:
-            if expr in seen_subexp:
-                to_eliminate.add(expr)
-                return
+            if not isinstance(expr, (Basic, Unevaluated)):
+                continue
 
-            seen_subexp.add(expr)
+            if isinstance(expr, Basic) and expr.is_Atom:
+                if expr.is_Symbol:
+                    excluded_symbols.add(expr)
+                continue
 
-            if expr in opt_subs:
-                expr = opt_subs[expr]
+            if iterable(expr):
+                args = expr
 
-            if isinstance(expr, CSE_NO_DESCEND_CLASSES):
-                args = ()
             else:
-                args = expr.args
+                if expr in seen_subexp:
+                    to_eliminate.add(expr)
+                    continue
+
+                seen_subexp.add(expr)
+
+                if expr in opt_subs:
+                    expr = opt_subs[expr]
 
-        for arg in args:
-            find_repeated(arg)
+                if isinstance(expr, CSE_NO_DESCEND_CLASSES):
+                    args = ()
+                else:
+                    args = expr.args
+
+            stack.extend(args)
 
     # }}}
 
@@ -496,21 +505,33 @@ def tree_cse(exprs, symbols, opt_subs=None):
 
     replacements = []
 
-    subs = dict()
+    # Maps subexpressions to their rebuilt versions. For subexpressions that
+    # are eliminated, this is the replacement symbol. Subexpressions that are
+    # left unchanged by rebuilding (e.g. atoms) are not included.
+    rebuilt = dict()
 
-    def rebuild(expr):
+    def get_rebuild_args(expr):
+        """Return the arguments of *expr* that need to be rebuilt before *expr*
+        itself, or *None* if *expr* is left unchanged.
+        """
         if not isinstance(expr, (Basic, Unevaluated)):
-            return expr
+            return None
 
         if not expr.args:
-            return expr
+            return None
 
         if iterable(expr):
-            new_args = [rebuild(arg) for arg in expr]
-            return expr.func(*new_args)
+            return list(expr)
 
-        if expr in subs:
-            return subs[expr]
+        expr = opt_subs.get(expr, expr)
+        if isinstance(expr, CSE_NO_DESCEND_CLASSES):
+            return ()
+
+        return expr.args
+
+    def rebuild_from_args(expr):
+        if iterable(expr):
+            return expr.func(*[rebuilt.get(arg, arg) for arg in expr])
 
         orig_expr = expr
         if expr in opt_subs:
@@ -518,7 +539,7 @@ def tree_cse(exprs, symbols, opt_subs=None):
 
         new_expr = expr
         if not isinstance(expr, CSE_NO_DESCEND_CLASSES):
-            new_args = tuple(rebuild(arg) for arg in expr.args)
+            new_args = tuple(rebuilt.get(arg, arg) for arg in expr.args)
             if isinstance(expr, Unevaluated) or new_args != expr.args:
                 new_expr = expr.func(*new_args)
 
@@ -528,12 +549,39 @@ def tree_cse(exprs, symbols, opt_subs=None):
             except StopIteration:
                 raise ValueError("Symbols iterator ran out of symbols.")
 
-            subs[orig_expr] = sym
             replacements.append((sym, new_expr))
+            if subexpr_table is not None and isinstance(orig_expr, Basic):
+                subexpr_table[orig_expr] = sym
             return sym
 
         return new_expr
 
+    def rebuild(root):
+        # This is a depth-first traversal that rebuilds each node after its
+        # (left-to-right) children, with an explicit stack to avoid deep
+        # recursion. Symbols are thus handed out in the same order as by a
+        # recursive traversal.
+        stack = [(root, False)]
+
+        while stack:
+            expr, args_done = stack.pop()
+
+            if args_done:
+                rebuilt[expr] = rebuild_from_args(expr)
+                continue
+
+            if expr in rebuilt:
+                continue
+
+            args = get_rebuild_args(expr)
+            if args is None:
+                continue
+
+            stack.append((expr, True))
+            stack.extend((arg, False) for arg in reversed(args))
+
+        return rebuilt.get(root, root)
+
     # }}}
 
     reduced_exprs = []
@@ -549,7 +597,7 @@ def tree_cse(exprs, symbols, opt_subs=None):
 # }}}
 
 
-def cse(exprs, symbols=None, optimizations=None):
+def cse(exprs, symbols=None, optimizations=None, subexpr_table=None):
     """
     Perform common subexpression elimination on an expression.
 
@@ -560,6 +608,9 @@ def cse(exprs, symbols=None, optimizations=None):
         form "x0", "x1", etc. This must be an infinite iterator.
     :arg optimizations: A list of (callable, callable) pairs consisting of
         (preprocessor, postprocessor) pairs of external optimization functions.
+    :arg subexpr_table: If not *None*, a dictionary that is updated to map each
+        eliminated subexpression, in the form in which it appears in the
+        (preprocessed) *exprs*, to the symbol replacing it.
 
     :return: This returns a pair ``(replacements, reduced_exprs)``.
 
@@ -591,7 +642,8 @@ def cse(exprs, symbols=None, optimizations=None):
     opt_subs = opt_cse(reduced_exprs)
 
     # Main CSE algorithm.
-    replacements, reduced_exprs = tree_cse(reduced_exprs, symbols, opt_subs)
+    replacements, reduced_exprs = tree_cse(reduced_exprs, symbols, opt_subs,
+            subexpr_table)
 
     # Postprocess the expressions to return the expressions to canonical form.
     for i, (sym, subtree) in enumerate(replacements):
@@ -22,15 +22,17 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import six
 from six.moves import range
 
 import numpy as np
 import loopy as lp
+import pyopencl as cl
+import pyopencl.array  # noqa
 import sumpy.symbolic as sym
 
 from loopy.version import MOST_RECENT_LANGUAGE_VERSION
-from sumpy.tools import KernelCacheWrapper
+from pytools import memoize_method
+from sumpy.tools import KernelCacheWrapper, get_accumulation_term
 
 import logging
 logger = logging.getLogger(__name__)
@@ -46,20 +48,60 @@ Expansion-to-expansion
 .. autoclass:: E2EFromParent
 .. autoclass:: E2EFromChildren
 
+Looped translations
+^^^^^^^^^^^^^^^^^^^
+
+These evaluate translations from a
+:class:`sumpy.expansion.TranslationTermTable`, in loops driven by data
+passed at run time, rather than as an unrolled sequence of expressions.
+Their code size is independent of the expansion order.
+
+.. autoclass:: LoopedE2EBase
+.. autoclass:: E2EFromParentLooped
+.. autoclass:: E2EFromChildrenLooped
+
 """
 
 
 # {{{ translation base class
 
 class E2EBase(KernelCacheWrapper):
+    expansion_prefixes = ("src", "tgt")
+
     def __init__(self, ctx, src_expansion, tgt_expansion,
-            options=[], name=None, device=None):
+            options=[], name=None, device=None, tgt_coeff_indices=None,
+            compact_expansions=False, expansion_layout="box_major",
+            src_storage_ncoeffs=None, accumulate_output=False):
         """
         :arg expansion: a subclass of :class:`sympy.expansion.ExpansionBase`
         :arg strength_usage: A list of integers indicating which expression
             uses which source strength indicator. This implicitly specifies the
             number of strength arrays that need to be passed.
             Default: all kernels use the same strength.
+        :arg tgt_coeff_indices: if not *None*, a tuple of indices of the target
+            coefficients to which the generated kernel is restricted. By
+            default, all target coefficients are computed. In either case,
+            the work is split among several kernels if the generated code is
+            too large (see :func:`sumpy.set_max_kernel_insns`).
+        :arg compact_expansions: if *True*, the expansion of box *ibox* is
+            stored in row ``src_box_slots[ibox]`` of *src_expansions* (resp.
+            ``tgt_box_slots[ibox]`` of *tgt_expansions*) instead of in row
+            ``ibox - src_base_ibox`` (resp. ``ibox - tgt_base_ibox``). The
+            generated kernel then takes the slot arrays as additional
+            arguments. See :func:`sumpy.tools.get_expansion_row_rules`.
+        :arg expansion_layout: the memory layout of *src_expansions* and
+            *tgt_expansions*, see :func:`sumpy.tools.parse_expansion_layout`.
+        :arg src_storage_ncoeffs: the number of coefficients stored per box in
+            *src_expansions*, by default ``len(src_expansion)``. If larger,
+            the source expansions are stored with a higher order than that of
+            *src_expansion*, and only their leading coefficients are used.
+            This truncates them to the order of *src_expansion* if
+            :attr:`sumpy.expansion.ExpansionBase.is_prefix_truncatable`
+            holds. Not supported by looped translations.
+        :arg accumulate_output: if *True*, translations computing the whole
+            target expansion of a box (such as :class:`E2EFromCSR`) add into
+            *tgt_expansions* instead of overwriting it. Translations from a
+            box's children or parent always add into *tgt_expansions*.
         """
 
         if device is None:
@@ -87,6 +129,11 @@ class E2EBase(KernelCacheWrapper):
         self.options = options
         self.name = name or self.default_name
         self.device = device
+        self.tgt_coeff_indices = tgt_coeff_indices
+        self.compact_expansions = compact_expansions
+        self.expansion_layout = expansion_layout
+        self.src_storage_ncoeffs = src_storage_ncoeffs
+        self.accumulate_output = accumulate_output
 
         if src_expansion.dim != tgt_expansion.dim:
             raise ValueError("source and target expansions must have "
@@ -94,7 +141,37 @@ class E2EBase(KernelCacheWrapper):
 
         self.dim = src_expansion.dim
 
-    def get_translation_loopy_insns(self):
+    def get_expansion_row_rules(self):
+        from sumpy.tools import get_expansion_row_rules
+        return get_expansion_row_rules(
+                self.expansion_prefixes, self.compact_expansions)
+
+    def get_expansion_slot_arguments(self):
+        from sumpy.tools import get_expansion_slot_arguments
+        return get_expansion_slot_arguments(
+                self.expansion_prefixes, self.compact_expansions)
+
+    def apply_expansion_layout(self, knl):
+        from sumpy.tools import apply_expansion_layout
+        return apply_expansion_layout(
+                knl, self.expansion_prefixes, self.expansion_layout)
+
+    def get_expansion_layout_kwargs(self, knl, kwargs):
+        from sumpy.tools import get_expansion_layout_kwargs
+        return get_expansion_layout_kwargs(
+                knl, self.expansion_prefixes, self.expansion_layout, kwargs)
+
+    def get_src_storage_ncoeffs(self):
+        if self.src_storage_ncoeffs is None:
+            return len(self.src_expansion)
+        return self.src_storage_ncoeffs
+
+    def get_tgt_coeff_indices(self):
+        if self.tgt_coeff_indices is None:
+            return tuple(range(len(self.tgt_expansion)))
+        return self.tgt_coeff_indices
+
+    def get_translation_assignments(self):
         from sumpy.symbolic import make_sym_vector
         dvec = make_sym_vector("d", self.dim)
 
@@ -106,18 +183,35 @@ class E2EBase(KernelCacheWrapper):
 
         from sumpy.assignment_collection import SymbolicAssignmentCollection
         sac = SymbolicAssignmentCollection()
+
+        tgt_coeffs = self.tgt_expansion.translate_from(
+                self.src_expansion, src_coeff_exprs, src_rscale,
+                dvec, tgt_rscale, sac=sac)
+
         tgt_coeff_names = [
-                sac.assign_unique("coeff%d" % i, coeff_i)
-                for i, coeff_i in enumerate(
-                    self.tgt_expansion.translate_from(
-                        self.src_expansion, src_coeff_exprs, src_rscale,
-                        dvec, tgt_rscale))]
+                sac.assign_unique("coeff%d" % i, coeff)
+                for i, coeff in enumerate(tgt_coeffs)]
+
+        return sac, tgt_coeff_names
+
+    def get_translation_loopy_insns(self):
+        # The symbolic work is done (and cached) once for all target
+        # coefficients, and shared by all restrictions to a subset of them.
+        from sumpy.tools import get_cached_post_cse_assignments
+        assignments, tgt_coeff_names = get_cached_post_cse_assignments(
+                ("translation", self.src_expansion, self.tgt_expansion),
+                self.get_translation_assignments)
+
+        if self.tgt_coeff_indices is not None:
+            tgt_coeff_names = [
+                    tgt_coeff_names[i] for i in self.tgt_coeff_indices]
 
-        sac.run_global_cse()
+            from sumpy.tools import restrict_assignments
+            assignments = restrict_assignments(assignments, tgt_coeff_names)
 
         from sumpy.codegen import to_loopy_insns
         return to_loopy_insns(
-                six.iteritems(sac.assignments),
+                assignments,
                 vector_names=set(["d"]),
                 pymbolic_expr_maps=[self.tgt_expansion.get_code_transformer()],
                 retain_names=tgt_coeff_names,
@@ -128,7 +222,55 @@ class E2EBase(KernelCacheWrapper):
         return (
                 type(self).__name__,
                 self.src_expansion,
-                self.tgt_expansion)
+                self.tgt_expansion,
+                self.tgt_coeff_indices,
+                self.compact_expansions,
+                self.expansion_layout,
+                self.src_storage_ncoeffs,
+                self.accumulate_output)
+
+    def get_chunks(self):
+        """Return a list of translations that, run one after the other,
+        compute the same result as *self*. Each computes a subset of the
+        target coefficients in a separate kernel, so that none has more
+        than about :data:`sumpy.MAX_KERNEL_INSNS` instructions.
+        """
+        from sumpy import MAX_KERNEL_INSNS
+        return self._get_chunks(MAX_KERNEL_INSNS)
+
+    @memoize_method
+    def _get_chunks(self, max_insns):
+        tgt_coeff_indices = self.get_tgt_coeff_indices()
+
+        from sumpy.tools import get_kernel_output_chunks
+        chunks = get_kernel_output_chunks(
+                self, max_insns, len(tgt_coeff_indices))
+        if len(chunks) == 1:
+            return [self]
+
+        return [
+                type(self)(self.ctx, self.src_expansion, self.tgt_expansion,
+                    options=self.options,
+                    name="%s_chunk%d" % (self.name, ichunk),
+                    device=self.device,
+                    tgt_coeff_indices=tuple(
+                        tgt_coeff_indices[i] for i in chunk_indices),
+                    compact_expansions=self.compact_expansions,
+                    expansion_layout=self.expansion_layout,
+                    src_storage_ncoeffs=self.src_storage_ncoeffs,
+                    accumulate_output=self.accumulate_output)
+                for ichunk, (chunk_indices, _) in enumerate(chunks)]
+
+    def run_chunks(self, queue, **kwargs):
+        """Run the kernels of :meth:`get_chunks` with the keyword arguments
+        *kwargs*, which must include the (shared) target expansion array.
+        """
+        for chunk in self.get_chunks():
+            knl = chunk.get_cached_optimized_kernel()
+            kwargs.update(chunk.get_expansion_layout_kwargs(knl, kwargs))
+            evt, result = knl(queue, **kwargs)
+
+        return evt, result
 
     def get_optimized_kernel(self):
         # FIXME
@@ -167,7 +309,7 @@ class E2EFromCSR(E2EBase):
                     "{[isrc_box]: isrc_start<=isrc_box<isrc_stop}",
                     "{[idim]: 0<=idim<dim}",
                     ],
-                ["""
+                self.get_expansion_row_rules() + ["""
                 for itgt_box
                     <> tgt_ibox = target_boxes[itgt_box]
 
@@ -186,7 +328,7 @@ class E2EFromCSR(E2EBase):
 
                         """] + ["""
                         <> src_coeff{coeffidx} = \
-                            src_expansions[src_ibox - src_base_ibox, {coeffidx}] \
+                            src_expansions[src_row(src_ibox), {coeffidx}] \
                             {{dep=read_src_ibox}}
                         """.format(coeffidx=i) for i in range(ncoeff_src)] + [
 
@@ -194,10 +336,14 @@ class E2EFromCSR(E2EBase):
                     end
 
                     """] + ["""
-                    tgt_expansions[tgt_ibox - tgt_base_ibox, {coeffidx}] = \
-                            simul_reduce(sum, isrc_box, coeff{coeffidx}) \
+                    tgt_expansions[tgt_row(tgt_ibox), {coeffidx}] = \
+                            {prev}simul_reduce(sum, isrc_box, coeff{coeffidx}) \
                             {{id_prefix=write_expn}}
-                    """.format(coeffidx=i) for i in range(ncoeff_tgt)] + ["""
+                    """.format(coeffidx=i,
+                        prev=get_accumulation_term(
+                            "tgt_expansions[tgt_row(tgt_ibox), %d]" % i,
+                            self.accumulate_output))
+                    for i in self.get_tgt_coeff_indices()] + ["""
                 end
                 """],
                 [
@@ -210,11 +356,14 @@ class E2EFromCSR(E2EBase):
                     lp.ValueArg("nsrc_level_boxes,ntgt_level_boxes",
                         np.int32),
                     lp.GlobalArg("src_expansions", None,
-                        shape=("nsrc_level_boxes", ncoeff_src), offset=lp.auto),
+                        shape=("nsrc_level_boxes",
+                            self.get_src_storage_ncoeffs()),
+                        offset=lp.auto),
                     lp.GlobalArg("tgt_expansions", None,
                         shape=("ntgt_level_boxes", ncoeff_tgt), offset=lp.auto),
                     "..."
-                ] + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
+                ] + self.get_expansion_slot_arguments()
+                + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
                 name=self.name,
                 assumptions="ntgt_boxes>=1",
                 silenced_warnings="write_race(write_expn*)",
@@ -229,7 +378,7 @@ class E2EFromCSR(E2EBase):
         loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
         loopy_knl = lp.tag_inames(loopy_knl, dict(idim="unr"))
 
-        return loopy_knl
+        return self.apply_expansion_layout(loopy_knl)
 
     def __call__(self, queue, **kwargs):
         """
@@ -240,15 +389,13 @@ class E2EFromCSR(E2EBase):
         :arg tgt_rscale:
         :arg centers:
         """
-        knl = self.get_cached_optimized_kernel()
-
         centers = kwargs.pop("centers")
         # "1" may be passed for rscale, which won't have its type
         # meaningfully inferred. Make the type of rscale explicit.
         src_rscale = centers.dtype.type(kwargs.pop("src_rscale"))
         tgt_rscale = centers.dtype.type(kwargs.pop("tgt_rscale"))
 
-        return knl(queue,
+        return self.run_chunks(queue,
                 centers=centers,
                 src_rscale=src_rscale, tgt_rscale=tgt_rscale,
                 **kwargs)
@@ -289,7 +436,7 @@ class E2EFromChildren(E2EBase):
                     "{[isrc_box]: 0<=isrc_box<nchildren}",
                     "{[idim]: 0<=idim<dim}",
                     ],
-                ["""
+                self.get_expansion_row_rules() + ["""
                 for itgt_box
                     <> tgt_ibox = target_boxes[itgt_box]
 
@@ -307,16 +454,17 @@ class E2EFromChildren(E2EBase):
 
                             """] + ["""
                             <> src_coeff{i} = \
-                                src_expansions[src_ibox - src_base_ibox, {i}] \
+                                src_expansions[src_row(src_ibox), {i}] \
                                 {{id_prefix=read_coeff,dep=read_src_ibox}}
                             """.format(i=i) for i in range(ncoeffs)] + [
                             ] + loopy_insns + ["""
-                            tgt_expansions[tgt_ibox - tgt_base_ibox, {i}] = \
-                                tgt_expansions[tgt_ibox - tgt_base_ibox, {i}] \
+                            tgt_expansions[tgt_row(tgt_ibox), {i}] = \
+                                tgt_expansions[tgt_row(tgt_ibox), {i}] \
                                 + coeff{i} \
                                 {{id_prefix=write_expn,dep=compute_coeff*,
                                     nosync=read_coeff*}}
-                            """.format(i=i) for i in range(ncoeffs)] + ["""
+                            """.format(i=i)
+                            for i in self.get_tgt_coeff_indices()] + ["""
                         end
                     end
                 end
@@ -331,12 +479,15 @@ class E2EFromChildren(E2EBase):
                     lp.GlobalArg("tgt_expansions", None,
                         shape=("ntgt_level_boxes", ncoeffs), offset=lp.auto),
                     lp.GlobalArg("src_expansions", None,
-                        shape=("nsrc_level_boxes", ncoeffs), offset=lp.auto),
+                        shape=("nsrc_level_boxes",
+                            self.get_src_storage_ncoeffs()),
+                        offset=lp.auto),
                     lp.ValueArg("src_base_ibox,tgt_base_ibox", np.int32),
                     lp.ValueArg("ntgt_level_boxes,nsrc_level_boxes", np.int32),
                     lp.ValueArg("aligned_nboxes", np.int32),
                     "..."
-                ] + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
+                ] + self.get_expansion_slot_arguments()
+                + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
                 name=self.name,
                 assumptions="ntgt_boxes>=1",
                 silenced_warnings="write_race(write_expn*)",
@@ -348,7 +499,7 @@ class E2EFromChildren(E2EBase):
 
         loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
 
-        return loopy_knl
+        return self.apply_expansion_layout(loopy_knl)
 
     def __call__(self, queue, **kwargs):
         """
@@ -359,15 +510,13 @@ class E2EFromChildren(E2EBase):
         :arg tgt_rscale:
         :arg centers:
         """
-        knl = self.get_cached_optimized_kernel()
-
         centers = kwargs.pop("centers")
         # "1" may be passed for rscale, which won't have its type
         # meaningfully inferred. Make the type of rscale explicit.
         src_rscale = centers.dtype.type(kwargs.pop("src_rscale"))
         tgt_rscale = centers.dtype.type(kwargs.pop("tgt_rscale"))
 
-        return knl(queue,
+        return self.run_chunks(queue,
                 centers=centers,
                 src_rscale=src_rscale, tgt_rscale=tgt_rscale,
                 **kwargs)
@@ -401,7 +550,7 @@ class E2EFromParent(E2EBase):
                     "{[itgt_box]: 0<=itgt_box<ntgt_boxes}",
                     "{[idim]: 0<=idim<dim}",
                     ],
-                ["""
+                self.get_expansion_row_rules() + ["""
                 for itgt_box
                     <> tgt_ibox = target_boxes[itgt_box]
 
@@ -415,16 +564,16 @@ class E2EFromParent(E2EBase):
 
                     """] + ["""
                     <> src_coeff{i} = \
-                        src_expansions[src_ibox - src_base_ibox, {i}] \
+                        src_expansions[src_row(src_ibox), {i}] \
                         {{id_prefix=read_expn,dep=read_src_ibox}}
                     """.format(i=i) for i in range(ncoeffs)] + [
 
                     ] + self.get_translation_loopy_insns() + ["""
 
-                    tgt_expansions[tgt_ibox - tgt_base_ibox, {i}] = \
-                        tgt_expansions[tgt_ibox - tgt_base_ibox, {i}] + coeff{i} \
+                    tgt_expansions[tgt_row(tgt_ibox), {i}] = \
+                        tgt_expansions[tgt_row(tgt_ibox), {i}] + coeff{i} \
                         {{id_prefix=write_expn,nosync=read_expn*}}
-                    """.format(i=i) for i in range(ncoeffs)] + ["""
+                    """.format(i=i) for i in self.get_tgt_coeff_indices()] + ["""
                 end
                 """],
                 [
@@ -439,9 +588,12 @@ class E2EFromParent(E2EBase):
                     lp.GlobalArg("tgt_expansions", None,
                         shape=("ntgt_level_boxes", ncoeffs), offset=lp.auto),
                     lp.GlobalArg("src_expansions", None,
-                        shape=("nsrc_level_boxes", ncoeffs), offset=lp.auto),
+                        shape=("nsrc_level_boxes",
+                            self.get_src_storage_ncoeffs()),
+                        offset=lp.auto),
                     "..."
-                ] + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
+                ] + self.get_expansion_slot_arguments()
+                + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
                 name=self.name, assumptions="ntgt_boxes>=1",
                 silenced_warnings="write_race(write_expn*)",
                 fixed_parameters=dict(dim=self.dim, nchildren=2**self.dim),
@@ -452,7 +604,7 @@ class E2EFromParent(E2EBase):
 
         loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
 
-        return loopy_knl
+        return self.apply_expansion_layout(loopy_knl)
 
     def __call__(self, queue, **kwargs):
         """
@@ -463,6 +615,112 @@ class E2EFromParent(E2EBase):
         :arg tgt_rscale:
         :arg centers:
         """
+        centers = kwargs.pop("centers")
+        # "1" may be passed for rscale, which won't have its type
+        # meaningfully inferred. Make the type of rscale explicit.
+        src_rscale = centers.dtype.type(kwargs.pop("src_rscale"))
+        tgt_rscale = centers.dtype.type(kwargs.pop("tgt_rscale"))
+
+        return self.run_chunks(queue,
+                centers=centers,
+                src_rscale=src_rscale, tgt_rscale=tgt_rscale,
+                **kwargs)
+
+# }}}
+
+
+# {{{ looped translation base class
+
+class LoopedE2EBase(E2EBase):
+    """Common functionality for translations evaluated from a
+    :class:`sumpy.expansion.TranslationTermTable`.
+    """
+
+    @memoize_method
+    def get_translation_term_table(self):
+        return self.tgt_expansion.get_translation_term_table(self.src_expansion)
+
+    @memoize_method
+    def get_translation_term_table_arrays(self):
+        table = self.get_translation_term_table()
+
+        with cl.CommandQueue(self.ctx) as queue:
+            return dict(
+                    (name, cl.array.to_device(queue, ary).with_queue(None))
+                    for name, ary in [
+                        ("term_starts", table.term_starts),
+                        ("term_src_indices", table.src_indices),
+                        ("term_coeffs", table.coefficients),
+                        ("term_d_exponents", table.d_exponents),
+                        ])
+
+    @memoize_method
+    def get_coeff_scaling_arrays(self, context, dtype, src_rscale, tgt_rscale):
+        """Return device arrays of the factors by which the source and target
+        coefficients are scaled for *src_rscale* and *tgt_rscale*, kept
+        for reuse since each level has one pair of scales.
+        """
+        table = self.get_translation_term_table()
+
+        with cl.CommandQueue(context) as queue:
+            return tuple(
+                    cl.array.to_device(queue,
+                        rscale ** exponents.astype(dtype)).with_queue(None)
+                    for rscale, exponents in [
+                        (src_rscale, table.src_rscale_exponents),
+                        (tgt_rscale, table.tgt_rscale_exponents),
+                        ])
+
+    def get_translation_loopy_insns(self):
+        # The translation sums over all terms of a target coefficient. The
+        # monomials in d are looked up in a table of powers.
+        monomial = " * ".join(
+                "d_powers[%d, term_d_exponents[%d, iterm]]" % (i, i)
+                for i in range(self.dim))
+
+        return ["""
+            <> d_powers[idim, iexp] = d[idim] ** iexp {{id=d_powers,dup=idim}}
+
+            for icoeff_tgt
+                <> iterm_start = term_starts[icoeff_tgt]
+                <> iterm_end = term_starts[icoeff_tgt + 1]
+
+                <> coeff = tgt_coeff_scaling[icoeff_tgt] * sum(iterm,
+                    term_coeffs[iterm]
+                    * src_coeff_scaling[term_src_indices[iterm]]
+                    * src_expansions[src_row(src_ibox), \
+                        term_src_indices[iterm]]
+                    * {monomial}) \
+                    {{id=compute_coeff,dep=d_powers}}
+            """.format(monomial=monomial)]
+
+    def get_translation_term_table_loopy_args(self):
+        return [
+                lp.GlobalArg("term_starts", np.int32,
+                    shape="ncoeff_tgt + 1"),
+                lp.GlobalArg("term_src_indices", np.int32, shape="nterms"),
+                lp.GlobalArg("term_coeffs", np.float64, shape="nterms"),
+                lp.GlobalArg("term_d_exponents", np.int32,
+                    shape="dim, nterms"),
+                lp.ValueArg("nterms", np.int32),
+                lp.GlobalArg("src_coeff_scaling", None, shape="ncoeff_src"),
+                lp.GlobalArg("tgt_coeff_scaling", None, shape="ncoeff_tgt"),
+                ]
+
+    def get_looped_fixed_parameters(self):
+        return dict(
+                dim=self.dim,
+                ncoeff_src=len(self.src_expansion),
+                ncoeff_tgt=len(self.tgt_expansion),
+                max_d_exponent=self.get_translation_term_table().max_d_exponent)
+
+    def __call__(self, queue, **kwargs):
+        """
+        :arg src_expansions:
+        :arg src_rscale:
+        :arg tgt_rscale:
+        :arg centers:
+        """
         knl = self.get_cached_optimized_kernel()
 
         centers = kwargs.pop("centers")
@@ -471,11 +729,180 @@ class E2EFromParent(E2EBase):
         src_rscale = centers.dtype.type(kwargs.pop("src_rscale"))
         tgt_rscale = centers.dtype.type(kwargs.pop("tgt_rscale"))
 
+        src_coeff_scaling, tgt_coeff_scaling = self.get_coeff_scaling_arrays(
+                queue.context, centers.dtype, src_rscale, tgt_rscale)
+
+        kwargs.update(self.get_translation_term_table_arrays())
+        kwargs.update(self.get_expansion_layout_kwargs(knl, kwargs))
+
         return knl(queue,
                 centers=centers,
-                src_rscale=src_rscale, tgt_rscale=tgt_rscale,
+                src_coeff_scaling=src_coeff_scaling,
+                tgt_coeff_scaling=tgt_coeff_scaling,
                 **kwargs)
 
 # }}}
 
+
+# {{{ looped translation from a box's children
+
+class E2EFromChildrenLooped(LoopedE2EBase):
+    """Like :class:`E2EFromChildren`, but with the translation evaluated
+    in loops.
+    """
+
+    default_name = "e2e_from_children_looped"
+
+    def get_kernel(self):
+        if self.src_expansion is not self.tgt_expansion:
+            raise RuntimeError("%s requires that the source "
+                    "and target expansion are the same object"
+                    % type(self).__name__)
+
+        from sumpy.tools import gather_loopy_arguments
+        loopy_knl = lp.make_kernel(
+                [
+                    "{[itgt_box]: 0<=itgt_box<ntgt_boxes}",
+                    "{[isrc_box]: 0<=isrc_box<nchildren}",
+                    "{[idim]: 0<=idim<dim}",
+                    "{[iexp]: 0<=iexp<=max_d_exponent}",
+                    "{[icoeff_tgt]: 0<=icoeff_tgt<ncoeff_tgt}",
+                    "{[iterm]: iterm_start<=iterm<iterm_end}",
+                    ],
+                self.get_expansion_row_rules() + ["""
+                for itgt_box
+                    <> tgt_ibox = target_boxes[itgt_box]
+
+                    <> tgt_center[idim] = centers[idim, tgt_ibox]
+
+                    for isrc_box
+                        <> src_ibox = box_child_ids[isrc_box,tgt_ibox] \
+                                {id=read_src_ibox}
+                        <> is_src_box_valid = src_ibox != 0
+
+                        if is_src_box_valid
+                            <> src_center[idim] = centers[idim, src_ibox] {dup=idim}
+                            <> d[idim] = tgt_center[idim] - src_center[idim] \
+                                    {dup=idim}
+
+                            """] + self.get_translation_loopy_insns() + ["""
+                                tgt_expansions[tgt_row(tgt_ibox), \
+                                        icoeff_tgt] = \
+                                    tgt_expansions[tgt_row(tgt_ibox), \
+                                        icoeff_tgt] + coeff \
+                                    {id_prefix=write_expn,dep=compute_coeff}
+                            end
+                        end
+                    end
+                end
+                """],
+                [
+                    lp.GlobalArg("target_boxes", None, shape=lp.auto,
+                        offset=lp.auto),
+                    lp.GlobalArg("centers", None, shape="dim, aligned_nboxes"),
+                    lp.GlobalArg("box_child_ids", None,
+                        shape="nchildren, aligned_nboxes"),
+                    lp.GlobalArg("tgt_expansions", None,
+                        shape=("ntgt_level_boxes", "ncoeff_tgt"), offset=lp.auto),
+                    lp.GlobalArg("src_expansions", None,
+                        shape=("nsrc_level_boxes", "ncoeff_src"), offset=lp.auto),
+                    lp.ValueArg("src_base_ibox,tgt_base_ibox", np.int32),
+                    lp.ValueArg("ntgt_level_boxes,nsrc_level_boxes", np.int32),
+                    lp.ValueArg("aligned_nboxes", np.int32),
+                    "..."
+                ] + self.get_expansion_slot_arguments()
+                + self.get_translation_term_table_loopy_args()
+                + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
+                name=self.name,
+                assumptions="ntgt_boxes>=1",
+                silenced_warnings="write_race(write_expn*)",
+                fixed_parameters=dict(
+                    nchildren=2**self.dim,
+                    **self.get_looped_fixed_parameters()),
+                lang_version=MOST_RECENT_LANGUAGE_VERSION)
+
+        for expn in [self.src_expansion, self.tgt_expansion]:
+            loopy_knl = expn.prepare_loopy_kernel(loopy_knl)
+
+        loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
+
+        return self.apply_expansion_layout(loopy_knl)
+
+# }}}
+
+
+# {{{ looped translation from a box's parent
+
+class E2EFromParentLooped(LoopedE2EBase):
+    """Like :class:`E2EFromParent`, but with the translation evaluated
+    in loops.
+    """
+
+    default_name = "e2e_from_parent_looped"
+
+    def get_kernel(self):
+        if self.src_expansion is not self.tgt_expansion:
+            raise RuntimeError("%s requires that the source "
+                    "and target expansion are the same object"
+                    % self.default_name)
+
+        from sumpy.tools import gather_loopy_arguments
+        loopy_knl = lp.make_kernel(
+                [
+                    "{[itgt_box]: 0<=itgt_box<ntgt_boxes}",
+                    "{[idim]: 0<=idim<dim}",
+                    "{[iexp]: 0<=iexp<=max_d_exponent}",
+                    "{[icoeff_tgt]: 0<=icoeff_tgt<ncoeff_tgt}",
+                    "{[iterm]: iterm_start<=iterm<iterm_end}",
+                    ],
+                self.get_expansion_row_rules() + ["""
+                for itgt_box
+                    <> tgt_ibox = target_boxes[itgt_box]
+
+                    <> tgt_center[idim] = centers[idim, tgt_ibox]
+
+                    <> src_ibox = box_parent_ids[tgt_ibox] \
+                        {id=read_src_ibox}
+
+                    <> src_center[idim] = centers[idim, src_ibox] {dup=idim}
+                    <> d[idim] = tgt_center[idim] - src_center[idim] {dup=idim}
+
+                    """] + self.get_translation_loopy_insns() + ["""
+                        tgt_expansions[tgt_row(tgt_ibox), icoeff_tgt] = \
+                            tgt_expansions[tgt_row(tgt_ibox), icoeff_tgt] \
+                            + coeff \
+                            {id_prefix=write_expn,dep=compute_coeff}
+                    end
+                end
+                """],
+                [
+                    lp.GlobalArg("target_boxes", None, shape=lp.auto,
+                        offset=lp.auto),
+                    lp.GlobalArg("centers", None, shape="dim, naligned_boxes"),
+                    lp.ValueArg("naligned_boxes,nboxes", np.int32),
+                    lp.ValueArg("tgt_base_ibox,src_base_ibox", np.int32),
+                    lp.ValueArg("ntgt_level_boxes,nsrc_level_boxes", np.int32),
+                    lp.GlobalArg("box_parent_ids", None, shape="nboxes"),
+                    lp.GlobalArg("tgt_expansions", None,
+                        shape=("ntgt_level_boxes", "ncoeff_tgt"), offset=lp.auto),
+                    lp.GlobalArg("src_expansions", None,
+                        shape=("nsrc_level_boxes", "ncoeff_src"), offset=lp.auto),
+                    "..."
+                ] + self.get_expansion_slot_arguments()
+                + self.get_translation_term_table_loopy_args()
+                + gather_loopy_arguments([self.src_expansion, self.tgt_expansion]),
+                name=self.name, assumptions="ntgt_boxes>=1",
+                silenced_warnings="write_race(write_expn*)",
+                fixed_parameters=self.get_looped_fixed_parameters(),
+                lang_version=MOST_RECENT_LANGUAGE_VERSION)
+
+        for expn in [self.src_expansion, self.tgt_expansion]:
+            loopy_knl = expn.prepare_loopy_kernel(loopy_knl)
+
+        loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
+
+        return self.apply_expansion_layout(loopy_knl)
+
+# }}}
+
 # vim: foldmethod=marker
@@ -22,14 +22,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import six
 from six.moves import range
 
 import numpy as np
 import loopy as lp
 import sumpy.symbolic as sym
 
-from sumpy.tools import KernelCacheWrapper
+from pytools import memoize_method
+from sumpy.tools import KernelCacheWrapper, get_accumulation_term
 from loopy.version import MOST_RECENT_LANGUAGE_VERSION
 
 
@@ -41,6 +41,8 @@ Expansion-to-particle
 .. autoclass:: E2PBase
 .. autoclass:: E2PFromCSR
 .. autoclass:: E2PFromSingleBox
+.. autoclass:: E2PMatrixFromSingleBox
+.. autoclass:: E2PFromSingleBoxAndP2PFromCSR
 
 """
 
@@ -48,14 +50,46 @@ Expansion-to-particle
 # {{{ E2P base class
 
 class E2PBase(KernelCacheWrapper):
+    expansion_prefixes = ("src",)
+
     def __init__(self, ctx, expansion, kernels,
-            options=[], name=None, device=None):
+            options=[], name=None, device=None, result_in_user_order=False,
+            compact_expansions=False, expansion_layout="box_major",
+            src_storage_ncoeffs=None, accumulate_output=False,
+            coeff_indices=None):
         """
         :arg expansion: a subclass of :class:`sympy.expansion.ExpansionBase`
         :arg strength_usage: A list of integers indicating which expression
           uses which source strength indicator. This implicitly specifies the
           number of strength arrays that need to be passed.
           Default: all kernels use the same strength.
+        :arg result_in_user_order: if *True*, the potentials are written to
+          *result* in user target order, through the array *user_target_ids*
+          that the generated kernel takes as an additional argument and that
+          gives the user index of each target in tree order.
+        :arg compact_expansions: if *True*, the expansion of box *ibox* is
+          read from row ``src_box_slots[ibox]`` of *src_expansions* instead of
+          from row ``ibox - src_base_ibox``, with *src_box_slots* an
+          additional argument of the generated kernel. See
+          :func:`sumpy.tools.get_expansion_row_rules`.
+        :arg expansion_layout: the memory layout of *src_expansions*, see
+          :func:`sumpy.tools.parse_expansion_layout`.
+        :arg src_storage_ncoeffs: the number of coefficients stored per box in
+          *src_expansions*, by default ``len(expansion)``. If larger, the
+          expansions are stored with a higher order than that of *expansion*,
+          and only their leading coefficients are evaluated. This truncates
+          them to the order of *expansion* if
+          :attr:`sumpy.expansion.ExpansionBase.is_prefix_truncatable` holds.
+        :arg accumulate_output: if *True*, kernels evaluating the expansion of
+          each target's own box add into *result* instead of overwriting it.
+          Kernels evaluating expansions of several boxes at each target
+          (such as :class:`E2PFromCSR`) always add into *result*.
+        :arg coeff_indices: if not *None*, a tuple of indices of the
+          coefficients to which the evaluation is restricted, so that the
+          generated kernel computes the part of the potential due to them.
+          By default, all coefficients are evaluated, and the work is split
+          among several kernels if the generated code is too large (see
+          :func:`sumpy.set_max_kernel_insns`).
         """
 
         if device is None:
@@ -76,10 +110,59 @@ class E2PBase(KernelCacheWrapper):
         self.options = options
         self.name = name or self.default_name
         self.device = device
+        self.result_in_user_order = result_in_user_order
+        self.compact_expansions = compact_expansions
+        self.expansion_layout = expansion_layout
+        self.src_storage_ncoeffs = src_storage_ncoeffs
+        self.accumulate_output = accumulate_output
+        self.coeff_indices = coeff_indices
 
         self.dim = expansion.dim
 
-    def get_loopy_insns_and_result_names(self):
+    def get_src_storage_ncoeffs(self):
+        if self.src_storage_ncoeffs is None:
+            return len(self.expansion)
+        return self.src_storage_ncoeffs
+
+    def get_coeff_indices(self):
+        if self.coeff_indices is None:
+            return tuple(range(len(self.expansion)))
+        return self.coeff_indices
+
+    def get_result_index(self, itgt):
+        """Return the (textual) index into *result* of the target with tree
+        index *itgt*.
+        """
+        if self.result_in_user_order:
+            return "user_target_ids[%s]" % itgt
+        return itgt
+
+    def get_reordering_arguments(self):
+        if self.result_in_user_order:
+            return [lp.GlobalArg("user_target_ids", None, shape=None)]
+        return []
+
+    def get_expansion_row_rules(self):
+        from sumpy.tools import get_expansion_row_rules
+        return get_expansion_row_rules(
+                self.expansion_prefixes, self.compact_expansions)
+
+    def get_expansion_slot_arguments(self):
+        from sumpy.tools import get_expansion_slot_arguments
+        return get_expansion_slot_arguments(
+                self.expansion_prefixes, self.compact_expansions)
+
+    def apply_expansion_layout(self, knl):
+        from sumpy.tools import apply_expansion_layout
+        return apply_expansion_layout(
+                knl, self.expansion_prefixes, self.expansion_layout)
+
+    def get_expansion_layout_kwargs(self, knl, kwargs):
+        from sumpy.tools import get_expansion_layout_kwargs
+        return get_expansion_layout_kwargs(
+                knl, self.expansion_prefixes, self.expansion_layout, kwargs)
+
+    def get_assignments(self):
         from sumpy.symbolic import make_sym_vector
         bvec = make_sym_vector("b", self.dim)
 
@@ -91,7 +174,14 @@ class E2PBase(KernelCacheWrapper):
 
         coeff_exprs = [sym.Symbol("coeff%d" % i)
                 for i in range(len(self.expansion.get_coefficient_identifiers()))]
-        value = self.expansion.evaluate(coeff_exprs, bvec, rscale)
+
+        # Intermediate values assigned in sac are opaque to differentiation,
+        # so only allow them if no target derivatives need to be taken.
+        from sumpy.kernel import TargetDerivativeRemover
+        tdr = TargetDerivativeRemover()
+        value = self.expansion.evaluate(coeff_exprs, bvec, rscale,
+                sac=sac if all(tdr(knl) == knl for knl in self.kernels)
+                else None)
 
         result_names = [
             sac.assign_unique("result_%d_p" % i,
@@ -99,11 +189,28 @@ class E2PBase(KernelCacheWrapper):
             for i, knl in enumerate(self.kernels)
             ]
 
-        sac.run_global_cse()
+        return sac, result_names
+
+    def get_loopy_insns_and_result_names(self):
+        # The symbolic work is done (and cached) once for all coefficients,
+        # and shared by all restrictions to a subset of them.
+        from sumpy.tools import get_cached_post_cse_assignments
+        assignments, result_names = get_cached_post_cse_assignments(
+                ("e2p", self.expansion, tuple(self.kernels)),
+                self.get_assignments)
+
+        if self.coeff_indices is not None:
+            coeff_indices = set(self.coeff_indices)
+
+            from sumpy.tools import restrict_assignments
+            assignments = restrict_assignments(assignments, result_names,
+                    zero_names=[
+                        "coeff%d" % i for i in range(len(self.expansion))
+                        if i not in coeff_indices])
 
         from sumpy.codegen import to_loopy_insns
         loopy_insns = to_loopy_insns(
-                six.iteritems(sac.assignments),
+                assignments,
                 vector_names=set(["b"]),
                 pymbolic_expr_maps=[self.expansion.get_code_transformer()],
                 retain_names=result_names,
@@ -122,7 +229,85 @@ class E2PBase(KernelCacheWrapper):
                     temp_var_type=lp.Optional(None))]
 
     def get_cache_key(self):
-        return (type(self).__name__, self.expansion, tuple(self.kernels))
+        return (type(self).__name__, self.expansion, tuple(self.kernels),
+                self.result_in_user_order, self.compact_expansions,
+                self.expansion_layout, self.src_storage_ncoeffs,
+                self.accumulate_output, self.coeff_indices)
+
+    def get_chunks(self):
+        """Return a list of tuples *(kernel_indices, e2p)* such that running
+        the *e2p* objects one after the other computes the same result as
+        *self*. Each *e2p* computes the outputs for the subset *kernel_indices*
+        of :attr:`kernels` in a separate kernel, so that none has more than
+        about :data:`sumpy.MAX_KERNEL_INSNS` instructions. If needed, the
+        coefficients are split, too, and the *e2p* objects evaluating the
+        later parts of the coefficients of a subset add into *result*.
+        """
+        from sumpy import MAX_KERNEL_INSNS
+        return self._get_chunks(MAX_KERNEL_INSNS)
+
+    @memoize_method
+    def _get_chunks(self, max_insns):
+        coeff_indices = self.get_coeff_indices()
+
+        from sumpy.tools import get_kernel_output_chunks
+        chunks = get_kernel_output_chunks(
+                self, max_insns, len(self.kernels), len(coeff_indices))
+        if len(chunks) == 1:
+            return [(chunks[0][0], self)]
+
+        return [
+                (kernel_indices,
+                    type(self)(self.ctx, self.expansion,
+                        [self.kernels[i] for i in kernel_indices],
+                        options=self.options,
+                        name="%s_chunk%d" % (self.name, ichunk),
+                        device=self.device,
+                        result_in_user_order=self.result_in_user_order,
+                        compact_expansions=self.compact_expansions,
+                        expansion_layout=self.expansion_layout,
+                        src_storage_ncoeffs=self.src_storage_ncoeffs,
+                        accumulate_output=(self.accumulate_output
+                            or term_indices[0] != 0),
+                        coeff_indices=tuple(
+                            coeff_indices[i] for i in term_indices)))
+                for ichunk, (kernel_indices, term_indices)
+                in enumerate(chunks)]
+
+    def run_chunks(self, queue, **kwargs):
+        """Run the kernels of :meth:`get_chunks` with the keyword arguments
+        *kwargs*, passing each the part of *result* (if given, or computed
+        by an earlier kernel) that belongs to it.
+        """
+        chunks = self.get_chunks()
+        if len(chunks) == 1:
+            knl = self.get_cached_optimized_kernel()
+            kwargs.update(self.get_expansion_layout_kwargs(knl, kwargs))
+            return knl(queue, **kwargs)
+
+        from pytools.obj_array import make_obj_array
+        result = kwargs.pop("result", None)
+
+        if result is None:
+            results = [None] * len(self.kernels)
+        else:
+            results = list(result)
+
+        for kernel_indices, chunk in chunks:
+            chunk_result = [results[i] for i in kernel_indices]
+            if all(res is not None for res in chunk_result):
+                kwargs["result"] = make_obj_array(chunk_result)
+            else:
+                kwargs.pop("result", None)
+
+            knl = chunk.get_cached_optimized_kernel()
+            kwargs.update(chunk.get_expansion_layout_kwargs(knl, kwargs))
+            evt, chunk_results = knl(queue, **kwargs)
+
+            for i, chunk_result in zip(kernel_indices, chunk_results):
+                results[i] = chunk_result
+
+        return evt, tuple(results)
 
 # }}}
 
@@ -133,8 +318,6 @@ class E2PFromSingleBox(E2PBase):
     default_name = "e2p_from_single_box"
 
     def get_kernel(self):
-        ncoeffs = len(self.expansion)
-
         loopy_insns, result_names = self.get_loopy_insns_and_result_names()
 
         loopy_knl = lp.make_kernel(
@@ -142,7 +325,8 @@ class E2PFromSingleBox(E2PBase):
                     "{[itgt_box]: 0<=itgt_box<ntgt_boxes}",
                     "{[itgt,idim]: itgt_start<=itgt<itgt_end and 0<=idim<dim}",
                     ],
-                self.get_kernel_scaling_assignment()
+                self.get_expansion_row_rules()
+                + self.get_kernel_scaling_assignment()
                 + ["""
                 for itgt_box
                     <> tgt_ibox = target_boxes[itgt_box]
@@ -153,18 +337,24 @@ class E2PFromSingleBox(E2PBase):
 
                     """] + ["""
                     <> coeff{coeffidx} = \
-                            src_expansions[tgt_ibox - src_base_ibox, {coeffidx}]
-                    """.format(coeffidx=i) for i in range(ncoeffs)] + ["""
+                            src_expansions[src_row(tgt_ibox), {coeffidx}]
+                    """.format(coeffidx=i) for i in self.get_coeff_indices()]
+                + ["""
 
                     for itgt
                         <> b[idim] = targets[idim, itgt] - center[idim] {dup=idim}
 
                         """] + loopy_insns + ["""
 
-                        result[{resultidx},itgt] = \
-                                kernel_scaling * result_{resultidx}_p \
+                        result[{resultidx}, {itgt}] = \
+                                {prev}kernel_scaling * result_{resultidx}_p \
                                 {{id_prefix=write_result}}
-                        """.format(resultidx=i) for i in range(len(result_names))
+                        """.format(resultidx=i, itgt=self.get_result_index("itgt"),
+                            prev=get_accumulation_term(
+                                "result[%d, %s]"
+                                % (i, self.get_result_index("itgt")),
+                                self.accumulate_output))
+                        for i in range(len(result_names))
                         ] + ["""
                     end
                 end
@@ -179,12 +369,16 @@ class E2PFromSingleBox(E2PBase):
                     lp.GlobalArg("result", None, shape="nresults, ntargets",
                         dim_tags="sep,C"),
                     lp.GlobalArg("src_expansions", None,
-                        shape=("nsrc_level_boxes", ncoeffs), offset=lp.auto),
+                        shape=("nsrc_level_boxes",
+                            self.get_src_storage_ncoeffs()),
+                        offset=lp.auto),
                     lp.ValueArg("nsrc_level_boxes,naligned_boxes", np.int32),
                     lp.ValueArg("src_base_ibox", np.int32),
                     lp.ValueArg("ntargets", np.int32),
                     "..."
-                ] + [arg.loopy_arg for arg in self.expansion.get_args()],
+                ] + self.get_reordering_arguments()
+                + self.get_expansion_slot_arguments()
+                + [arg.loopy_arg for arg in self.expansion.get_args()],
                 name=self.name,
                 assumptions="ntgt_boxes>=1",
                 silenced_warnings="write_race(write_result*)",
@@ -195,7 +389,7 @@ class E2PFromSingleBox(E2PBase):
         loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
         loopy_knl = self.expansion.prepare_loopy_kernel(loopy_knl)
 
-        return loopy_knl
+        return self.apply_expansion_layout(loopy_knl)
 
     def get_optimized_kernel(self):
         # FIXME
@@ -212,14 +406,12 @@ class E2PFromSingleBox(E2PBase):
         :arg centers:
         :arg targets:
         """
-        knl = self.get_cached_optimized_kernel()
-
         centers = kwargs.pop("centers")
         # "1" may be passed for rscale, which won't have its type
         # meaningfully inferred. Make the type of rscale explicit.
         rscale = centers.dtype.type(kwargs.pop("rscale"))
 
-        return knl(queue, centers=centers, rscale=rscale, **kwargs)
+        return self.run_chunks(queue, centers=centers, rscale=rscale, **kwargs)
 
 # }}}
 
@@ -227,50 +419,60 @@ class E2PFromSingleBox(E2PBase):
 # {{{ E2P from CSR-like interaction list
 
 class E2PFromCSR(E2PBase):
+    """Evaluates the expansions in the boxes *source_box_lists* at the
+    targets of each box in *target_boxes* (M2P, likely).
+
+    Source boxes are iterated outside the targets of each target box, so
+    that each source box's coefficients and center are loaded once per
+    target box and reused for all of its targets.
+    """
+
     default_name = "e2p_from_csr"
 
     def get_kernel(self):
-        ncoeffs = len(self.expansion)
-
         loopy_insns, result_names = self.get_loopy_insns_and_result_names()
 
         loopy_knl = lp.make_kernel(
                 [
                     "{[itgt_box]: 0<=itgt_box<ntgt_boxes}",
-                    "{[itgt]: itgt_start<=itgt<itgt_end}",
-                    "{[isrc_box]: isrc_box_start<=isrc_box<isrc_box_end }",
+                    "{[isrc_box, itgt]: isrc_box_start<=isrc_box<isrc_box_end "
+                    "and itgt_start<=itgt<itgt_end}",
                     "{[idim]: 0<=idim<dim}",
                     ],
-                self.get_kernel_scaling_assignment()
+                self.get_expansion_row_rules()
+                + self.get_kernel_scaling_assignment()
                 + ["""
                 for itgt_box
                     <> tgt_ibox = target_boxes[itgt_box]
                     <> itgt_start = box_target_starts[tgt_ibox]
                     <> itgt_end = itgt_start+box_target_counts_nonchild[tgt_ibox]
 
-                    for itgt
-                        <> tgt[idim] = targets[idim,itgt]
+                    <> isrc_box_start = source_box_starts[itgt_box]
+                    <> isrc_box_end = source_box_starts[itgt_box+1]
 
-                        <> isrc_box_start = source_box_starts[itgt_box]
-                        <> isrc_box_end = source_box_starts[itgt_box+1]
+                    for isrc_box
+                        <> src_ibox = source_box_lists[isrc_box]
+                        """] + ["""
+                        <> coeff{coeffidx} = \
+                            src_expansions[src_row(src_ibox), {coeffidx}]
+                        """.format(coeffidx=i) for i in self.get_coeff_indices()]
+                + ["""
 
-                        for isrc_box
-                            <> src_ibox = source_box_lists[isrc_box]
-                            """] + ["""
-                            <> coeff{coeffidx} = \
-                                src_expansions[src_ibox - src_base_ibox, {coeffidx}]
-                            """.format(coeffidx=i) for i in range(ncoeffs)] + ["""
+                        <> center[idim] = centers[idim, src_ibox] {dup=idim}
 
-                            <> center[idim] = centers[idim, src_ibox] {dup=idim}
-                            <> b[idim] = tgt[idim] - center[idim] {dup=idim}
+                        for itgt
+                            <> b[idim] = targets[idim, itgt] - center[idim] \
+                                    {dup=idim}
 
                             """] + loopy_insns + ["""
+                            result[{resultidx}, {itgt}] = \
+                                    result[{resultidx}, {itgt}] \
+                                    + kernel_scaling * result_{resultidx}_p \
+                                    {{id_prefix=write_result}}
+                            """.format(resultidx=i,
+                                itgt=self.get_result_index("itgt"))
+                            for i in range(len(result_names))] + ["""
                         end
-                        """] + ["""
-                        result[{resultidx}, itgt] = result[{resultidx}, itgt] + \
-                                kernel_scaling * simul_reduce(sum, isrc_box,
-                                result_{resultidx}_p) {{id_prefix=write_result}}
-                        """.format(resultidx=i) for i in range(len(result_names))] + ["""
                     end
                 end
                 """],
@@ -281,7 +483,9 @@ class E2PFromCSR(E2PBase):
                         None, shape=None),
                     lp.GlobalArg("centers", None, shape="dim, aligned_nboxes"),
                     lp.GlobalArg("src_expansions", None,
-                        shape=("nsrc_level_boxes", ncoeffs), offset=lp.auto),
+                        shape=("nsrc_level_boxes",
+                            self.get_src_storage_ncoeffs()),
+                        offset=lp.auto),
                     lp.ValueArg("src_base_ibox", np.int32),
                     lp.ValueArg("nsrc_level_boxes,aligned_nboxes", np.int32),
                     lp.ValueArg("ntargets", np.int32),
@@ -290,7 +494,9 @@ class E2PFromCSR(E2PBase):
                     lp.GlobalArg("source_box_starts, source_box_lists,",
                         None, shape=None, offset=lp.auto),
                     "..."
-                ] + [arg.loopy_arg for arg in self.expansion.get_args()],
+                ] + self.get_reordering_arguments()
+                + self.get_expansion_slot_arguments()
+                + [arg.loopy_arg for arg in self.expansion.get_args()],
                 name=self.name,
                 assumptions="ntgt_boxes>=1",
                 silenced_warnings="write_race(write_result*)",
@@ -301,10 +507,10 @@ class E2PFromCSR(E2PBase):
                 lang_version=MOST_RECENT_LANGUAGE_VERSION)
 
         loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
-        loopy_knl = lp.prioritize_loops(loopy_knl, "itgt_box,itgt,isrc_box")
+        loopy_knl = lp.prioritize_loops(loopy_knl, "itgt_box,isrc_box,itgt")
         loopy_knl = self.expansion.prepare_loopy_kernel(loopy_knl)
 
-        return loopy_knl
+        return self.apply_expansion_layout(loopy_knl)
 
     def get_optimized_kernel(self):
         # FIXME
@@ -313,14 +519,398 @@ class E2PFromCSR(E2PBase):
         return knl
 
     def __call__(self, queue, **kwargs):
-        knl = self.get_cached_optimized_kernel()
+        centers = kwargs.pop("centers")
+        # "1" may be passed for rscale, which won't have its type
+        # meaningfully inferred. Make the type of rscale explicit.
+        rscale = centers.dtype.type(kwargs.pop("rscale"))
+
+        return self.run_chunks(queue, centers=centers, rscale=rscale, **kwargs)
+
+# }}}
+
+
+# {{{ E2P matrix of single box
+
+class E2PMatrixFromSingleBox(E2PBase):
+    """Computes, for each target in the boxes *target_boxes* and each kernel,
+    the contribution of each expansion coefficient of its box to the
+    potential, i.e. the matrix of the linear map from a box's expansion
+    coefficients to the potentials :class:`E2PFromSingleBox` computes at its
+    targets.
+
+    The result for each kernel is written to the first ``len(expansion)``
+    rows of the corresponding entry of *result*, an array of shape
+    ``(e2p_matrix_ncoeffs, ntargets)``, so that expansions of different
+    orders can share one matrix. If *coeff_indices* is given, only the rows
+    of these coefficients are written.
+    """
+
+    default_name = "e2p_matrix_from_single_box"
+
+    def get_assignments(self):
+        from sumpy.symbolic import make_sym_vector
+        bvec = make_sym_vector("b", self.dim)
+
+        import sumpy.symbolic as sp
+        rscale = sp.Symbol("rscale")
+
+        from sumpy.assignment_collection import SymbolicAssignmentCollection
+        sac = SymbolicAssignmentCollection()
+
+        from sumpy.kernel import TargetDerivativeRemover
+        tdr = TargetDerivativeRemover()
+        eval_sac = (sac if all(tdr(knl) == knl for knl in self.kernels)
+                else None)
+
+        ncoeffs = len(self.expansion)
+        values = [
+                self.expansion.evaluate(
+                    [1 if i == icoeff else 0 for i in range(ncoeffs)],
+                    bvec, rscale, sac=eval_sac)
+                for icoeff in range(ncoeffs)]
+
+        result_names = [
+                sac.assign_unique("basis_%d_p" % iknl,
+                    knl.postprocess_at_target(value, bvec))
+                for iknl, knl in enumerate(self.kernels)
+                for value in values]
+
+        return sac, result_names
+
+    def get_loopy_insns_and_result_names(self):
+        from sumpy.tools import get_cached_post_cse_assignments
+        assignments, result_names = get_cached_post_cse_assignments(
+                ("e2p_matrix", self.expansion, tuple(self.kernels)),
+                self.get_assignments)
+
+        ncoeffs = len(self.expansion)
+        written_names = [
+                result_names[iknl*ncoeffs + icoeff]
+                for iknl in range(len(self.kernels))
+                for icoeff in self.get_coeff_indices()]
+
+        if self.coeff_indices is not None:
+            from sumpy.tools import restrict_assignments
+            assignments = restrict_assignments(assignments, written_names)
+
+        from sumpy.codegen import to_loopy_insns
+        loopy_insns = to_loopy_insns(
+                assignments,
+                vector_names=set(["b"]),
+                pymbolic_expr_maps=[self.expansion.get_code_transformer()],
+                retain_names=written_names,
+                complex_dtype=np.complex128  # FIXME
+                )
+
+        return loopy_insns, result_names
+
+    def get_kernel(self):
+        ncoeffs = len(self.expansion)
+
+        loopy_insns, result_names = self.get_loopy_insns_and_result_names()
+
+        loopy_knl = lp.make_kernel(
+                [
+                    "{[itgt_box]: 0<=itgt_box<ntgt_boxes}",
+                    "{[itgt,idim]: itgt_start<=itgt<itgt_end and 0<=idim<dim}",
+                    ],
+                self.get_kernel_scaling_assignment()
+                + ["""
+                for itgt_box
+                    <> tgt_ibox = target_boxes[itgt_box]
+                    <> itgt_start = box_target_starts[tgt_ibox]
+                    <> itgt_end = itgt_start+box_target_counts_nonchild[tgt_ibox]
+
+                    <> center[idim] = centers[idim, tgt_ibox] {id=fetch_center}
+
+                    for itgt
+                        <> b[idim] = targets[idim, itgt] - center[idim] {dup=idim}
+
+                        """] + loopy_insns + ["""
+
+                        result[{iknl}, {icoeff}, itgt] = \
+                                kernel_scaling * {name} \
+                                {{id_prefix=write_matrix}}
+                        """.format(
+                            iknl=iknl, icoeff=icoeff,
+                            name=result_names[iknl*ncoeffs + icoeff])
+                        for iknl in range(len(self.kernels))
+                        for icoeff in self.get_coeff_indices()] + ["""
+                    end
+                end
+                """],
+                [
+                    lp.GlobalArg("targets", None, shape=(self.dim, "ntargets"),
+                        dim_tags="sep,C"),
+                    lp.GlobalArg("box_target_starts,box_target_counts_nonchild",
+                        None, shape=None),
+                    lp.GlobalArg("centers", None, shape="dim, naligned_boxes"),
+                    lp.ValueArg("rscale", None),
+                    lp.GlobalArg("result", None,
+                        shape="nresults, e2p_matrix_ncoeffs, ntargets",
+                        dim_tags="sep,C,C"),
+                    lp.ValueArg("naligned_boxes,e2p_matrix_ncoeffs", np.int32),
+                    lp.ValueArg("ntargets", np.int32),
+                    "..."
+                ] + [arg.loopy_arg for arg in self.expansion.get_args()],
+                name=self.name,
+                assumptions="ntgt_boxes>=1",
+                default_offset=lp.auto,
+                fixed_parameters=dict(
+                    dim=self.dim, nresults=len(self.kernels)),
+                lang_version=MOST_RECENT_LANGUAGE_VERSION)
+
+        loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
+        loopy_knl = self.expansion.prepare_loopy_kernel(loopy_knl)
+
+        return loopy_knl
+
+    def get_optimized_kernel(self):
+        knl = self.get_kernel()
+        knl = lp.tag_inames(knl, dict(itgt_box="g.0"))
+        knl = lp.split_iname(knl, "itgt", 32, inner_tag="l.0")
+        return knl
+
+    def __call__(self, queue, **kwargs):
+        """
+        :arg result:
+        :arg target_boxes:
+        :arg box_target_starts:
+        :arg box_target_counts_nonchild:
+        :arg centers:
+        :arg targets:
+        :arg rscale:
+        """
+        centers = kwargs.pop("centers")
+        # "1" may be passed for rscale, which won't have its type
+        # meaningfully inferred. Make the type of rscale explicit.
+        rscale = centers.dtype.type(kwargs.pop("rscale"))
+
+        return self.run_chunks(queue, centers=centers, rscale=rscale, **kwargs)
+
+# }}}
+
+
+# {{{ E2P to single box fused with P2P from CSR-like interaction list
+
+class E2PFromSingleBoxAndP2PFromCSR(E2PBase):
+    """Computes, in a single pass over the targets of each box in
+    *target_boxes*, the sum of what :class:`E2PFromSingleBox` computes from
+    the box's own expansion and what :class:`sumpy.p2p.P2PFromCSR` computes
+    from the sources in the boxes *source_box_lists* (L2P and the list 1
+    interactions, likely). Each target's result is updated once.
+    """
+
+    default_name = "e2p_from_single_box_and_p2p_from_csr"
+
+    def __init__(self, ctx, expansion, kernels, exclude_self=False,
+            strength_usage=None, value_dtypes=None,
+            options=[], name=None, device=None,
+            strengths_in_user_order=False, result_in_user_order=False,
+            compact_expansions=False, expansion_layout="box_major",
+            src_storage_ncoeffs=None, accumulate_output=False):
+        super(E2PFromSingleBoxAndP2PFromCSR, self).__init__(
+                ctx, expansion, kernels,
+                options=options, name=name, device=device,
+                result_in_user_order=result_in_user_order,
+                compact_expansions=compact_expansions,
+                expansion_layout=expansion_layout,
+                src_storage_ncoeffs=src_storage_ncoeffs,
+                accumulate_output=accumulate_output)
+
+        from sumpy.p2p import P2PFromCSR
+        self.p2p = P2PFromCSR(ctx, kernels, exclude_self,
+                strength_usage=strength_usage, value_dtypes=value_dtypes,
+                device=self.device,
+                strengths_in_user_order=strengths_in_user_order)
+
+    def get_cache_key(self):
+        return (type(self).__name__, self.expansion, tuple(self.kernels),
+                self.p2p.exclude_self, tuple(self.p2p.strength_usage),
+                tuple(self.p2p.value_dtypes),
+                self.p2p.strengths_in_user_order, self.result_in_user_order,
+                self.compact_expansions, self.expansion_layout,
+                self.src_storage_ncoeffs,
+                self.accumulate_output)
+
+    def get_reordering_arguments(self):
+        return (
+                super(E2PFromSingleBoxAndP2PFromCSR, self)
+                .get_reordering_arguments()
+                + [arg for arg in self.p2p.get_reordering_arguments()
+                    if arg.name == "user_source_ids"])
+
+    def get_p2p_loopy_insns_and_result_names(self):
+        """Return the instructions of :attr:`p2p` with all assigned names
+        prefixed by ``p2p_``, so that they do not clash with those of the
+        expansion evaluation.
+        """
+        loopy_insns, result_names = self.p2p.get_loopy_insns_and_result_names()
+
+        from pymbolic import var
+        from pymbolic.mapper.substitutor import make_subst_func
+        from loopy.symbolic import SubstitutionMapper
+        subst_map = SubstitutionMapper(make_subst_func(dict(
+                (insn.assignee.name, var("p2p_" + insn.assignee.name))
+                for insn in loopy_insns)))
+
+        loopy_insns = [
+                insn.copy(
+                    assignee=subst_map(insn.assignee),
+                    expression=subst_map(insn.expression))
+                for insn in loopy_insns]
+
+        return loopy_insns, ["p2p_" + name for name in result_names]
+
+    def get_kernel(self):
+        loopy_insns, result_names = self.get_loopy_insns_and_result_names()
+        p2p_loopy_insns, p2p_result_names = \
+                self.get_p2p_loopy_insns_and_result_names()
+        p2p_pair_insns = (
+                (["<> is_self = (isrc == target_to_source[itgt])"]
+                    if self.p2p.exclude_self else [])
+                + p2p_loopy_insns
+                + self.p2p.get_kernel_exprs(p2p_result_names))
+
+        loopy_knl = lp.make_kernel(
+                [
+                    "{[itgt_box]: 0<=itgt_box<ntgt_boxes}",
+                    "{[itgt, isrc_box, idim]: itgt_start<=itgt<itgt_end "
+                    "and isrc_box_start<=isrc_box<isrc_box_end "
+                    "and 0<=idim<dim}",
+                    "{[isrc]: isrc_start<=isrc<isrc_end}",
+                    ],
+                self.get_expansion_row_rules()
+                + self.get_kernel_scaling_assignment()
+                + self.p2p.get_kernel_scaling_assignments()
+                + ["""
+                for itgt_box
+                    <> tgt_ibox = target_boxes[itgt_box]
+                    <> itgt_start = box_target_starts[tgt_ibox]
+                    <> itgt_end = itgt_start+box_target_counts_nonchild[tgt_ibox]
+
+                    <> isrc_box_start = source_box_starts[itgt_box]
+                    <> isrc_box_end = source_box_starts[itgt_box+1]
+
+                    <> center[idim] = centers[idim, tgt_ibox] {id=fetch_center}
+
+                    """] + ["""
+                    <> coeff{coeffidx} = \
+                            src_expansions[src_row(tgt_ibox), {coeffidx}]
+                    """.format(coeffidx=i) for i in self.get_coeff_indices()]
+                + ["""
+
+                    for itgt
+                        <> b[idim] = targets[idim, itgt] - center[idim] {dup=idim}
+
+                        """] + loopy_insns + ["""
+
+                        for isrc_box
+                            <> src_ibox = source_box_lists[isrc_box]
+                            <> isrc_start = box_source_starts[src_ibox]
+                            <> isrc_end = isrc_start \
+                                    + box_source_counts_nonchild[src_ibox]
+
+                            for isrc
+                                <> d[idim] = targets[idim, itgt] \
+                                        - sources[idim, isrc] {dup=idim}
+                                """] + p2p_pair_insns + ["""
+                            end
+                        end
+                        """] + ["""
+                        result[{i}, {itgt}] = \
+                                {prev}kernel_scaling * result_{i}_p \
+                                + knl_{i}_scaling * simul_reduce(sum,
+                                    [isrc_box, isrc], pair_result_{i}) \
+                                {{id_prefix=write_result}}
+                        """.format(i=i, itgt=self.get_result_index("itgt"),
+                            prev=get_accumulation_term(
+                                "result[%d, %s]"
+                                % (i, self.get_result_index("itgt")),
+                                self.accumulate_output))
+                        for i in range(len(result_names))] + ["""
+                    end
+                end
+                """],
+                self.p2p.get_default_src_tgt_arguments()
+                + [
+                    lp.GlobalArg("box_target_starts,box_target_counts_nonchild",
+                        None, shape=None),
+                    lp.GlobalArg("box_source_starts,box_source_counts_nonchild",
+                        None, shape=None),
+                    lp.GlobalArg("source_box_starts, source_box_lists,",
+                        None, shape=None, offset=lp.auto),
+                    lp.GlobalArg("centers", None, shape="dim, naligned_boxes"),
+                    lp.ValueArg("rscale", None),
+                    lp.GlobalArg("strength", None,
+                        shape="nstrengths, nsources", dim_tags="sep,C"),
+                    lp.GlobalArg("result", None, shape="nresults, ntargets",
+                        dim_tags="sep,C"),
+                    lp.GlobalArg("src_expansions", None,
+                        shape=("nsrc_level_boxes",
+                            self.get_src_storage_ncoeffs()),
+                        offset=lp.auto),
+                    lp.ValueArg("nsrc_level_boxes,naligned_boxes", np.int32),
+                    lp.ValueArg("src_base_ibox", np.int32),
+                    "..."
+                ] + self.get_reordering_arguments()
+                + self.get_expansion_slot_arguments()
+                + [arg.loopy_arg for arg in self.expansion.get_args()],
+                name=self.name,
+                assumptions="ntgt_boxes>=1",
+                silenced_warnings="write_race(write_result*)",
+                default_offset=lp.auto,
+                fixed_parameters=dict(
+                    dim=self.dim,
+                    nstrengths=self.p2p.strength_count,
+                    nresults=len(result_names)),
+                lang_version=MOST_RECENT_LANGUAGE_VERSION)
 
+        loopy_knl = lp.add_dtypes(loopy_knl,
+                dict(nsources=np.int32, ntargets=np.int32))
+
+        loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
+        loopy_knl = lp.tag_array_axes(loopy_knl, "targets", "sep,C")
+        loopy_knl = lp.tag_array_axes(loopy_knl, "sources", "sep,C")
+        loopy_knl = lp.prioritize_loops(loopy_knl, "itgt_box,itgt,isrc_box,isrc")
+
+        loopy_knl = self.expansion.prepare_loopy_kernel(loopy_knl)
+        for knl in self.kernels:
+            loopy_knl = knl.prepare_loopy_kernel(loopy_knl)
+
+        return self.apply_expansion_layout(loopy_knl)
+
+    def get_optimized_kernel(self):
+        # FIXME
+        knl = self.get_kernel()
+        knl = lp.tag_inames(knl, dict(itgt_box="g.0"))
+        return knl
+
+    def get_chunks(self):
+        return [(tuple(range(len(self.kernels))), self)]
+
+    def __call__(self, queue, **kwargs):
+        """
+        :arg src_expansions:
+        :arg src_base_ibox:
+        :arg target_boxes:
+        :arg source_box_starts:
+        :arg source_box_lists:
+        :arg box_target_starts:
+        :arg box_target_counts_nonchild:
+        :arg box_source_starts:
+        :arg box_source_counts_nonchild:
+        :arg centers:
+        :arg targets:
+        :arg sources:
+        :arg strength:
+        """
         centers = kwargs.pop("centers")
         # "1" may be passed for rscale, which won't have its type
         # meaningfully inferred. Make the type of rscale explicit.
         rscale = centers.dtype.type(kwargs.pop("rscale"))
 
-        return knl(queue, centers=centers, rscale=rscale, **kwargs)
+        return self.run_chunks(queue, centers=centers, rscale=rscale, **kwargs)
 
 # }}}
 
@@ -34,6 +34,7 @@ from collections import defaultdict
 
 __doc__ = """
 .. autoclass:: ExpansionBase
+.. autoclass:: TranslationTermTable
 
 Expansion Factories
 ^^^^^^^^^^^^^^^^^^^
@@ -50,15 +51,25 @@ logger = logging.getLogger(__name__)
 
 class ExpansionBase(object):
     """
+    .. attribute:: is_prefix_truncatable
+
+        *True* if the coefficients of this expansion at a lower order are the
+        leading coefficients of those at a higher order, so that setting the
+        trailing coefficients of an expansion to zero truncates it to a lower
+        order.
+
     .. automethod:: with_kernel
     .. automethod:: __len__
     .. automethod:: get_coefficient_identifiers
     .. automethod:: coefficients_from_source
     .. automethod:: translate_from
+    .. automethod:: get_translation_term_table
     .. automethod:: __eq__
     .. automethod:: __ne__
     """
 
+    is_prefix_truncatable = False
+
     def __init__(self, kernel, order, use_rscale=None):
         # Don't be tempted to remove target derivatives here.
         # Line Taylor QBX can't do without them, because it can't
@@ -114,20 +125,26 @@ class ExpansionBase(object):
         """
         raise NotImplementedError
 
-    def coefficients_from_source(self, avec, bvec, rscale):
+    def coefficients_from_source(self, avec, bvec, rscale, sac=None):
         """Form an expansion from a source point.
 
         :arg avec: vector from source to center.
         :arg bvec: vector from center to target. Not usually necessary,
             except for line-Taylor expansion.
+        :arg sac: a
+            :class:`sumpy.assignment_collection.SymbolicAssignmentCollection`
+            or *None*. If given, expansions may assign intermediate values
+            (such as kernel derivatives computed by a recurrence) to new
+            variables in it, and refer to those in the returned expressions.
 
         :returns: a list of :mod:`sympy` expressions representing
             the coefficients of the expansion.
         """
         raise NotImplementedError
 
-    def evaluate(self, coeffs, bvec, rscale):
+    def evaluate(self, coeffs, bvec, rscale, sac=None):
         """
+        :arg sac: see :meth:`coefficients_from_source`.
         :return: a :mod:`sympy` expression corresponding
             to the evaluated expansion with the coefficients
             in *coeffs*.
@@ -136,7 +153,20 @@ class ExpansionBase(object):
         raise NotImplementedError
 
     def translate_from(self, src_expansion, src_coeff_exprs, src_rscale,
-            dvec, tgt_rscale):
+            dvec, tgt_rscale, sac=None):
+        """
+        :arg sac: see :meth:`coefficients_from_source`.
+        """
+        raise NotImplementedError
+
+    def get_translation_term_table(self, src_expansion):
+        """Return a :class:`TranslationTermTable` describing the translation
+        from *src_expansion* to *self* numerically, for use by code that
+        evaluates translations in loops rather than as unrolled expressions.
+
+        :raises NotImplementedError: if the translation cannot be described
+            by a table of numeric coefficients.
+        """
         raise NotImplementedError
 
     def update_persistent_hash(self, key_hash, key_builder):
@@ -158,6 +188,89 @@ class ExpansionBase(object):
 # }}}
 
 
+# {{{ translation term table
+
+class TranslationTermTable(object):
+    r"""A numeric description of a translation operator whose entries are
+    polynomials in the translation vector :math:`d`. Target coefficient
+    :math:`t` is obtained as
+
+    .. math::
+
+        \text{tgt}_t = r_\text{tgt}^{b_t} \sum_k c_k
+            \, r_\text{src}^{a_{s_k}} \, \text{src}_{s_k} \, d^{e_k},
+
+    where :math:`k` ranges over the terms belonging to :math:`t`.
+
+    .. attribute:: term_starts
+
+        An array of length *ntgt_coeffs* + 1. The terms for target coefficient
+        *t* are found at indices ``term_starts[t]:term_starts[t+1]`` of the
+        per-term arrays.
+
+    .. attribute:: src_indices
+
+        Per-term index of the source coefficient :math:`s_k`.
+
+    .. attribute:: coefficients
+
+        Per-term numeric coefficient :math:`c_k`.
+
+    .. attribute:: d_exponents
+
+        An array of shape ``(dim, nterms)`` holding the multi-index
+        :math:`e_k`.
+
+    .. attribute:: src_rscale_exponents
+
+        Per-source-coefficient exponent :math:`a_s` of the source rscale.
+
+    .. attribute:: tgt_rscale_exponents
+
+        Per-target-coefficient exponent :math:`b_t` of the target rscale.
+    """
+
+    def __init__(self, dim, ntgt_coeffs, terms,
+            src_rscale_exponents, tgt_rscale_exponents):
+        """
+        :arg terms: a mapping from ``(tgt_index, src_index, d_exponent)`` to
+            the numeric coefficient of the term, where *d_exponent* is a
+            multi-index.
+        """
+        terms = sorted(
+                (key, coeff) for key, coeff in six.iteritems(terms)
+                if coeff != 0)
+        nterms = len(terms)
+
+        tgt_indices = np.array(
+                [tgt_index for (tgt_index, _, _), _ in terms], dtype=np.int32)
+        self.src_indices = np.array(
+                [src_index for (_, src_index, _), _ in terms], dtype=np.int32)
+        self.coefficients = np.array(
+                [coeff for _, coeff in terms], dtype=np.float64)
+        self.d_exponents = np.array(
+                [d_exponent for (_, _, d_exponent), _ in terms],
+                dtype=np.int32).reshape(nterms, dim).T.copy()
+
+        self.term_starts = np.searchsorted(
+                tgt_indices, np.arange(ntgt_coeffs + 1)).astype(np.int32)
+
+        self.src_rscale_exponents = np.array(src_rscale_exponents, dtype=np.int32)
+        self.tgt_rscale_exponents = np.array(tgt_rscale_exponents, dtype=np.int32)
+
+    @property
+    def nterms(self):
+        return len(self.coefficients)
+
+    @property
+    def max_d_exponent(self):
+        if not self.nterms:
+            return 0
+        return int(np.max(self.d_exponents))
+
+# }}}
+
+
 # {{{ derivative wrangler
 
 class DerivativeWrangler(object):
@@ -201,6 +314,13 @@ class FullDerivativeWrangler(DerivativeWrangler):
     get_coefficient_identifiers = (
             DerivativeWrangler.get_full_coefficient_identifiers)
 
+    @memoize_method
+    def get_coefficient_matrix(self, rscale):
+        # All derivatives are stored, so this is just the identity.
+        return defaultdict(list, (
+            (i, [(i, 1)])
+            for i in range(len(self.get_full_coefficient_identifiers()))))
+
     def get_full_kernel_derivatives_from_stored(self, stored_kernel_derivatives,
             rscale):
         return stored_kernel_derivatives
@@ -249,6 +369,13 @@ class LinearRecurrenceBasedDerivativeWrangler(DerivativeWrangler):
     def get_coefficient_identifiers(self):
         return self.stored_identifiers
 
+    def get_recurrence_key(self):
+        """Return a hashable key identifying the recurrences found by
+        :meth:`try_get_recurrence_for_derivative`. Unlike the wrangler itself,
+        this does not depend on the order.
+        """
+        return (type(self).__name__, self.dim)
+
     def get_full_kernel_derivatives_from_stored(self, stored_kernel_derivatives,
             rscale):
         coeff_matrix = self.get_coefficient_matrix(rscale)
@@ -311,6 +438,30 @@ class LinearRecurrenceBasedDerivativeWrangler(DerivativeWrangler):
 
     @memoize_method
     def _get_stored_ids_and_coeff_mat(self):
+        from sumpy import derivative_recurrence_cache, CACHING_ENABLED
+
+        if CACHING_ENABLED:
+            from sumpy.symbolic import get_backend_version
+            cache_key = (
+                    self.get_recurrence_key() + (self.order,)
+                    + get_backend_version())
+
+            try:
+                stored_identifiers, coeff_matrix = \
+                        derivative_recurrence_cache[cache_key]
+                return stored_identifiers, defaultdict(list, coeff_matrix)
+            except KeyError:
+                pass
+
+        stored_identifiers, coeff_matrix = self._compute_stored_ids_and_coeff_mat()
+
+        if CACHING_ENABLED:
+            derivative_recurrence_cache.store_if_not_present(
+                    cache_key, (stored_identifiers, dict(coeff_matrix)))
+
+        return stored_identifiers, coeff_matrix
+
+    def _compute_stored_ids_and_coeff_mat(self):
         stored_identifiers = []
         identifiers_so_far = {}
 
@@ -318,10 +469,11 @@ class LinearRecurrenceBasedDerivativeWrangler(DerivativeWrangler):
         start_time = time.time()
         logger.debug("computing recurrence for Taylor coefficients: start")
 
-        # Sparse matrix, indexed by row
-        coeff_matrix_transpose = defaultdict(list)
+        # Sparse matrix, indexed by row. Each row expresses a derivative in
+        # terms of the stored ones, so the row for a derivative obtained by a
+        # recurrence is the same linear combination of the rows it refers to.
+        coeff_matrix = defaultdict(list)
 
-        # Build up the matrix transpose by row.
         from six import iteritems
         for i, identifier in enumerate(self.get_full_coefficient_identifiers()):
             expr = self.try_get_recurrence_for_derivative(
@@ -329,23 +481,19 @@ class LinearRecurrenceBasedDerivativeWrangler(DerivativeWrangler):
 
             if expr is None:
                 # Identifier should be stored
-                coeff_matrix_transpose[len(stored_identifiers)] = [(i, 1)]
+                coeff_matrix[i] = [(len(stored_identifiers), 1)]
                 stored_identifiers.append(identifier)
             else:
-                expr = dict((identifiers_so_far[ident], val) for ident, val in
-                            iteritems(expr))
-                result = _spmv(coeff_matrix_transpose, expr, sparse_vectors=True)
-                for j, item in iteritems(result):
-                    coeff_matrix_transpose[j].append((i, item))
-
-            identifiers_so_far[identifier] = i
+                row = {}
+                for ident, coeff in iteritems(expr):
+                    for j, val in coeff_matrix[identifiers_so_far[ident]]:
+                        row[j] = row.get(j, 0) + coeff * val
 
-        stored_identifiers = stored_identifiers
+                coeff_matrix[i] = [
+                        (j, val) for j, val in sorted(iteritems(row))
+                        if val != 0]
 
-        coeff_matrix = defaultdict(list)
-        for i, row in iteritems(coeff_matrix_transpose):
-            for j, val in row:
-                coeff_matrix[j].append((i, val))
+            identifiers_so_far[identifier] = i
 
         logger.debug("computing recurrence for Taylor coefficients: "
                      "done after {dur:.2f} seconds"
@@ -406,6 +554,10 @@ class HelmholtzDerivativeWrangler(LinearRecurrenceBasedDerivativeWrangler):
         super(HelmholtzDerivativeWrangler, self).__init__(order, dim)
         self.helmholtz_k_name = helmholtz_k_name
 
+    def get_recurrence_key(self):
+        return (super(HelmholtzDerivativeWrangler, self).get_recurrence_key()
+                + (self.helmholtz_k_name,))
+
     def try_get_recurrence_for_derivative(self, deriv, in_terms_of):
         deriv = np.array(deriv, dtype=int)
 
@@ -440,6 +592,10 @@ class HelmholtzDerivativeWrangler(LinearRecurrenceBasedDerivativeWrangler):
 
 class VolumeTaylorExpansionBase(object):
 
+    # Coefficient identifiers are sorted by total degree, see
+    # get_full_coefficient_identifiers.
+    is_prefix_truncatable = True
+
     @classmethod
     def get_or_make_derivative_wrangler(cls, *key):
         """
@@ -476,6 +632,28 @@ class VolumeTaylorExpansionBase(object):
     def get_storage_index(self, i):
         return self._storage_loc_dict[i]
 
+    def _get_numeric_coefficient_matrix(self):
+        """Return the coefficient matrix of the derivative wrangler for
+        unit rscale, with all entries converted to :class:`float`.
+
+        :raises NotImplementedError: if the matrix entries are not numbers,
+            e.g. because they depend on a kernel parameter.
+        """
+        coeff_matrix = self.derivative_wrangler.get_coefficient_matrix(1)
+
+        result = defaultdict(list)
+        for irow, row in six.iteritems(coeff_matrix):
+            for icol, coeff in row:
+                try:
+                    coeff = float(coeff)
+                except TypeError:
+                    raise NotImplementedError(
+                            "coefficient matrix of '%s' is not numeric"
+                            % type(self.derivative_wrangler).__name__)
+                result[irow].append((icol, coeff))
+
+        return result
+
 
 class VolumeTaylorExpansion(VolumeTaylorExpansionBase):
 
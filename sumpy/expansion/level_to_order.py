@@ -25,9 +25,27 @@ THE SOFTWARE.
 __doc__ = """
 .. autoclass:: FMMLibExpansionOrderFinder
 .. autoclass:: SimpleExpansionOrderFinder
+.. autoclass:: EmpiricalExpansionOrderFinder
+
+Per-box orders
+--------------
+
+.. autoclass:: StrengthBasedBoxOrderFinder
+
+Per-interaction orders
+----------------------
+
+.. autoclass:: SeparationBasedPairOrderFinder
 """
 
 import numpy as np
+from pytools.persistent_dict import WriteOncePersistentDict
+
+from sumpy.version import VERSION_TEXT
+
+# Maps a translation setup and an order to the relative error measured for it.
+translation_error_cache = WriteOncePersistentDict(
+        "sumpy-translation-error-cache-v2-"+VERSION_TEXT)
 
 
 class FMMLibExpansionOrderFinder(object):
@@ -166,4 +184,454 @@ class SimpleExpansionOrderFinder(object):
         return max(laplace_order, helm_order) + self.extra_order
 
 
+class EmpiricalExpansionOrderFinder(object):
+    r"""Return the smallest expansion order whose measured error meets the
+    tolerance for a given level.
+
+    The error for an order is measured with :mod:`sumpy.toys` by forming a
+    multipole expansion of point sources in a box, translating it to a local
+    expansion about the closest well-separated boxes and comparing the
+    evaluated result at points of those boxes (including their corners)
+    against direct evaluation. The target boxes are enlarged by the tree's
+    *stick_out_factor*, since targets may stick out of their boxes by that
+    fraction of the box size. Any kernel and expansion class supported by
+    :mod:`sumpy.toys` may be used.
+
+    Measured errors are stored on disk, keyed by kernel, kernel arguments,
+    expansion classes, box size, stick-out factor and order, so each
+    configuration is only calibrated once. The errors of kernels that are
+    homogeneous in the distance and have no arguments (such as the
+    three-dimensional :class:`sumpy.kernel.LaplaceKernel`) are independent
+    of the box size and are measured for unit boxes, while for others (such
+    as the logarithmic two-dimensional :class:`sumpy.kernel.LaplaceKernel`
+    or :class:`sumpy.kernel.HelmholtzKernel`) they are measured separately
+    for each level's box size.
+
+    .. automethod:: __init__
+    """
+
+    def __init__(self, cl_context, tol, extra_order=0,
+            mpole_expn_class=None, local_expn_class=None,
+            max_order=50, nsources=20, ntargets=20):
+        """
+        :arg tol: relative error tolerance
+        :arg extra_order: order increase to accommodate, say, the taking of
+            derivatives of the FMM expansions.
+        :arg mpole_expn_class: passed to :class:`sumpy.toys.ToyContext`
+        :arg local_expn_class: passed to :class:`sumpy.toys.ToyContext`
+        :arg max_order: the largest order that is tried before giving up
+        :arg nsources: the number of random sources in the source box, in
+            addition to its corners
+        :arg ntargets: the number of random targets in each target box, in
+            addition to its corners
+        """
+        self.cl_context = cl_context
+        self.tol = tol
+        self.extra_order = extra_order
+        self.mpole_expn_class = mpole_expn_class
+        self.local_expn_class = local_expn_class
+        self.max_order = max_order
+        self.nsources = nsources
+        self.ntargets = ntargets
+
+        self._toy_contexts = {}
+
+    def _get_toy_context(self, kernel, kernel_args):
+        key = (kernel, kernel_args)
+
+        try:
+            return self._toy_contexts[key]
+        except KeyError:
+            pass
+
+        from sumpy.toys import ToyContext
+        result = ToyContext(self.cl_context, kernel,
+                mpole_expn_class=self.mpole_expn_class,
+                local_expn_class=self.local_expn_class,
+                extra_kernel_kwargs=dict(kernel_args))
+
+        self._toy_contexts[key] = result
+        return result
+
+    def _get_box_points(self, dim, center, size, nrandom, seed):
+        from itertools import product
+        corners = np.array(list(product([-0.5, 0.5], repeat=dim))).T
+
+        rng = np.random.RandomState(seed)
+        random = rng.uniform(-0.5, 0.5, size=(dim, nrandom))
+
+        return (np.asarray(center).reshape(dim, 1)
+                + size * np.hstack([corners, random]))
+
+    def _get_target_box_offsets(self, dim):
+        # Up to symmetry, the boxes (in units of the box size) closest to the
+        # source box that are still well-separated from it
+        from itertools import combinations_with_replacement
+        return [
+                np.array((2,) + rest, dtype=np.float64)
+                for rest in combinations_with_replacement(
+                    [2, 1, 0], dim - 1)]
+
+    def _is_scale_invariant(self, kernel, kernel_args):
+        """Return whether the relative errors measured for *kernel* are
+        independent of the box size.
+        """
+        from sumpy.kernel import LaplaceKernel, BiharmonicKernel
+
+        # 1/r and r, unlike log(r) and r**2 log(r) in two dimensions
+        return (
+                not kernel_args
+                and isinstance(kernel, (LaplaceKernel, BiharmonicKernel))
+                and kernel.dim == 3)
+
+    def get_translation_error(self, kernel, kernel_args, size, order,
+            stick_out_factor=0):
+        """Return the largest relative error of evaluating, at order *order*,
+        the field of sources in a box of side length *size* through a
+        multipole-to-local translation to each closest well-separated box,
+        at targets sticking out of these boxes by *stick_out_factor* times
+        *size*.
+        """
+        toy_ctx = self._get_toy_context(kernel, kernel_args)
+
+        key = (kernel, kernel_args, size, stick_out_factor, order,
+                toy_ctx.mpole_expn_class.__name__,
+                toy_ctx.local_expn_class.__name__,
+                self.nsources, self.ntargets)
+
+        try:
+            return translation_error_cache[key]
+        except KeyError:
+            pass
+
+        import sumpy.toys as t
+
+        dim = kernel.dim
+
+        source_center = np.zeros(dim)
+        sources = self._get_box_points(
+                dim, source_center, size, self.nsources, seed=15)
+        psource = t.PointSources(toy_ctx, sources,
+                weights=np.ones(sources.shape[-1]))
+
+        mexp = t.multipole_expand(psource, source_center,
+                order=order, rscale=size)
+
+        target_size = (1 + 2 * stick_out_factor) * size
+
+        error = 0
+        for offset in self._get_target_box_offsets(dim):
+            target_center = source_center + size * offset
+            targets = self._get_box_points(
+                    dim, target_center, target_size, self.ntargets, seed=17)
+
+            lexp = t.local_expand(mexp, target_center,
+                    order=order, rscale=size)
+
+            ref_pot = psource.eval(targets)
+            pot = lexp.eval(targets)
+
+            error = max(error,
+                    np.max(np.abs(pot - ref_pot)) / np.max(np.abs(ref_pot)))
+
+        error = float(error)
+        translation_error_cache.store_if_not_present(key, error)
+        return error
+
+    def __call__(self, kernel, kernel_args, tree, level):
+        kernel_args = tuple(sorted(kernel_args))
+
+        if self._is_scale_invariant(kernel, kernel_args):
+            size = 1.
+        else:
+            size = tree.root_extent / 2 ** level
+
+        for order in range(1, self.max_order + 1):
+            if self.get_translation_error(
+                    kernel, kernel_args, size, order,
+                    tree.stick_out_factor) < self.tol:
+                return order + self.extra_order
+
+        raise ValueError("unable to find an expansion order at most %d "
+                "meeting tolerance %g" % (self.max_order, self.tol))
+
+
+def _get_default_separation_ratios(tree):
+    """Return the ratios *(mpole_ratio, local_ratio)* of the radius of the
+    region an expansion of a box represents to the distance from its center
+    to the closest point it is evaluated at (for multipole expansions) or
+    the closest source it represents (for local expansions), for a box and a
+    box of the same size separated from it by its own size. Targets may
+    stick out of their boxes by *tree.stick_out_factor* times the box size,
+    which brings them closer to the multipole expansions they are evaluated
+    from and moves them further from the centers of local expansions.
+    """
+    dim = tree.dimensions
+    stick_out_factor = tree.stick_out_factor
+
+    mpole_ratio = np.sqrt(dim) / (3 - 2 * stick_out_factor)
+    local_ratio = np.sqrt(dim) * (1 + 2 * stick_out_factor) / 3
+    return mpole_ratio, local_ratio
+
+
+class StrengthBasedBoxOrderFinder(object):
+    r"""Return, for each box, an expansion order at most that of its level,
+    lowered for boxes whose expansions represent only a small part of the
+    total source strength.
+
+    The error of an expansion truncated after order :math:`p` is modeled as
+
+    .. math::
+
+        C Q \rho^{p+1},
+
+    where :math:`Q` is the sum of the absolute source strengths represented
+    by the expansion and :math:`\rho` is the separation ratio of the FMM.
+    Assuming that the order :math:`p_\ell` of a level meets the tolerance
+    for the total strength :math:`Q_\text{total}`, the error of each of the
+    :math:`n` expansions of the level that a target interacts with stays
+    within an :math:`n`-th of the tolerance at order
+
+    .. math::
+
+        p_\ell - \left\lfloor \frac{\log (Q_\text{total}/(n Q))}
+            {\log (1/\rho)} \right\rfloor,
+
+    so that their sum stays within the tolerance.
+
+    For multipole expansions, :math:`Q` is the strength of the sources in the
+    box, and :math:`n` is the number of multipole expansions of a level that
+    a target box interacts with. For local expansions, :math:`Q` is bounded by
+    the total strength less that of the sources in the box and its
+    colleagues, which are never in the far field of the box, and
+    :math:`n = 1`, since each target lies in a single box of each level.
+
+    Instances are suitable as *box_order_finder* in
+    :meth:`sumpy.fmm.SumpyExpansionWranglerCodeContainer.get_wrangler`.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    """
+
+    def __init__(self, separation_ratio=None, min_order=1,
+            ninteractions=None):
+        r"""
+        :arg separation_ratio: the ratio of the radius of a box to the
+            distance from its center to its closest well-separated point,
+            by default :math:`\sqrt{d}/3` (as in
+            :class:`SimpleExpansionOrderFinder`), adjusted for targets
+            sticking out of their boxes by the tree's *stick_out_factor*.
+        :arg min_order: the smallest order assigned to any box.
+        :arg ninteractions: the number :math:`n` of multipole expansions of a
+            level that a target box interacts with, by default
+            :math:`6^d - 3^d`, the largest number of boxes
+            well-separated from a box but not from its parent.
+        """
+        self.separation_ratio = separation_ratio
+        self.min_order = min_order
+        self.ninteractions = ninteractions
+
+    def _get_box_strengths(self, tree, source_strengths):
+        strength_cumsum = np.zeros(tree.nsources + 1, dtype=np.float64)
+        np.cumsum(source_strengths, out=strength_cumsum[1:])
+
+        starts = tree.box_source_starts
+        return (
+                strength_cumsum[starts + tree.box_source_counts_cumul]
+                - strength_cumsum[starts])
+
+    def _get_near_strengths(self, tree, box_strengths):
+        """Return the sum of *box_strengths* over each box and its
+        colleagues.
+        """
+        from itertools import product
+
+        dim = tree.dimensions
+        root_center = tree.box_centers[:, 0]
+        root_lower = root_center - tree.root_extent / 2
+
+        result = np.zeros(tree.nboxes, dtype=np.float64)
+
+        for lev in range(tree.nlevels):
+            start, stop = tree.level_start_box_nrs[lev:lev+2]
+            if start == stop:
+                continue
+
+            nboxes_per_axis = 2**lev
+            box_size = tree.root_extent / nboxes_per_axis
+
+            coords = np.floor(
+                    (tree.box_centers[:, start:stop] - root_lower.reshape(-1, 1))
+                    / box_size).astype(np.int64)
+
+            def linearize(coords):
+                result = np.zeros(coords.shape[-1], dtype=np.int64)
+                for iaxis in range(dim):
+                    result = result * nboxes_per_axis + coords[iaxis]
+                return result
+
+            keys = linearize(coords)
+            key_order = np.argsort(keys)
+            sorted_keys = keys[key_order]
+            level_strengths = box_strengths[start:stop]
+
+            for offset in product([-1, 0, 1], repeat=dim):
+                nb_coords = coords + np.array(offset).reshape(-1, 1)
+                in_range = np.all(
+                        (nb_coords >= 0) & (nb_coords < nboxes_per_axis), axis=0)
+
+                nb_keys = linearize(nb_coords)
+                idx = np.minimum(
+                        np.searchsorted(sorted_keys, nb_keys), len(keys) - 1)
+                found = in_range & (sorted_keys[idx] == nb_keys)
+
+                result[start:stop] += np.where(
+                        found, level_strengths[key_order[idx]], 0)
+
+        return result
+
+    def _reduce_orders(self, level_orders, strengths, budget_strength,
+            separation_ratio):
+        """Lower *level_orders* for expansions representing *strengths* so
+        that their modeled error stays within that of the level order for
+        *budget_strength*.
+        """
+        with np.errstate(divide="ignore"):
+            reduction = np.floor(
+                    np.log(budget_strength / strengths)
+                    / np.log(1 / separation_ratio))
+
+        reduction = np.where(strengths > 0, reduction, np.inf)
+        orders = np.maximum(level_orders - reduction, self.min_order)
+        return np.minimum(orders, level_orders).astype(np.int32)
+
+    def __call__(self, tree, level_orders, source_strengths):
+        """
+        :arg tree: a :class:`boxtree.Tree` on the host
+        :arg level_orders: the expansion order of each level
+        :arg source_strengths: the absolute source strengths, in tree order,
+            on the host
+        :returns: a tuple *(mpole_box_orders, local_box_orders)* of arrays of
+            length *tree.nboxes*
+        """
+        box_level_orders = np.array(level_orders)[tree.box_levels]
+
+        box_strengths = self._get_box_strengths(tree, source_strengths)
+        total_strength = box_strengths[0]
+
+        if total_strength == 0:
+            orders = np.minimum(box_level_orders, self.min_order)
+            return orders, orders
+
+        ninteractions = self.ninteractions
+        if ninteractions is None:
+            ninteractions = 6**tree.dimensions - 3**tree.dimensions
+
+        if self.separation_ratio is None:
+            mpole_ratio, local_ratio = _get_default_separation_ratios(tree)
+        else:
+            mpole_ratio = local_ratio = self.separation_ratio
+
+        mpole_box_orders = self._reduce_orders(
+                box_level_orders, box_strengths,
+                total_strength / ninteractions, mpole_ratio)
+
+        far_strengths = np.maximum(
+                total_strength
+                - self._get_near_strengths(tree, box_strengths), 0)
+        local_box_orders = self._reduce_orders(
+                box_level_orders, far_strengths, total_strength,
+                local_ratio)
+
+        return mpole_box_orders, local_box_orders
+
+
+class SeparationBasedPairOrderFinder(object):
+    r"""Return, for each interaction of a multipole expansion with a target
+    box, an order to which the multipole expansion may be truncated, lowered
+    for source boxes that are further from the target box than the closest
+    well-separated ones.
+
+    The error of evaluating a multipole expansion truncated after order
+    :math:`p` within a target box is modeled as :math:`C \rho^{p+1}`, where
+    :math:`\rho` is the ratio of the radius of the source box to the
+    distance from its center to the target box. Assuming that the order
+    :math:`p_\ell` of the source level meets the tolerance at the closest
+    separation, with ratio :math:`\rho_0`, the same error is reached at
+    order
+
+    .. math::
+
+        \left\lceil (p_\ell + 1) \frac{\log \rho_0}{\log \rho}
+            \right\rceil - 1.
+
+    Instances are suitable as *pair_order_finder* in
+    :meth:`sumpy.fmm.SumpyExpansionWranglerCodeContainer.get_wrangler`.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    """
+
+    def __init__(self, separation_ratio=None, min_order=1):
+        r"""
+        :arg separation_ratio: the ratio :math:`\rho_0` for the closest
+            well-separated boxes, by default :math:`\sqrt{d}/3`, that of a
+            box and a box of at least the same size separated from it by
+            its own size (as in :class:`SimpleExpansionOrderFinder`),
+            adjusted for targets sticking out of their boxes by the tree's
+            *stick_out_factor*.
+        :arg min_order: the smallest order assigned to any interaction.
+        """
+        self.separation_ratio = separation_ratio
+        self.min_order = min_order
+
+    def __call__(self, tree, source_level_order, target_boxes,
+            source_box_starts, source_box_lists):
+        """
+        :arg tree: a :class:`boxtree.Tree` on the host
+        :arg source_level_order: the expansion order of the level of the
+            source boxes
+        :arg target_boxes: an array of target box numbers
+        :arg source_box_starts: an array of length ``len(target_boxes) + 1``
+            that, with *source_box_lists*, forms a "compressed sparse row"
+            list of the source boxes interacting with each target box
+        :returns: an array of orders, one for each entry of
+            ``source_box_lists[source_box_starts[0]:source_box_starts[-1]]``
+        """
+        dim = tree.dimensions
+
+        separation_ratio = self.separation_ratio
+        if separation_ratio is None:
+            separation_ratio, _ = _get_default_separation_ratios(tree)
+
+        nsources_per_target = np.diff(source_box_starts)
+        pair_target_boxes = np.repeat(target_boxes, nsources_per_target)
+        pair_source_boxes = source_box_lists[
+                source_box_starts[0]:source_box_starts[-1]]
+
+        source_sizes = tree.root_extent / 2**tree.box_levels[pair_source_boxes]
+        target_sizes = tree.root_extent / 2**tree.box_levels[pair_target_boxes]
+
+        # distance from the source box center to the target box, including
+        # the margin by which targets may stick out of it
+        axis_dists = np.maximum(
+                np.abs(tree.box_centers[:, pair_target_boxes]
+                    - tree.box_centers[:, pair_source_boxes])
+                - target_sizes * (0.5 + tree.stick_out_factor), 0)
+        dists = np.sqrt(np.sum(axis_dists**2, axis=0))
+
+        source_radii = np.sqrt(dim) / 2 * source_sizes
+        with np.errstate(divide="ignore"):
+            ratios = source_radii / dists
+
+        orders = np.full(len(ratios), source_level_order, dtype=np.int32)
+        far = ratios < separation_ratio
+        orders[far] = np.ceil(
+                (source_level_order + 1)
+                * np.log(separation_ratio) / np.log(ratios[far])) - 1
+
+        return np.clip(orders, min(self.min_order, source_level_order),
+                source_level_order).astype(np.int32)
+
+
 # vim: fdm=marker
@@ -23,6 +23,7 @@ THE SOFTWARE.
 """
 
 from six.moves import range, zip
+from collections import defaultdict
 import sumpy.symbolic as sym
 
 from sumpy.expansion import (
@@ -51,13 +52,15 @@ __doc__ = """
 
 class LineTaylorLocalExpansion(LocalExpansionBase):
 
+    is_prefix_truncatable = True
+
     def get_storage_index(self, k):
         return k
 
     def get_coefficient_identifiers(self):
         return list(range(self.order+1))
 
-    def coefficients_from_source(self, avec, bvec, rscale):
+    def coefficients_from_source(self, avec, bvec, rscale, sac=None):
         # no point in heeding rscale here--just ignore it
         if bvec is None:
             raise RuntimeError("cannot use line-Taylor expansions in a setting "
@@ -98,7 +101,7 @@ class LineTaylorLocalExpansion(LocalExpansionBase):
                     .subs("tau", 0)
                     for i in self.get_coefficient_identifiers()]
 
-    def evaluate(self, coeffs, bvec, rscale):
+    def evaluate(self, coeffs, bvec, rscale, sac=None):
         # no point in heeding rscale here--just ignore it
         from pytools import factorial
         return sym.Add(*(
@@ -115,32 +118,33 @@ class VolumeTaylorLocalExpansionBase(LocalExpansionBase):
     Coefficients represent derivative values of the kernel.
     """
 
-    def coefficients_from_source(self, avec, bvec, rscale):
-        from sumpy.tools import MiDerivativeTaker
-        ppkernel = self.kernel.postprocess_at_source(
-                self.kernel.get_expression(avec), avec)
+    def coefficients_from_source(self, avec, bvec, rscale, sac=None):
+        taker = None
+        if sac is not None:
+            taker = self.kernel.get_recurrence_derivative_taker(avec, sac)
+
+        if taker is None:
+            from sumpy.tools import MiDerivativeTaker
+            ppkernel = self.kernel.postprocess_at_source(
+                    self.kernel.get_expression(avec), avec)
+
+            taker = MiDerivativeTaker(ppkernel, avec)
 
-        taker = MiDerivativeTaker(ppkernel, avec)
         return [
                 taker.diff(mi) * rscale ** sum(mi)
                 for mi in self.get_coefficient_identifiers()]
 
-    def evaluate(self, coeffs, bvec, rscale):
-        from sumpy.tools import mi_power, mi_factorial
+    def evaluate(self, coeffs, bvec, rscale, sac=None):
+        from sumpy.tools import mi_taylor_polynomial
         evaluated_coeffs = (
             self.derivative_wrangler.get_full_kernel_derivatives_from_stored(
                 coeffs, rscale))
         bvec = bvec * rscale**-1
-        result = sum(
-                coeff
-                * mi_power(bvec, mi, evaluate=False)
-                / mi_factorial(mi)
-                for coeff, mi in zip(
-                        evaluated_coeffs, self.get_full_coefficient_identifiers()))
-        return result
+        return mi_taylor_polynomial(
+                evaluated_coeffs, self.get_full_coefficient_identifiers(), bvec)
 
     def translate_from(self, src_expansion, src_coeff_exprs, src_rscale,
-            dvec, tgt_rscale):
+            dvec, tgt_rscale, sac=None):
         logger.info("building translation operator: %s(%d) -> %s(%d): start"
                 % (type(src_expansion).__name__,
                     src_expansion.order,
@@ -163,7 +167,8 @@ class VolumeTaylorLocalExpansionBase(LocalExpansionBase):
             # This code speeds up derivative taking by caching all kernel
             # derivatives.
 
-            taker = src_expansion.get_kernel_derivative_taker(dvec)
+            taker = src_expansion.get_kernel_derivative_taker(
+                    dvec, src_rscale, sac)
 
             from sumpy.tools import add_mi
 
@@ -201,6 +206,48 @@ class VolumeTaylorLocalExpansionBase(LocalExpansionBase):
         logger.info("building translation operator: done")
         return result
 
+    def get_translation_term_table(self, src_expansion):
+        if not isinstance(src_expansion, VolumeTaylorLocalExpansionBase):
+            raise NotImplementedError("no translation term table for %s to "
+                    "Taylor local expansion"
+                    % type(src_expansion).__name__)
+
+        from sumpy.tools import mi_factorial
+        from sumpy.expansion import TranslationTermTable
+
+        # This mirrors translate_from(). Derivative *tgt_mi* of the
+        # source expansion receives d**(src_mi-tgt_mi)/(src_mi-tgt_mi)! times
+        # each full source coefficient *src_mi* with src_mi >= tgt_mi. The full
+        # source coefficients are in turn linear combinations of the stored
+        # ones.
+
+        src_coeff_matrix = src_expansion._get_numeric_coefficient_matrix()
+
+        terms = defaultdict(lambda: 0)
+        for tgt_index, tgt_mi in enumerate(self.get_coefficient_identifiers()):
+            for i, src_mi in enumerate(
+                    src_expansion.get_full_coefficient_identifiers()):
+                if any(k < n for n, k in zip(tgt_mi, src_mi)):
+                    continue
+
+                d_exponent = tuple(k - n for n, k in zip(tgt_mi, src_mi))
+                contrib = 1 / mi_factorial(d_exponent)
+
+                for src_index, val in src_coeff_matrix[i]:
+                    terms[tgt_index, src_index, d_exponent] += val * contrib
+
+        if self.use_rscale:
+            src_rscale_exponents = [
+                    -sum(mi) for mi in src_expansion.get_coefficient_identifiers()]
+            tgt_rscale_exponents = [
+                    sum(mi) for mi in self.get_coefficient_identifiers()]
+        else:
+            src_rscale_exponents = [0] * len(src_expansion)
+            tgt_rscale_exponents = [0] * len(self)
+
+        return TranslationTermTable(self.dim, len(self), terms,
+                src_rscale_exponents, tgt_rscale_exponents)
+
 
 class VolumeTaylorLocalExpansion(
         VolumeTaylorExpansion,
@@ -242,7 +289,7 @@ class _FourierBesselLocalExpansion(LocalExpansionBase):
     def get_coefficient_identifiers(self):
         return list(range(-self.order, self.order+1))
 
-    def coefficients_from_source(self, avec, bvec, rscale):
+    def coefficients_from_source(self, avec, bvec, rscale, sac=None):
         if not self.use_rscale:
             rscale = 1
 
@@ -260,7 +307,7 @@ class _FourierBesselLocalExpansion(LocalExpansionBase):
                     * sym.exp(sym.I * l * source_angle_rel_center), avec)
                     for l in self.get_coefficient_identifiers()]
 
-    def evaluate(self, coeffs, bvec, rscale):
+    def evaluate(self, coeffs, bvec, rscale, sac=None):
         if not self.use_rscale:
             rscale = 1
 
@@ -279,7 +326,7 @@ class _FourierBesselLocalExpansion(LocalExpansionBase):
                 for l in self.get_coefficient_identifiers())
 
     def translate_from(self, src_expansion, src_coeff_exprs, src_rscale,
-            dvec, tgt_rscale):
+            dvec, tgt_rscale, sac=None):
         from sumpy.symbolic import sym_real_norm_2
 
         if not self.use_rscale:
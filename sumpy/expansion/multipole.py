@@ -23,6 +23,7 @@ THE SOFTWARE.
 """
 
 from six.moves import range, zip
+from collections import defaultdict
 import sumpy.symbolic as sym  # noqa
 
 from sumpy.symbolic import vector_xreplace
@@ -54,7 +55,7 @@ class VolumeTaylorMultipoleExpansionBase(MultipoleExpansionBase):
     Coefficients represent the terms in front of the kernel derivatives.
     """
 
-    def coefficients_from_source(self, avec, bvec, rscale):
+    def coefficients_from_source(self, avec, bvec, rscale, sac=None):
         from sumpy.kernel import DirectionalSourceDerivative
         kernel = self.kernel
 
@@ -88,11 +89,11 @@ class VolumeTaylorMultipoleExpansionBase(MultipoleExpansionBase):
             for i, mi in enumerate(coeff_identifiers):
                 result[i] /= (mi_factorial(mi) * rscale ** sum(mi))
         else:
+            from sumpy.tools import mi_scaled_powers
             avec = [sym.UnevaluatedExpr(a * rscale**-1) for a in avec]
 
-            result = [
-                    mi_power(avec, mi) / mi_factorial(mi)
-                    for mi in self.get_full_coefficient_identifiers()]
+            result = mi_scaled_powers(
+                    avec, self.get_full_coefficient_identifiers(), sac)
         return (
             self.derivative_wrangler.get_stored_mpole_coefficients_from_full(
                 result, rscale))
@@ -113,11 +114,11 @@ class VolumeTaylorMultipoleExpansionBase(MultipoleExpansionBase):
         else:
             return (rscale**nderivatives_for_scaling * expr)
 
-    def evaluate(self, coeffs, bvec, rscale):
+    def evaluate(self, coeffs, bvec, rscale, sac=None):
         if not self.use_rscale:
             rscale = 1
 
-        taker = self.get_kernel_derivative_taker(bvec)
+        taker = self.get_kernel_derivative_taker(bvec, rscale, sac)
 
         result = sym.Add(*tuple(
                 coeff
@@ -126,12 +127,35 @@ class VolumeTaylorMultipoleExpansionBase(MultipoleExpansionBase):
 
         return result
 
-    def get_kernel_derivative_taker(self, bvec):
+    def get_kernel_derivative_taker(self, bvec, rscale=1, sac=None):
+        """Return an object whose ``diff(mi)`` method returns derivatives of
+        the kernel at *bvec*, for use with :meth:`get_scaled_multipole`.
+
+        If *sac* is given and the kernel has a recurrence for its derivatives
+        (see :meth:`sumpy.kernel.Kernel.get_recurrence_derivative_taker`), the
+        derivatives are evaluated numerically in generated code. For kernels
+        with efficient scale adjustment, they are then evaluated at
+        *bvec* / *rscale*, since :meth:`get_scaled_multipole` cannot apply
+        the scaling to the resulting variables.
+        """
+        if sac is not None:
+            from sumpy.tools import add_to_sac
+            if self.kernel.has_efficient_scale_adjustment:
+                dist_vec = [
+                        add_to_sac(sac, bvec_i * rscale**-1, "kernel_dist")
+                        for bvec_i in bvec]
+            else:
+                dist_vec = bvec
+
+            taker = self.kernel.get_recurrence_derivative_taker(dist_vec, sac)
+            if taker is not None:
+                return taker
+
         return (self.derivative_wrangler.get_derivative_taker(
             self.kernel.get_expression(bvec), bvec))
 
     def translate_from(self, src_expansion, src_coeff_exprs, src_rscale,
-            dvec, tgt_rscale):
+            dvec, tgt_rscale, sac=None):
         if not isinstance(src_expansion, type(self)):
             raise RuntimeError("do not know how to translate %s to "
                     "Taylor multipole expansion"
@@ -191,6 +215,56 @@ class VolumeTaylorMultipoleExpansionBase(MultipoleExpansionBase):
             self.derivative_wrangler.get_stored_mpole_coefficients_from_full(
                 result, tgt_rscale))
 
+    def get_translation_term_table(self, src_expansion):
+        if not isinstance(src_expansion, type(self)):
+            raise NotImplementedError("no translation term table for %s to "
+                    "Taylor multipole expansion"
+                    % type(src_expansion).__name__)
+
+        from sumpy.tools import mi_factorial
+        from pytools import generate_nonnegative_integer_tuples_below as gnitb
+        from sumpy.expansion import TranslationTermTable
+
+        # This mirrors translate_from(). After simplification, the
+        # contribution of source coefficient *src_mi* to full target
+        # coefficient *tgt_mi* is d**(tgt_mi-src_mi)/(tgt_mi-src_mi)!, and
+        # the rscales separate into a factor depending only on the source and
+        # one depending only on the target coefficient.
+
+        src_mi_to_index = dict((mi, i) for i, mi in enumerate(
+            src_expansion.get_coefficient_identifiers()))
+
+        coeff_matrix = self._get_numeric_coefficient_matrix()
+
+        terms = defaultdict(lambda: 0)
+        for i, tgt_mi in enumerate(self.get_full_coefficient_identifiers()):
+            tgt_mi_plus_one = tuple(mi_i + 1 for mi_i in tgt_mi)
+
+            for src_mi in gnitb(tgt_mi_plus_one):
+                try:
+                    src_index = src_mi_to_index[src_mi]
+                except KeyError:
+                    # Omitted coefficients: not life-threatening
+                    continue
+
+                d_exponent = tuple(n - k for n, k in zip(tgt_mi, src_mi))
+                contrib = 1 / mi_factorial(d_exponent)
+
+                for tgt_index, val in coeff_matrix[i]:
+                    terms[tgt_index, src_index, d_exponent] += val * contrib
+
+        if self.use_rscale:
+            src_rscale_exponents = [
+                    sum(mi) for mi in src_expansion.get_coefficient_identifiers()]
+            tgt_rscale_exponents = [
+                    -sum(mi) for mi in self.get_coefficient_identifiers()]
+        else:
+            src_rscale_exponents = [0] * len(src_expansion)
+            tgt_rscale_exponents = [0] * len(self)
+
+        return TranslationTermTable(self.dim, len(self), terms,
+                src_rscale_exponents, tgt_rscale_exponents)
+
 
 class VolumeTaylorMultipoleExpansion(
         VolumeTaylorExpansion,
@@ -215,6 +289,11 @@ class HelmholtzConformingVolumeTaylorMultipoleExpansion(
         HelmholtzConformingVolumeTaylorExpansion,
         VolumeTaylorMultipoleExpansionBase):
 
+    # The Helmholtz recurrence expresses derivatives in terms of derivatives
+    # of lower degree, so that stored coefficients receive contributions from
+    # the coefficients of higher degree that are not stored.
+    is_prefix_truncatable = False
+
     def __init__(self, kernel, order, use_rscale=None):
         VolumeTaylorMultipoleExpansionBase.__init__(self, kernel, order, use_rscale)
         HelmholtzConformingVolumeTaylorExpansion.__init__(
@@ -232,7 +311,7 @@ class _HankelBased2DMultipoleExpansion(MultipoleExpansionBase):
     def get_coefficient_identifiers(self):
         return list(range(-self.order, self.order+1))
 
-    def coefficients_from_source(self, avec, bvec, rscale):
+    def coefficients_from_source(self, avec, bvec, rscale, sac=None):
         if not self.use_rscale:
             rscale = 1
 
@@ -252,7 +331,7 @@ class _HankelBased2DMultipoleExpansion(MultipoleExpansionBase):
                     avec)
                 for l in self.get_coefficient_identifiers()]
 
-    def evaluate(self, coeffs, bvec, rscale):
+    def evaluate(self, coeffs, bvec, rscale, sac=None):
         if not self.use_rscale:
             rscale = 1
 
@@ -271,7 +350,7 @@ class _HankelBased2DMultipoleExpansion(MultipoleExpansionBase):
                 for l in self.get_coefficient_identifiers())
 
     def translate_from(self, src_expansion, src_coeff_exprs, src_rscale,
-            dvec, tgt_rscale):
+            dvec, tgt_rscale, sac=None):
         if not isinstance(src_expansion, type(self)):
             raise RuntimeError("do not know how to translate %s to %s"
                                % (type(src_expansion).__name__,
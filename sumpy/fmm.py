@@ -26,11 +26,14 @@ __doc__ = """Integrates :mod:`boxtree` with :mod:`sumpy`.
 
 .. autoclass:: SumpyExpansionWranglerCodeContainer
 .. autoclass:: SumpyExpansionWrangler
+.. autofunction:: drive_sumpy_fmm
+.. autoclass:: IncrementalFMMDriver
 """
 
 
 from six.moves import zip
 
+import numpy as np
 import pyopencl as cl
 import pyopencl.array  # noqa
 
@@ -39,8 +42,10 @@ from pytools import memoize_method
 from sumpy import (
         P2EFromSingleBox, P2EFromCSR,
         E2PFromSingleBox, E2PFromCSR,
+        E2PFromSingleBoxAndP2PFromCSR,
         P2PFromCSR,
-        E2EFromCSR, E2EFromChildren, E2EFromParent)
+        E2EFromCSR, E2EFromChildren, E2EFromParent,
+        E2EFromChildrenLooped, E2EFromParentLooped)
 
 
 def level_to_rscale(tree, level):
@@ -64,7 +69,10 @@ class SumpyExpansionWranglerCodeContainer(object):
     def __init__(self, cl_context,
             multipole_expansion_factory,
             local_expansion_factory,
-            out_kernels, exclude_self=False, use_rscale=None):
+            out_kernels, exclude_self=False, use_rscale=None,
+            looped_translations=False, fused_l2p_p2p=False,
+            reorder_in_kernels=False, compact_expansions=False,
+            expansion_layout="box_major"):
         """
         :arg multipole_expansion_factory: a callable of a single argument (order)
             that returns a multipole expansion.
@@ -72,12 +80,54 @@ class SumpyExpansionWranglerCodeContainer(object):
             that returns a local expansion.
         :arg out_kernels: a list of output kernels
         :arg exclude_self: whether the self contribution should be excluded
+        :arg looped_translations: if *True*, use
+            :class:`sumpy.e2e.E2EFromChildrenLooped` and
+            :class:`sumpy.e2e.E2EFromParentLooped` for multipole-to-multipole
+            and local-to-local translations. This keeps the size of the
+            generated code independent of the order, but requires Taylor
+            expansions with numeric coefficient matrices.
+        :arg fused_l2p_p2p: if *True*, evaluate the local expansions and the
+            direct interactions with the neighbor source boxes ("list 1") in
+            a single pass over the targets, using
+            :class:`sumpy.e2p.E2PFromSingleBoxAndP2PFromCSR`, through
+            :meth:`SumpyExpansionWrangler.eval_locals_and_direct`. Only
+            :func:`drive_sumpy_fmm` and :class:`IncrementalFMMDriver` make
+            use of this, :func:`boxtree.fmm.drive_fmm` evaluates both stages
+            separately.
+        :arg reorder_in_kernels: if *True*, the kernels read source strengths
+            and write potentials in user order, through the tree's
+            permutation indices, so that
+            :meth:`SumpyExpansionWrangler.reorder_sources` and
+            :meth:`SumpyExpansionWrangler.reorder_potentials` need not
+            create reordered copies.
+        :arg compact_expansions: if *True*, store multipole expansions only
+            for boxes containing sources and local expansions only for boxes
+            containing targets, so that expansion storage scales with the
+            number of occupied boxes. The expansion arrays are then indexed
+            through per-box slot numbers (see
+            :meth:`SumpyExpansionWrangler.multipole_box_slots`) rather than
+            by box number.
+        :arg expansion_layout: the memory layout of the expansions of each
+            level, see :func:`sumpy.tools.parse_expansion_layout`. Other
+            than with ``"box_major"``, the arrays returned by
+            :meth:`SumpyExpansionWrangler.multipole_expansions_view` and
+            :meth:`SumpyExpansionWrangler.local_expansions_view` are not
+            C-contiguous, and in the blocked layout, they have the shape
+            ``(nblocks, block_size, ncoeffs)``.
         """
         self.multipole_expansion_factory = multipole_expansion_factory
         self.local_expansion_factory = local_expansion_factory
         self.out_kernels = out_kernels
         self.exclude_self = exclude_self
         self.use_rscale = use_rscale
+        self.looped_translations = looped_translations
+        self.fused_l2p_p2p = fused_l2p_p2p
+        self.reorder_in_kernels = reorder_in_kernels
+        self.compact_expansions = compact_expansions
+
+        from sumpy.tools import parse_expansion_layout
+        parse_expansion_layout(expansion_layout)
+        self.expansion_layout = expansion_layout
 
         self.cl_context = cl_context
 
@@ -94,57 +144,150 @@ class SumpyExpansionWranglerCodeContainer(object):
     def local_expansion(self, order):
         return self.local_expansion_factory(order, self.use_rscale)
 
+    def _truncated_coeff_indices(self, expansion_getter, order, trunc_order):
+        """Return the indices of the coefficients of the expansion of order
+        *order* that make up its truncation to order *trunc_order*, or *None*
+        if *trunc_order* is *None*.
+        """
+        if trunc_order is None:
+            return None
+
+        return tuple(range(len(expansion_getter(trunc_order))))
+
     @memoize_method
-    def p2m(self, tgt_order):
+    def p2m(self, tgt_order, tgt_trunc_order=None):
         return P2EFromSingleBox(self.cl_context,
-                self.multipole_expansion(tgt_order))
+                self.multipole_expansion(tgt_order),
+                coeff_indices=self._truncated_coeff_indices(
+                    self.multipole_expansion, tgt_order, tgt_trunc_order),
+                strengths_in_user_order=self.reorder_in_kernels,
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout)
 
     @memoize_method
-    def p2l(self, tgt_order):
+    def p2l(self, tgt_order, tgt_trunc_order=None):
         return P2EFromCSR(self.cl_context,
-                self.local_expansion(tgt_order))
+                self.local_expansion(tgt_order),
+                coeff_indices=self._truncated_coeff_indices(
+                    self.local_expansion, tgt_order, tgt_trunc_order),
+                strengths_in_user_order=self.reorder_in_kernels,
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout,
+                accumulate_output=True)
 
     @memoize_method
-    def m2m(self, src_order, tgt_order):
+    def m2m(self, src_order, tgt_order, tgt_trunc_order=None):
+        if self.looped_translations:
+            # Looped translations always compute all coefficients.
+            return E2EFromChildrenLooped(self.cl_context,
+                    self.multipole_expansion(src_order),
+                    self.multipole_expansion(tgt_order),
+                    compact_expansions=self.compact_expansions,
+                    expansion_layout=self.expansion_layout)
+
         return E2EFromChildren(self.cl_context,
                 self.multipole_expansion(src_order),
-                self.multipole_expansion(tgt_order))
+                self.multipole_expansion(tgt_order),
+                tgt_coeff_indices=self._truncated_coeff_indices(
+                    self.multipole_expansion, tgt_order, tgt_trunc_order),
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout)
+
+    def _truncated_storage_ncoeffs(self, expansion_getter, order, trunc_order):
+        """Return the number of coefficients of the expansion of order
+        *order*, in which that of order *trunc_order* is stored, or *None*
+        if *trunc_order* is *None*.
+        """
+        if trunc_order is None:
+            return None
+
+        return len(expansion_getter(order))
 
     @memoize_method
-    def m2l(self, src_order, tgt_order):
+    def m2l(self, src_order, tgt_order, tgt_trunc_order=None,
+            src_trunc_order=None):
         return E2EFromCSR(self.cl_context,
-                self.multipole_expansion(src_order),
-                self.local_expansion(tgt_order))
+                self.multipole_expansion(
+                    src_order if src_trunc_order is None else src_trunc_order),
+                self.local_expansion(tgt_order),
+                tgt_coeff_indices=self._truncated_coeff_indices(
+                    self.local_expansion, tgt_order, tgt_trunc_order),
+                src_storage_ncoeffs=self._truncated_storage_ncoeffs(
+                    self.multipole_expansion, src_order, src_trunc_order),
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout,
+                accumulate_output=True)
 
     @memoize_method
-    def l2l(self, src_order, tgt_order):
+    def l2l(self, src_order, tgt_order, tgt_trunc_order=None):
+        if self.looped_translations:
+            # Looped translations always compute all coefficients.
+            return E2EFromParentLooped(self.cl_context,
+                    self.local_expansion(src_order),
+                    self.local_expansion(tgt_order),
+                    compact_expansions=self.compact_expansions,
+                    expansion_layout=self.expansion_layout)
+
         return E2EFromParent(self.cl_context,
                 self.local_expansion(src_order),
-                self.local_expansion(tgt_order))
+                self.local_expansion(tgt_order),
+                tgt_coeff_indices=self._truncated_coeff_indices(
+                    self.local_expansion, tgt_order, tgt_trunc_order),
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout)
 
     @memoize_method
-    def m2p(self, src_order):
+    def m2p(self, src_order, src_trunc_order=None):
         return E2PFromCSR(self.cl_context,
-                self.multipole_expansion(src_order),
-                self.out_kernels)
+                self.multipole_expansion(
+                    src_order if src_trunc_order is None else src_trunc_order),
+                self.out_kernels,
+                src_storage_ncoeffs=self._truncated_storage_ncoeffs(
+                    self.multipole_expansion, src_order, src_trunc_order),
+                result_in_user_order=self.reorder_in_kernels,
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout)
 
     @memoize_method
     def l2p(self, src_order):
         return E2PFromSingleBox(self.cl_context,
                 self.local_expansion(src_order),
-                self.out_kernels)
+                self.out_kernels,
+                result_in_user_order=self.reorder_in_kernels,
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout,
+                accumulate_output=True)
+
+    @memoize_method
+    def l2p_and_p2p(self, src_order):
+        return E2PFromSingleBoxAndP2PFromCSR(self.cl_context,
+                self.local_expansion(src_order),
+                self.out_kernels,
+                exclude_self=self.exclude_self,
+                strengths_in_user_order=self.reorder_in_kernels,
+                result_in_user_order=self.reorder_in_kernels,
+                compact_expansions=self.compact_expansions,
+                expansion_layout=self.expansion_layout,
+                accumulate_output=True)
 
     @memoize_method
     def p2p(self):
         return P2PFromCSR(self.cl_context, self.out_kernels,
-                          exclude_self=self.exclude_self)
+                          exclude_self=self.exclude_self,
+                          strengths_in_user_order=self.reorder_in_kernels,
+                          result_in_user_order=self.reorder_in_kernels)
 
     def get_wrangler(self, queue, tree, dtype, fmm_level_to_order,
             source_extra_kwargs={},
             kernel_extra_kwargs=None,
-            self_extra_kwargs=None):
+            self_extra_kwargs=None,
+            box_order_finder=None, pair_order_finder=None,
+            direct_evaluation_selector=None):
         return SumpyExpansionWrangler(self, queue, tree, dtype, fmm_level_to_order,
-                source_extra_kwargs, kernel_extra_kwargs, self_extra_kwargs)
+                source_extra_kwargs, kernel_extra_kwargs, self_extra_kwargs,
+                box_order_finder=box_order_finder,
+                pair_order_finder=pair_order_finder,
+                direct_evaluation_selector=direct_evaluation_selector)
 
 # }}}
 
@@ -199,6 +342,31 @@ class SumpyTimingFuture(object):
 
 # {{{ expansion wrangler
 
+def _csr_row_indices(starts, rows):
+    """Return a tuple *(new_starts, list_indices)* describing the rows *rows*
+    of the "compressed sparse row" structure with (host) *starts*, where
+    *list_indices* are the indices of their entries in the list.
+    """
+    counts = starts[rows + 1] - starts[rows]
+    new_starts = np.zeros(len(rows) + 1, dtype=starts.dtype)
+    np.cumsum(counts, out=new_starts[1:])
+
+    list_indices = (
+            np.repeat(starts[rows] - new_starts[:-1], counts)
+            + np.arange(new_starts[-1]))
+
+    return new_starts, list_indices
+
+
+def _restrict_boxes(level_starts, boxes, keep):
+    """Return the level starts and entries of the level-sorted *boxes* for
+    which *keep* is set.
+    """
+    kept_cumul = np.zeros(len(boxes) + 1, dtype=level_starts.dtype)
+    np.cumsum(keep, out=kept_cumul[1:])
+    return kept_cumul[level_starts], boxes[keep]
+
+
 class SumpyExpansionWrangler(object):
     """Implements the :class:`boxtree.fmm.ExpansionWranglerInterface`
     by using :mod:`sumpy` expansions/translations.
@@ -218,12 +386,69 @@ class SumpyExpansionWrangler(object):
         Keyword arguments to be passed for handling
         self interactions (source and target particles are the same),
         provided special handling is needed
+
+    The methods producing potentials (:meth:`eval_direct`,
+    :meth:`eval_multipoles`, :meth:`eval_locals`) and local expansions
+    (:meth:`multipole_to_local`, :meth:`form_locals`) accept an optional
+    keyword argument *output*. If it is given, the result is added into it
+    (an array as returned by :meth:`output_zeros` or
+    :meth:`local_expansion_zeros`, respectively) and *output* is returned,
+    so that a driver can accumulate all stages into one array instead of
+    allocating and summing one array per stage.
+
+    .. attribute:: level_orders
+
+        The expansion order of each level, as given by *fmm_level_to_order*.
+        Expansions are stored with these orders.
+
+    .. attribute:: multipole_box_orders
+
+        If a *box_order_finder* was given, an array (on the host) of the
+        order to which the multipole expansion of each box is truncated,
+        at most that of its level. Set by :meth:`update_box_orders`.
+        Otherwise *None*.
+
+    .. attribute:: local_box_orders
+
+        Like :attr:`multipole_box_orders`, for local expansions.
+
+    .. automethod:: update_box_orders
     """
 
     def __init__(self, code_container, queue, tree, dtype, fmm_level_to_order,
             source_extra_kwargs,
             kernel_extra_kwargs=None,
-            self_extra_kwargs=None):
+            self_extra_kwargs=None,
+            box_order_finder=None, pair_order_finder=None,
+            direct_evaluation_selector=None):
+        """
+        :arg box_order_finder: if not *None*, a callable that, given a
+            :class:`boxtree.Tree` on the host, :attr:`level_orders` and the
+            absolute source strengths in tree order (on the host), returns a
+            tuple *(mpole_box_orders, local_box_orders)*, for example a
+            :class:`sumpy.expansion.level_to_order.StrengthBasedBoxOrderFinder`.
+            Expansions of boxes with an order below that of their level are
+            then formed only up to that order, with their trailing
+            coefficients left zero. Requires expansions for which
+            :attr:`sumpy.expansion.ExpansionBase.is_prefix_truncatable`
+            holds.
+        :arg pair_order_finder: if not *None*, a callable like
+            :class:`sumpy.expansion.level_to_order.SeparationBasedPairOrderFinder`
+            giving the order to which each multipole expansion is truncated
+            in each of its interactions with a target box (in
+            :meth:`multipole_to_local` and :meth:`eval_multipoles`). Only the
+            leading coefficients of the stored expansions are then used.
+            Requires multipole expansions for which
+            :attr:`sumpy.expansion.ExpansionBase.is_prefix_truncatable`
+            holds.
+        :arg direct_evaluation_selector: if not *None*, a callable like
+            :class:`sumpy.cost.DirectEvaluationSelector` choosing the
+            interactions of lists 3 and 4 that are evaluated directly from
+            the source particles instead of through M2P and P2L. The source
+            strengths must then be passed to :meth:`eval_multipoles` and an
+            array of potentials to :meth:`form_locals` to receive the direct
+            list 4 interactions, as :func:`drive_sumpy_fmm` does.
+        """
         self.code = code_container
         self.queue = queue
         self.tree = tree
@@ -246,6 +471,25 @@ class SumpyExpansionWrangler(object):
                 fmm_level_to_order(base_kernel, kernel_arg_set, tree, lev)
                 for lev in range(tree.nlevels)]
 
+        truncated_expansions = []
+        if box_order_finder is not None or pair_order_finder is not None:
+            truncated_expansions.append(
+                    code_container.multipole_expansion(self.level_orders[0]))
+        if box_order_finder is not None:
+            truncated_expansions.append(
+                    code_container.local_expansion(self.level_orders[0]))
+
+        for expn in truncated_expansions:
+            if not expn.is_prefix_truncatable:
+                raise ValueError("truncated expansion orders are not supported "
+                        "for expansions of type '%s'" % type(expn).__name__)
+
+        self.box_order_finder = box_order_finder
+        self.pair_order_finder = pair_order_finder
+        self.direct_evaluation_selector = direct_evaluation_selector
+        self.multipole_box_orders = None
+        self.local_box_orders = None
+
         self.source_extra_kwargs = source_extra_kwargs
         self.kernel_extra_kwargs = kernel_extra_kwargs
         self.self_extra_kwargs = self_extra_kwargs
@@ -253,31 +497,101 @@ class SumpyExpansionWrangler(object):
         self.extra_kwargs = source_extra_kwargs.copy()
         self.extra_kwargs.update(self.kernel_extra_kwargs)
 
+        # see _get_cached_for_arrays
+        self.array_derived_cache = {}
+
     # {{{ data vector utilities
 
-    def _expansions_level_starts(self, order_to_size):
-        result = [0]
+    def _box_slots(self, box_counts_cumul):
+        """Number the boxes of each level for which *box_counts_cumul* is
+        nonzero consecutively. All other boxes of the level share the
+        level's last slot, whose expansion is never written and stays zero.
+
+        :returns: a tuple *(box_slots, level_nslots)*.
+        """
+        from sumpy.tools import _to_host
+        box_counts_cumul = _to_host(box_counts_cumul, self.queue)
+
+        box_slots = np.empty(self.tree.nboxes, dtype=np.int32)
+        level_nslots = []
+
         for lev in range(self.tree.nlevels):
-            lev_nboxes = (
+            start, stop = self.tree.level_start_box_nrs[lev:lev+2]
+            occupied = box_counts_cumul[start:stop] > 0
+            noccupied = int(np.count_nonzero(occupied))
+
+            box_slots[start:stop] = np.where(
+                    occupied, np.cumsum(occupied) - 1, noccupied)
+            level_nslots.append(noccupied + 1)
+
+        return cl.array.to_device(self.queue, box_slots), level_nslots
+
+    @memoize_method
+    def multipole_box_slots(self):
+        """Return a tuple *(box_slots, level_nslots)*, where *box_slots* gives,
+        for each box, the row of its multipole expansion in the multipole
+        expansions of its level, and *level_nslots* gives the number of such
+        rows for each level. Only boxes containing sources have a row of
+        their own. Only used with *compact_expansions* (see
+        :class:`SumpyExpansionWranglerCodeContainer`).
+        """
+        return self._box_slots(self.tree.box_source_counts_cumul)
+
+    @memoize_method
+    def local_box_slots(self):
+        """Like :meth:`multipole_box_slots`, for local expansions. Only boxes
+        containing targets have a row of their own.
+        """
+        return self._box_slots(self.tree.box_target_counts_cumul)
+
+    def _expansions_level_nrows(self, box_slots_getter):
+        if self.code.compact_expansions:
+            _, level_nrows = box_slots_getter()
+        else:
+            level_nrows = [
                     self.tree.level_start_box_nrs[lev+1]
-                    - self.tree.level_start_box_nrs[lev])
+                    - self.tree.level_start_box_nrs[lev]
+                    for lev in range(self.tree.nlevels)]
+
+        from sumpy.tools import parse_expansion_layout
+        _, block_size = parse_expansion_layout(self.code.expansion_layout)
+        if block_size is not None:
+            # pad to a whole number of blocks
+            level_nrows = [
+                    -(-nrows // block_size) * block_size
+                    for nrows in level_nrows]
 
+        return level_nrows
+
+    def _expansions_level_starts(self, order_to_size, level_nrows):
+        result = [0]
+        for lev in range(self.tree.nlevels):
             expn_size = order_to_size(self.level_orders[lev])
             result.append(
                     result[-1]
-                    + expn_size * lev_nboxes)
+                    + expn_size * level_nrows[lev])
 
         return result
 
+    @memoize_method
+    def multipole_expansions_level_nrows(self):
+        return self._expansions_level_nrows(self.multipole_box_slots)
+
+    @memoize_method
+    def local_expansions_level_nrows(self):
+        return self._expansions_level_nrows(self.local_box_slots)
+
     @memoize_method
     def multipole_expansions_level_starts(self):
         return self._expansions_level_starts(
-                lambda order: len(self.code.multipole_expansion_factory(order)))
+                lambda order: len(self.code.multipole_expansion_factory(order)),
+                self.multipole_expansions_level_nrows())
 
     @memoize_method
     def local_expansions_level_starts(self):
         return self._expansions_level_starts(
-                lambda order: len(self.code.local_expansion_factory(order)))
+                lambda order: len(self.code.local_expansion_factory(order)),
+                self.local_expansions_level_nrows())
 
     def multipole_expansion_zeros(self):
         return cl.array.zeros(
@@ -291,21 +605,56 @@ class SumpyExpansionWrangler(object):
                 self.local_expansions_level_starts()[-1],
                 dtype=self.dtype)
 
+    def _expansions_view(self, level_exps, nrows):
+        from sumpy.tools import parse_expansion_layout
+        kind, block_size = parse_expansion_layout(self.code.expansion_layout)
+
+        if kind == "box_major":
+            return level_exps.reshape(nrows, -1)
+        elif kind == "coeff_major":
+            return level_exps.reshape(nrows, -1, order="F")
+        else:
+            return (level_exps
+                    .reshape(nrows // block_size, -1, block_size)
+                    .transpose((0, 2, 1)))
+
     def multipole_expansions_view(self, mpole_exps, level):
         expn_start, expn_stop = \
                 self.multipole_expansions_level_starts()[level:level+2]
-        box_start, box_stop = self.tree.level_start_box_nrs[level:level+2]
+        box_start = self.tree.level_start_box_nrs[level]
+        nrows = self.multipole_expansions_level_nrows()[level]
 
         return (box_start,
-                mpole_exps[expn_start:expn_stop].reshape(box_stop-box_start, -1))
+                self._expansions_view(mpole_exps[expn_start:expn_stop], nrows))
 
     def local_expansions_view(self, local_exps, level):
         expn_start, expn_stop = \
                 self.local_expansions_level_starts()[level:level+2]
-        box_start, box_stop = self.tree.level_start_box_nrs[level:level+2]
+        box_start = self.tree.level_start_box_nrs[level]
+        nrows = self.local_expansions_level_nrows()[level]
 
         return (box_start,
-                local_exps[expn_start:expn_stop].reshape(box_stop-box_start, -1))
+                self._expansions_view(local_exps[expn_start:expn_stop], nrows))
+
+    def multipole_slot_kwargs(self, prefix):
+        """Return the arguments needed by kernels that access the multipole
+        expansions as *prefix* (``"src"`` or ``"tgt"``) expansions when
+        *compact_expansions* is set (see
+        :class:`SumpyExpansionWranglerCodeContainer`).
+        """
+        if not self.code.compact_expansions:
+            return {}
+
+        box_slots, _ = self.multipole_box_slots()
+        return {"%s_box_slots" % prefix: box_slots}
+
+    def local_slot_kwargs(self, prefix):
+        """Like :meth:`multipole_slot_kwargs`, for local expansions."""
+        if not self.code.compact_expansions:
+            return {}
+
+        box_slots, _ = self.local_box_slots()
+        return {"%s_box_slots" % prefix: box_slots}
 
     def output_zeros(self):
         from pytools.obj_array import make_obj_array
@@ -317,12 +666,18 @@ class SumpyExpansionWrangler(object):
                 for k in self.code.out_kernels])
 
     def reorder_sources(self, source_array):
+        if self.code.reorder_in_kernels:
+            return source_array.with_queue(self.queue)
+
         return source_array.with_queue(self.queue)[self.tree.user_source_ids]
 
     def reorder_potentials(self, potentials):
         from pytools.obj_array import is_obj_array, with_object_array_or_scalar
         assert is_obj_array(potentials)
 
+        if self.code.reorder_in_kernels:
+            return potentials
+
         def reorder(x):
             return x.with_queue(self.queue)[self.tree.sorted_target_ids]
 
@@ -348,20 +703,351 @@ class SumpyExpansionWrangler(object):
                 box_target_counts_nonchild=self.tree.box_target_counts_nonchild,
                 targets=self.tree.targets)
 
+    def source_reordering_kwargs(self):
+        """Return the arguments needed by kernels that read source strengths
+        in user order (see *reorder_in_kernels* in
+        :class:`SumpyExpansionWranglerCodeContainer`).
+        """
+        if not self.code.reorder_in_kernels:
+            return {}
+
+        return dict(user_source_ids=self.tree.user_source_ids)
+
+    def target_reordering_kwargs(self):
+        """Return the arguments needed by kernels that write potentials in
+        user order (see *reorder_in_kernels* in
+        :class:`SumpyExpansionWranglerCodeContainer`).
+        """
+        if not self.code.reorder_in_kernels:
+            return {}
+
+        return dict(user_target_ids=self.user_target_ids())
+
+    @memoize_method
+    def user_target_ids(self):
+        """Return the index in user order of each target in tree order, i.e.
+        the inverse of the permutation :attr:`boxtree.Tree.sorted_target_ids`.
+        """
+        sorted_target_ids = self.tree.sorted_target_ids
+        user_target_ids = cl.array.empty(
+                self.queue, self.tree.ntargets, dtype=sorted_target_ids.dtype)
+        cl.array.multi_put(
+                [cl.array.arange(self.queue, self.tree.ntargets,
+                    dtype=sorted_target_ids.dtype)],
+                sorted_target_ids, out=[user_target_ids], queue=self.queue)
+
+        return user_target_ids
+
+    # }}}
+
+    # {{{ caching of data derived from interaction lists
+
+    def _get_cached_for_arrays(self, key, arrays, compute):
+        """Return ``compute()``, reusing the result of the last call with
+        the same *key* if it was made with the same *arrays*, i.e. views of
+        the same memory (such as the same slices of the traversal's arrays).
+        The arrays must not be modified in between.
+
+        One result is kept per *key*, along with the arrays it was computed
+        from, so that their memory cannot be reused by other arrays.
+        """
+        def identity(ary):
+            if isinstance(ary, cl.array.Array):
+                return (getattr(ary.base_data, "int_ptr", None), ary.offset,
+                        ary.shape, ary.strides)
+            else:
+                return (ary.__array_interface__["data"][0],
+                        ary.shape, ary.strides)
+
+        arrays_identity = [identity(ary) for ary in arrays]
+
+        try:
+            cached_identity, _, result = self.array_derived_cache[key]
+        except KeyError:
+            pass
+        else:
+            if cached_identity == arrays_identity:
+                return result
+
+        result = compute()
+        self.array_derived_cache[key] = (arrays_identity, arrays, result)
+        return result
+
+    # }}}
+
+    # {{{ per-box orders
+
+    @memoize_method
+    def _host_tree(self):
+        return self.tree.get(queue=self.queue)
+
+    def update_box_orders(self, src_weights):
+        """Set :attr:`multipole_box_orders` and :attr:`local_box_orders` from
+        the source strengths *src_weights* (as passed to
+        :meth:`form_multipoles`) using the *box_order_finder*, if any.
+        Called by :meth:`form_multipoles`.
+        """
+        if self.box_order_finder is None:
+            return
+
+        from sumpy.tools import _to_host
+        strengths = np.abs(_to_host(src_weights, self.queue))
+        if self.code.reorder_in_kernels:
+            strengths = strengths[self._host_tree().user_source_ids]
+
+        self.multipole_box_orders, self.local_box_orders = \
+                self.box_order_finder(
+                        self._host_tree(), self.level_orders, strengths)
+
+    def _truncation_classes(self, box_orders, boxes, level):
+        """Group the entries of *boxes*, all at *level*, by their order in
+        *box_orders*.
+
+        :returns: a list of tuples *(trunc_order, rows)*, where *rows* are
+            the indices into *boxes* of a group (or *None* for all of them)
+            and *trunc_order* is the order to which their expansions are
+            truncated (or *None* for the level's order).
+        """
+        if box_orders is None:
+            return [(None, None)]
+
+        from sumpy.tools import _to_host
+        orders = np.minimum(
+                box_orders[_to_host(boxes, self.queue)],
+                self.level_orders[level])
+
+        result = []
+        for order in np.unique(orders):
+            rows = np.nonzero(orders == order)[0]
+            result.append((
+                None if order == self.level_orders[level] else int(order),
+                None if len(rows) == len(orders) else rows))
+
+        return result
+
+    def _take_rows(self, boxes, rows):
+        if rows is None:
+            return boxes
+
+        from sumpy.tools import _to_host
+        return cl.array.to_device(
+                self.queue, _to_host(boxes, self.queue)[rows])
+
+    def _take_csr_rows(self, starts, lists, rows):
+        """Return the rows *rows* of the CSR structure *starts*, *lists* as a
+        new tuple *(starts, lists)*.
+        """
+        if rows is None:
+            return starts, lists
+
+        from sumpy.tools import _to_host
+        starts = _to_host(starts, self.queue)
+        lists = _to_host(lists, self.queue)
+
+        new_starts, list_indices = _csr_row_indices(starts, rows)
+
+        return (
+                cl.array.to_device(self.queue, new_starts),
+                cl.array.to_device(self.queue, lists[list_indices]))
+
+    def _source_truncation_classes(self, target_boxes, source_box_starts,
+            source_box_lists, source_level, rows=None):
+        """Group the interactions of the multipole expansions of the boxes
+        *source_box_lists* at *source_level* with *target_boxes* (or only
+        with the entries *rows* of *target_boxes*, if given) by the
+        order to which the multipole expansions are truncated, which is the
+        smaller of that given by the *pair_order_finder* and that in
+        :attr:`multipole_box_orders`.
+
+        :arg source_box_starts: an array of length ``len(target_boxes) + 1``
+        :returns: a list of tuples *(trunc_order, starts, lists)*, where
+            *starts* and *lists* form a "compressed sparse row" list of the
+            interactions of a group, and *trunc_order* is the order to which
+            their expansions are truncated (or *None* for the level's order).
+        """
+        if self.pair_order_finder is None and self.multipole_box_orders is None:
+            return [(None,) + self._take_csr_rows(
+                source_box_starts, source_box_lists, rows)]
+
+        # The pair orders depend only on the tree, so that they are reused
+        # by later calls with the same arrays.
+        starts, lists, orders = self._get_cached_for_arrays(
+                ("pair_orders", source_level),
+                (target_boxes, source_box_starts, source_box_lists),
+                lambda: self._get_pair_orders(
+                    target_boxes, source_box_starts, source_box_lists,
+                    source_level))
+
+        if rows is not None:
+            starts, list_indices = _csr_row_indices(starts, rows)
+            lists = lists[list_indices]
+            orders = orders[list_indices]
+
+        if self.multipole_box_orders is not None:
+            orders = np.minimum(orders, self.multipole_box_orders[lists])
+
+        level_order = self.level_orders[source_level]
+
+        result = []
+        for order in np.unique(orders):
+            class_starts, class_lists = self._mask_csr(
+                    starts, lists, orders == order)
+            result.append((
+                None if order == level_order else int(order),
+                class_starts, class_lists))
+
+        return result
+
+    def _get_pair_orders(self, target_boxes, source_box_starts,
+            source_box_lists, source_level):
+        """
+        :returns: a tuple *(starts, lists, orders)* of the interaction list
+            (on the host, with ``starts[0] == 0``) and the order given by the
+            *pair_order_finder* (or that of *source_level*) for each of its
+            entries
+        """
+        from sumpy.tools import _to_host
+        target_boxes = _to_host(target_boxes, self.queue)
+        starts = _to_host(source_box_starts, self.queue)
+        lists = _to_host(source_box_lists, self.queue)[starts[0]:starts[-1]]
+        starts = starts - starts[0]
+
+        level_order = self.level_orders[source_level]
+        orders = np.full(len(lists), level_order, dtype=np.int32)
+        if self.pair_order_finder is not None:
+            orders = np.minimum(orders, self.pair_order_finder(
+                    self._host_tree(), level_order,
+                    target_boxes, starts, lists))
+
+        return starts, lists, orders
+
+    def _mask_csr(self, starts, lists, mask):
+        """Return the entries of the CSR structure *starts*, *lists* (on the
+        host, with ``starts[0] == 0``) for which *mask* is *True*, as a new
+        tuple *(starts, lists)* on the device.
+        """
+        masked_cumul = np.zeros(len(lists) + 1, dtype=starts.dtype)
+        np.cumsum(mask, out=masked_cumul[1:])
+
+        return (
+                cl.array.to_device(self.queue, masked_cumul[starts]),
+                cl.array.to_device(self.queue, lists[mask]))
+
+    # }}}
+
+    # {{{ direct evaluation of lists 3 and 4
+
+    def _split_direct_interactions(self, stage, level, target_boxes,
+            source_box_starts, source_box_lists):
+        """Split the list 3 (if *stage* is ``"m2p"``) or list 4 (if *stage*
+        is ``"p2l"``) interactions of *target_boxes* into those to be
+        evaluated through expansions of *level* and those to be evaluated
+        directly, as chosen by the *direct_evaluation_selector*.
+
+        :arg source_box_starts: an array of length ``len(target_boxes) + 1``
+        :returns: a tuple *(expansion_csr, direct_csr)* of tuples
+            *(starts, lists)*, where *direct_csr* is *None* if no
+            interactions are to be evaluated directly.
+
+        The selection depends only on the tree, so that it is reused by later
+        calls with the same arrays.
+        """
+        if self.direct_evaluation_selector is None:
+            return (source_box_starts, source_box_lists), None
+
+        return self._get_cached_for_arrays(
+                ("direct_interactions", stage, level),
+                (target_boxes, source_box_starts, source_box_lists),
+                lambda: self._split_direct_interactions_uncached(
+                    stage, level, target_boxes,
+                    source_box_starts, source_box_lists))
+
+    def _split_direct_interactions_uncached(self, stage, level, target_boxes,
+            source_box_starts, source_box_lists):
+        from sumpy.tools import _to_host
+        target_boxes = _to_host(target_boxes, self.queue)
+        starts = _to_host(source_box_starts, self.queue)
+        lists = _to_host(source_box_lists, self.queue)[starts[0]:starts[-1]]
+        starts = starts - starts[0]
+
+        if stage == "m2p":
+            expn = self.code.multipole_expansion(self.level_orders[level])
+        else:
+            expn = self.code.local_expansion(self.level_orders[level])
+
+        direct = self.direct_evaluation_selector(
+                self._host_tree(), stage, len(expn),
+                target_boxes, starts, lists)
+
+        if not direct.any():
+            return (source_box_starts, source_box_lists), None
+
+        return (
+                self._mask_csr(starts, lists, ~direct),
+                self._mask_csr(starts, lists, direct))
+
+    def _eval_direct_interactions(self, target_boxes, source_box_starts,
+            source_box_lists, src_weights, pot, source_descendants=False,
+            target_descendants=False, wait_for=None):
+        """Add the potential of the sources in *source_box_lists* at the
+        targets in *target_boxes* to *pot*, including the particles of the
+        descendants of the source or target boxes if *source_descendants*
+        or *target_descendants* is set.
+
+        *target_boxes* must not overlap, i.e. none may be an ancestor of
+        another.
+
+        :returns: the event of the evaluation
+        """
+        kwargs = self.extra_kwargs.copy()
+        kwargs.update(self.self_extra_kwargs)
+        kwargs.update(self.box_source_list_kwargs())
+        kwargs.update(self.box_target_list_kwargs())
+        kwargs.update(self.source_reordering_kwargs())
+        kwargs.update(self.target_reordering_kwargs())
+
+        # Particles of a box and its descendants are contiguous in tree
+        # order, so that the cumulative counts delimit them.
+        if source_descendants:
+            kwargs["box_source_counts_nonchild"] = \
+                    self.tree.box_source_counts_cumul
+        if target_descendants:
+            kwargs["box_target_counts_nonchild"] = \
+                    self.tree.box_target_counts_cumul
+
+        evt, pot_res = self.code.p2p()(self.queue,
+                target_boxes=target_boxes,
+                source_box_starts=source_box_starts,
+                source_box_lists=source_box_lists,
+                strength=(src_weights,),
+                result=pot,
+
+                wait_for=wait_for,
+
+                **kwargs)
+
+        for pot_i, pot_res_i in zip(pot, pot_res):
+            assert pot_i is pot_res_i
+
+        return evt
+
     # }}}
 
     def form_multipoles(self,
             level_start_source_box_nrs, source_boxes,
             src_weights):
+        self.update_box_orders(src_weights)
+
         mpoles = self.multipole_expansion_zeros()
 
         kwargs = self.extra_kwargs.copy()
         kwargs.update(self.box_source_list_kwargs())
+        kwargs.update(self.source_reordering_kwargs())
+        kwargs.update(self.multipole_slot_kwargs("tgt"))
 
         events = []
 
         for lev in range(self.tree.nlevels):
-            p2m = self.code.p2m(self.level_orders[lev])
             start, stop = level_start_source_box_nrs[lev:lev+2]
             if start == stop:
                 continue
@@ -369,20 +1055,25 @@ class SumpyExpansionWrangler(object):
             level_start_ibox, mpoles_view = self.multipole_expansions_view(
                     mpoles, lev)
 
-            evt, (mpoles_res,) = p2m(
-                    self.queue,
-                    source_boxes=source_boxes[start:stop],
-                    centers=self.tree.box_centers,
-                    strengths=src_weights,
-                    tgt_expansions=mpoles_view,
-                    tgt_base_ibox=level_start_ibox,
+            for trunc_order, rows in self._truncation_classes(
+                    self.multipole_box_orders, source_boxes[start:stop], lev):
+                p2m = self.code.p2m(self.level_orders[lev], trunc_order)
 
-                    rscale=level_to_rscale(self.tree, lev),
+                evt, (mpoles_res,) = p2m(
+                        self.queue,
+                        source_boxes=self._take_rows(
+                            source_boxes[start:stop], rows),
+                        centers=self.tree.box_centers,
+                        strengths=src_weights,
+                        tgt_expansions=mpoles_view,
+                        tgt_base_ibox=level_start_ibox,
 
-                    **kwargs)
-            events.append(evt)
+                        rscale=level_to_rscale(self.tree, lev),
+
+                        **kwargs)
+                events.append(evt)
 
-            assert mpoles_res is mpoles_view
+                assert mpoles_res is mpoles_view
 
         return (mpoles, SumpyTimingFuture(self.queue, events))
 
@@ -392,6 +1083,10 @@ class SumpyExpansionWrangler(object):
             mpoles):
         tree = self.tree
 
+        kwargs = self.kernel_extra_kwargs.copy()
+        kwargs.update(self.multipole_slot_kwargs("src"))
+        kwargs.update(self.multipole_slot_kwargs("tgt"))
+
         events = []
 
         # nlevels-1 is the last valid level index
@@ -410,33 +1105,38 @@ class SumpyExpansionWrangler(object):
                 print("source", source_level, "empty")
                 continue
 
-            m2m = self.code.m2m(
-                    self.level_orders[source_level],
-                    self.level_orders[target_level])
-
             source_level_start_ibox, source_mpoles_view = \
                     self.multipole_expansions_view(mpoles, source_level)
             target_level_start_ibox, target_mpoles_view = \
                     self.multipole_expansions_view(mpoles, target_level)
 
-            evt, (mpoles_res,) = m2m(
-                    self.queue,
-                    src_expansions=source_mpoles_view,
-                    src_base_ibox=source_level_start_ibox,
-                    tgt_expansions=target_mpoles_view,
-                    tgt_base_ibox=target_level_start_ibox,
+            for trunc_order, rows in self._truncation_classes(
+                    self.multipole_box_orders,
+                    source_parent_boxes[start:stop], target_level):
+                m2m = self.code.m2m(
+                        self.level_orders[source_level],
+                        self.level_orders[target_level],
+                        trunc_order)
 
-                    target_boxes=source_parent_boxes[start:stop],
-                    box_child_ids=self.tree.box_child_ids,
-                    centers=self.tree.box_centers,
+                evt, (mpoles_res,) = m2m(
+                        self.queue,
+                        src_expansions=source_mpoles_view,
+                        src_base_ibox=source_level_start_ibox,
+                        tgt_expansions=target_mpoles_view,
+                        tgt_base_ibox=target_level_start_ibox,
 
-                    src_rscale=level_to_rscale(self.tree, source_level),
-                    tgt_rscale=level_to_rscale(self.tree, target_level),
+                        target_boxes=self._take_rows(
+                            source_parent_boxes[start:stop], rows),
+                        box_child_ids=self.tree.box_child_ids,
+                        centers=self.tree.box_centers,
 
-                    **self.kernel_extra_kwargs)
-            events.append(evt)
+                        src_rscale=level_to_rscale(self.tree, source_level),
+                        tgt_rscale=level_to_rscale(self.tree, target_level),
+
+                        **kwargs)
+                events.append(evt)
 
-            assert mpoles_res is target_mpoles_view
+                assert mpoles_res is target_mpoles_view
 
         if events:
             mpoles.add_event(events[-1])
@@ -444,13 +1144,15 @@ class SumpyExpansionWrangler(object):
         return (mpoles, SumpyTimingFuture(self.queue, events))
 
     def eval_direct(self, target_boxes, source_box_starts,
-            source_box_lists, src_weights):
-        pot = self.output_zeros()
+            source_box_lists, src_weights, output=None):
+        pot = self.output_zeros() if output is None else output
 
         kwargs = self.extra_kwargs.copy()
         kwargs.update(self.self_extra_kwargs)
         kwargs.update(self.box_source_list_kwargs())
         kwargs.update(self.box_target_list_kwargs())
+        kwargs.update(self.source_reordering_kwargs())
+        kwargs.update(self.target_reordering_kwargs())
 
         events = []
 
@@ -473,8 +1175,12 @@ class SumpyExpansionWrangler(object):
     def multipole_to_local(self,
             level_start_target_box_nrs,
             target_boxes, src_box_starts, src_box_lists,
-            mpole_exps):
-        local_exps = self.local_expansion_zeros()
+            mpole_exps, output=None):
+        local_exps = self.local_expansion_zeros() if output is None else output
+
+        kwargs = self.kernel_extra_kwargs.copy()
+        kwargs.update(self.multipole_slot_kwargs("src"))
+        kwargs.update(self.local_slot_kwargs("tgt"))
 
         events = []
 
@@ -484,40 +1190,62 @@ class SumpyExpansionWrangler(object):
                 continue
 
             order = self.level_orders[lev]
-            m2l = self.code.m2l(order, order)
 
             source_level_start_ibox, source_mpoles_view = \
                     self.multipole_expansions_view(mpole_exps, lev)
             target_level_start_ibox, target_local_exps_view = \
                     self.local_expansions_view(local_exps, lev)
 
-            evt, (local_exps_res,) = m2l(
-                    self.queue,
+            for trunc_order, rows in self._truncation_classes(
+                    self.local_box_orders, target_boxes[start:stop], lev):
 
-                    src_expansions=source_mpoles_view,
-                    src_base_ibox=source_level_start_ibox,
-                    tgt_expansions=target_local_exps_view,
-                    tgt_base_ibox=target_level_start_ibox,
+                level_target_boxes = self._take_rows(
+                        target_boxes[start:stop], rows)
 
-                    target_boxes=target_boxes[start:stop],
-                    src_box_starts=src_box_starts[start:stop],
-                    src_box_lists=src_box_lists,
-                    centers=self.tree.box_centers,
+                for src_trunc_order, class_starts, class_lists in \
+                        self._source_truncation_classes(
+                                target_boxes[start:stop],
+                                src_box_starts[start:stop+1],
+                                src_box_lists, lev, rows):
+                    m2l = self.code.m2l(
+                            order, order, trunc_order, src_trunc_order)
 
-                    src_rscale=level_to_rscale(self.tree, lev),
-                    tgt_rscale=level_to_rscale(self.tree, lev),
+                    evt, (local_exps_res,) = m2l(
+                            self.queue,
 
-                    **self.kernel_extra_kwargs)
-            events.append(evt)
+                            src_expansions=source_mpoles_view,
+                            src_base_ibox=source_level_start_ibox,
+                            tgt_expansions=target_local_exps_view,
+                            tgt_base_ibox=target_level_start_ibox,
+
+                            target_boxes=level_target_boxes,
+                            src_box_starts=class_starts,
+                            src_box_lists=class_lists,
+                            centers=self.tree.box_centers,
+
+                            src_rscale=level_to_rscale(self.tree, lev),
+                            tgt_rscale=level_to_rscale(self.tree, lev),
+
+                            **kwargs)
+                    events.append(evt)
 
         return (local_exps, SumpyTimingFuture(self.queue, events))
 
     def eval_multipoles(self,
-            target_boxes_by_source_level, source_boxes_by_level, mpole_exps):
-        pot = self.output_zeros()
+            target_boxes_by_source_level, source_boxes_by_level, mpole_exps,
+            output=None, src_weights=None):
+        """
+        :arg src_weights: the source strengths, as passed to
+            :meth:`form_multipoles`. Required if the
+            *direct_evaluation_selector* chooses to evaluate interactions
+            directly.
+        """
+        pot = self.output_zeros() if output is None else output
 
         kwargs = self.kernel_extra_kwargs.copy()
         kwargs.update(self.box_target_list_kwargs())
+        kwargs.update(self.target_reordering_kwargs())
+        kwargs.update(self.multipole_slot_kwargs("src"))
 
         events = []
 
@@ -527,34 +1255,57 @@ class SumpyExpansionWrangler(object):
             if len(target_boxes_by_source_level[isrc_level]) == 0:
                 continue
 
-            m2p = self.code.m2p(self.level_orders[isrc_level])
-
             source_level_start_ibox, source_mpoles_view = \
                     self.multipole_expansions_view(mpole_exps, isrc_level)
 
-            evt, pot_res = m2p(
-                    self.queue,
+            (level_starts, level_lists), direct_csr = \
+                    self._split_direct_interactions("m2p", isrc_level,
+                            target_boxes_by_source_level[isrc_level],
+                            ssn.starts, ssn.lists)
 
-                    src_expansions=source_mpoles_view,
-                    src_base_ibox=source_level_start_ibox,
+            if direct_csr is not None:
+                if src_weights is None:
+                    raise ValueError("src_weights must be passed to "
+                            "evaluate list 3 interactions directly")
 
-                    target_boxes=target_boxes_by_source_level[isrc_level],
-                    source_box_starts=ssn.starts,
-                    source_box_lists=ssn.lists,
-                    centers=self.tree.box_centers,
-                    result=pot,
+                evt = self._eval_direct_interactions(
+                        target_boxes_by_source_level[isrc_level],
+                        direct_csr[0], direct_csr[1],
+                        src_weights, pot,
+                        source_descendants=True, wait_for=wait_for)
+                events.append(evt)
 
-                    rscale=level_to_rscale(self.tree, isrc_level),
+                wait_for = [evt]
 
-                    wait_for=wait_for,
+            for src_trunc_order, class_starts, class_lists in \
+                    self._source_truncation_classes(
+                            target_boxes_by_source_level[isrc_level],
+                            level_starts, level_lists, isrc_level):
+                m2p = self.code.m2p(self.level_orders[isrc_level], src_trunc_order)
 
-                    **kwargs)
-            events.append(evt)
+                evt, pot_res = m2p(
+                        self.queue,
 
-            wait_for = [evt]
+                        src_expansions=source_mpoles_view,
+                        src_base_ibox=source_level_start_ibox,
 
-            for pot_i, pot_res_i in zip(pot, pot_res):
-                assert pot_i is pot_res_i
+                        target_boxes=target_boxes_by_source_level[isrc_level],
+                        source_box_starts=class_starts,
+                        source_box_lists=class_lists,
+                        centers=self.tree.box_centers,
+                        result=pot,
+
+                        rscale=level_to_rscale(self.tree, isrc_level),
+
+                        wait_for=wait_for,
+
+                        **kwargs)
+                events.append(evt)
+
+                wait_for = [evt]
+
+                for pot_i, pot_res_i in zip(pot, pot_res):
+                    assert pot_i is pot_res_i
 
         if events:
             for pot_i in pot:
@@ -564,11 +1315,20 @@ class SumpyExpansionWrangler(object):
 
     def form_locals(self,
             level_start_target_or_target_parent_box_nrs,
-            target_or_target_parent_boxes, starts, lists, src_weights):
-        local_exps = self.local_expansion_zeros()
+            target_or_target_parent_boxes, starts, lists, src_weights,
+            output=None, potentials=None):
+        """
+        :arg potentials: an array as returned by :meth:`output_zeros`, to
+            which the potentials of the interactions that the
+            *direct_evaluation_selector* chooses to evaluate directly are
+            added. Required if there are any.
+        """
+        local_exps = self.local_expansion_zeros() if output is None else output
 
         kwargs = self.extra_kwargs.copy()
         kwargs.update(self.box_source_list_kwargs())
+        kwargs.update(self.source_reordering_kwargs())
+        kwargs.update(self.local_slot_kwargs("tgt"))
 
         events = []
 
@@ -578,28 +1338,56 @@ class SumpyExpansionWrangler(object):
             if start == stop:
                 continue
 
-            p2l = self.code.p2l(self.level_orders[lev])
-
             target_level_start_ibox, target_local_exps_view = \
                     self.local_expansions_view(local_exps, lev)
 
-            evt, (result,) = p2l(
-                    self.queue,
-                    target_boxes=target_or_target_parent_boxes[start:stop],
-                    source_box_starts=starts[start:stop+1],
-                    source_box_lists=lists,
-                    centers=self.tree.box_centers,
-                    strengths=src_weights,
+            # Target boxes on one level do not overlap, so that each level
+            # can be evaluated directly in one call.
+            (level_starts, level_lists), direct_csr = \
+                    self._split_direct_interactions("p2l", lev,
+                            target_or_target_parent_boxes[start:stop],
+                            starts[start:stop+1], lists)
 
-                    tgt_expansions=target_local_exps_view,
-                    tgt_base_ibox=target_level_start_ibox,
+            if direct_csr is not None:
+                if potentials is None:
+                    raise ValueError("potentials must be passed to "
+                            "evaluate list 4 interactions directly")
 
-                    rscale=level_to_rscale(self.tree, lev),
+                evt = self._eval_direct_interactions(
+                        target_or_target_parent_boxes[start:stop],
+                        direct_csr[0], direct_csr[1], src_weights, potentials,
+                        target_descendants=True)
+                events.append(evt)
 
-                    **kwargs)
-            events.append(evt)
+                for pot_i in potentials:
+                    pot_i.add_event(evt)
 
-            assert result is target_local_exps_view
+            for trunc_order, rows in self._truncation_classes(
+                    self.local_box_orders,
+                    target_or_target_parent_boxes[start:stop], lev):
+                p2l = self.code.p2l(self.level_orders[lev], trunc_order)
+
+                class_starts, class_lists = self._take_csr_rows(
+                        level_starts, level_lists, rows)
+
+                evt, (result,) = p2l(
+                        self.queue,
+                        target_boxes=self._take_rows(
+                            target_or_target_parent_boxes[start:stop], rows),
+                        source_box_starts=class_starts,
+                        source_box_lists=class_lists,
+                        centers=self.tree.box_centers,
+                        strengths=src_weights,
+
+                        tgt_expansions=target_local_exps_view,
+                        tgt_base_ibox=target_level_start_ibox,
+
+                        rscale=level_to_rscale(self.tree, lev),
+
+                        **kwargs)
+                events.append(evt)
+
+                assert result is target_local_exps_view
 
         return (local_exps, SumpyTimingFuture(self.queue, events))
 
@@ -607,6 +1395,9 @@ class SumpyExpansionWrangler(object):
             level_start_target_or_target_parent_box_nrs,
             target_or_target_parent_boxes,
             local_exps):
+        kwargs = self.kernel_extra_kwargs.copy()
+        kwargs.update(self.local_slot_kwargs("src"))
+        kwargs.update(self.local_slot_kwargs("tgt"))
 
         events = []
 
@@ -617,42 +1408,51 @@ class SumpyExpansionWrangler(object):
                 continue
 
             source_lev = target_lev - 1
-            l2l = self.code.l2l(
-                    self.level_orders[source_lev],
-                    self.level_orders[target_lev])
 
             source_level_start_ibox, source_local_exps_view = \
                     self.local_expansions_view(local_exps, source_lev)
             target_level_start_ibox, target_local_exps_view = \
                     self.local_expansions_view(local_exps, target_lev)
 
-            evt, (local_exps_res,) = l2l(self.queue,
-                    src_expansions=source_local_exps_view,
-                    src_base_ibox=source_level_start_ibox,
-                    tgt_expansions=target_local_exps_view,
-                    tgt_base_ibox=target_level_start_ibox,
+            for trunc_order, rows in self._truncation_classes(
+                    self.local_box_orders,
+                    target_or_target_parent_boxes[start:stop], target_lev):
+                l2l = self.code.l2l(
+                        self.level_orders[source_lev],
+                        self.level_orders[target_lev],
+                        trunc_order)
 
-                    target_boxes=target_or_target_parent_boxes[start:stop],
-                    box_parent_ids=self.tree.box_parent_ids,
-                    centers=self.tree.box_centers,
+                evt, (local_exps_res,) = l2l(self.queue,
+                        src_expansions=source_local_exps_view,
+                        src_base_ibox=source_level_start_ibox,
+                        tgt_expansions=target_local_exps_view,
+                        tgt_base_ibox=target_level_start_ibox,
 
-                    src_rscale=level_to_rscale(self.tree, source_lev),
-                    tgt_rscale=level_to_rscale(self.tree, target_lev),
+                        target_boxes=self._take_rows(
+                            target_or_target_parent_boxes[start:stop], rows),
+                        box_parent_ids=self.tree.box_parent_ids,
+                        centers=self.tree.box_centers,
 
-                    **self.kernel_extra_kwargs)
-            events.append(evt)
+                        src_rscale=level_to_rscale(self.tree, source_lev),
+                        tgt_rscale=level_to_rscale(self.tree, target_lev),
+
+                        **kwargs)
+                events.append(evt)
 
-            assert local_exps_res is target_local_exps_view
+                assert local_exps_res is target_local_exps_view
 
         local_exps.add_event(evt)
 
         return (local_exps, SumpyTimingFuture(self.queue, [evt]))
 
-    def eval_locals(self, level_start_target_box_nrs, target_boxes, local_exps):
-        pot = self.output_zeros()
+    def eval_locals(self, level_start_target_box_nrs, target_boxes, local_exps,
+            output=None):
+        pot = self.output_zeros() if output is None else output
 
         kwargs = self.kernel_extra_kwargs.copy()
         kwargs.update(self.box_target_list_kwargs())
+        kwargs.update(self.target_reordering_kwargs())
+        kwargs.update(self.local_slot_kwargs("src"))
 
         events = []
 
@@ -686,9 +1486,495 @@ class SumpyExpansionWrangler(object):
 
         return (pot, SumpyTimingFuture(self.queue, events))
 
+    def eval_locals_and_direct(self,
+            level_start_target_box_nrs, target_boxes,
+            source_box_starts, source_box_lists, src_weights,
+            local_exps, output=None):
+        """Return the sum of what :meth:`eval_locals` and :meth:`eval_direct`
+        compute for the same *target_boxes*, in a single pass over the
+        targets. *source_box_starts* and *source_box_lists* are the list 1
+        interactions, as passed to :meth:`eval_direct`.
+        """
+        pot = self.output_zeros() if output is None else output
+
+        kwargs = self.extra_kwargs.copy()
+        kwargs.update(self.self_extra_kwargs)
+        kwargs.update(self.box_source_list_kwargs())
+        kwargs.update(self.box_target_list_kwargs())
+        kwargs.update(self.source_reordering_kwargs())
+        kwargs.update(self.target_reordering_kwargs())
+        kwargs.update(self.local_slot_kwargs("src"))
+
+        events = []
+
+        for lev in range(self.tree.nlevels):
+            start, stop = level_start_target_box_nrs[lev:lev+2]
+            if start == stop:
+                continue
+
+            source_level_start_ibox, source_local_exps_view = \
+                    self.local_expansions_view(local_exps, lev)
+
+            evt, pot_res = self.code.l2p_and_p2p(self.level_orders[lev])(
+                    self.queue,
+
+                    src_expansions=source_local_exps_view,
+                    src_base_ibox=source_level_start_ibox,
+
+                    target_boxes=target_boxes[start:stop],
+                    source_box_starts=source_box_starts[start:stop+1],
+                    source_box_lists=source_box_lists,
+                    strength=(src_weights,),
+                    centers=self.tree.box_centers,
+                    result=pot,
+
+                    rscale=level_to_rscale(self.tree, lev),
+
+                    **kwargs)
+            events.append(evt)
+
+            for pot_i, pot_res_i in zip(pot, pot_res):
+                assert pot_i is pot_res_i
+
+        return (pot, SumpyTimingFuture(self.queue, events))
+
     def finalize_potentials(self, potentials):
         return potentials
 
 # }}}
 
+
+# {{{ driver
+
+def drive_sumpy_fmm(traversal, wrangler, src_weights, timing_data=None):
+    """Evaluate the FMM for *src_weights* like :func:`boxtree.fmm.drive_fmm`,
+    but with the stages accumulating into one array of potentials and one of
+    local expansions, and with the fused stage of the *fused_l2p_p2p* option
+    of :class:`SumpyExpansionWranglerCodeContainer`, if set.
+
+    :arg traversal: a :class:`boxtree.traversal.FMMTraversalInfo` on the
+        device
+    :arg wrangler: a :class:`SumpyExpansionWrangler` for the tree of
+        *traversal*
+    :arg timing_data: if not *None*, a dictionary that is updated with the
+        :class:`boxtree.fmm.TimingResult` of each stage, keyed by the name
+        of the wrangler method carrying it out
+    :returns: the potentials, as from :func:`boxtree.fmm.drive_fmm`
+    """
+    trav = traversal
+    fused = wrangler.code.fused_l2p_p2p
+
+    stage_events = {}
+
+    def record(name, timing_future):
+        stage_events.setdefault(name, []).extend(timing_future.events)
+
+    src_weights = wrangler.reorder_sources(src_weights)
+
+    # {{{ upward pass
+
+    mpole_exps, timing_future = wrangler.form_multipoles(
+            trav.level_start_source_box_nrs,
+            trav.source_boxes,
+            src_weights)
+    record("form_multipoles", timing_future)
+
+    mpole_exps, timing_future = wrangler.coarsen_multipoles(
+            trav.level_start_source_parent_box_nrs,
+            trav.source_parent_boxes,
+            mpole_exps)
+    record("coarsen_multipoles", timing_future)
+
+    # }}}
+
+    potentials = wrangler.output_zeros()
+    local_exps = wrangler.local_expansion_zeros()
+
+    # {{{ interactions with target boxes
+
+    if not fused:
+        # list 1, else evaluated along with the local expansions
+        _, timing_future = wrangler.eval_direct(
+                trav.target_boxes,
+                trav.neighbor_source_boxes_starts,
+                trav.neighbor_source_boxes_lists,
+                src_weights, output=potentials)
+        record("eval_direct", timing_future)
+
+    _, timing_future = wrangler.multipole_to_local(
+            trav.level_start_target_or_target_parent_box_nrs,
+            trav.target_or_target_parent_boxes,
+            trav.from_sep_siblings_starts,
+            trav.from_sep_siblings_lists,
+            mpole_exps, output=local_exps)
+    record("multipole_to_local", timing_future)
+
+    _, timing_future = wrangler.eval_multipoles(
+            trav.target_boxes_sep_smaller_by_source_level,
+            trav.from_sep_smaller_by_level,
+            mpole_exps, output=potentials, src_weights=src_weights)
+    record("eval_multipoles", timing_future)
+
+    if trav.from_sep_close_smaller_starts is not None:
+        _, timing_future = wrangler.eval_direct(
+                trav.target_boxes,
+                trav.from_sep_close_smaller_starts,
+                trav.from_sep_close_smaller_lists,
+                src_weights, output=potentials)
+        record("eval_direct", timing_future)
+
+    _, timing_future = wrangler.form_locals(
+            trav.level_start_target_or_target_parent_box_nrs,
+            trav.target_or_target_parent_boxes,
+            trav.from_sep_bigger_starts,
+            trav.from_sep_bigger_lists,
+            src_weights, output=local_exps, potentials=potentials)
+    record("form_locals", timing_future)
+
+    if trav.from_sep_close_bigger_starts is not None:
+        _, timing_future = wrangler.eval_direct(
+                trav.target_boxes,
+                trav.from_sep_close_bigger_starts,
+                trav.from_sep_close_bigger_lists,
+                src_weights, output=potentials)
+        record("eval_direct", timing_future)
+
+    # }}}
+
+    # {{{ downward pass
+
+    local_exps, timing_future = wrangler.refine_locals(
+            trav.level_start_target_or_target_parent_box_nrs,
+            trav.target_or_target_parent_boxes,
+            local_exps)
+    record("refine_locals", timing_future)
+
+    if fused:
+        _, timing_future = wrangler.eval_locals_and_direct(
+                trav.level_start_target_box_nrs,
+                trav.target_boxes,
+                trav.neighbor_source_boxes_starts,
+                trav.neighbor_source_boxes_lists,
+                src_weights, local_exps, output=potentials)
+        record("eval_locals_and_direct", timing_future)
+    else:
+        _, timing_future = wrangler.eval_locals(
+                trav.level_start_target_box_nrs,
+                trav.target_boxes,
+                local_exps, output=potentials)
+        record("eval_locals", timing_future)
+
+    # }}}
+
+    result = wrangler.finalize_potentials(
+            wrangler.reorder_potentials(potentials))
+
+    if timing_data is not None:
+        for name, events in stage_events.items():
+            timing_data[name] = SumpyTimingFuture(
+                    wrangler.queue, events).result()
+
+    return result
+
+# }}}
+
+
+# {{{ incremental evaluation
+
+def _flagged_particle_boxes(box_starts, box_counts, particle_flags):
+    """Return, for each box, whether any of the particles
+    ``box_starts[ibox]:box_starts[ibox]+box_counts[ibox]`` is flagged.
+    """
+    flags_cumul = np.zeros(len(particle_flags) + 1, dtype=np.int64)
+    np.cumsum(particle_flags, out=flags_cumul[1:])
+    return flags_cumul[box_starts + box_counts] > flags_cumul[box_starts]
+
+
+def _restrict_interactions(boxes, starts, lists, source_flags, box_flags=None):
+    """Restrict the "compressed sparse row" interaction list *starts*, *lists*
+    of *boxes* to the source boxes for which *source_flags* is set, keeping
+    only boxes that have such interactions or for which *box_flags* is set.
+
+    :returns: a tuple *(row_mask, boxes, starts, lists)*, where *row_mask*
+        tells which of *boxes* were kept
+    """
+    lists = lists[:starts[-1]]
+    entry_mask = source_flags[lists]
+
+    entry_cumul = np.zeros(len(lists) + 1, dtype=starts.dtype)
+    np.cumsum(entry_mask, out=entry_cumul[1:])
+    row_counts = entry_cumul[starts[1:]] - entry_cumul[starts[:-1]]
+
+    row_mask = row_counts > 0
+    if box_flags is not None:
+        row_mask |= box_flags[boxes]
+
+    new_starts = np.zeros(np.count_nonzero(row_mask) + 1, dtype=starts.dtype)
+    np.cumsum(row_counts[row_mask], out=new_starts[1:])
+
+    return row_mask, boxes[row_mask], new_starts, lists[entry_mask]
+
+
+class _InteractionList(object):
+    def __init__(self, starts, lists):
+        self.starts = starts
+        self.lists = lists
+
+
+class IncrementalFMMDriver(object):
+    """Evaluates an FMM for a sequence of source strengths of which only a
+    few change from one evaluation to the next.
+
+    Since the potential depends linearly on the source strengths, the new
+    potential is the previous one plus the potential due to the change in
+    strengths. The latter is computed by an FMM restricted to the boxes that
+    the changed sources affect: the leaf boxes containing them and their
+    ancestors in the upward pass, the target boxes interacting with these
+    in lists 1 to 4, and their descendants in the downward pass.
+
+    Each stage is carried out by the *wrangler*, so that its options (e.g.
+    per-box orders, fused stages) apply unchanged.
+
+    .. attribute:: src_weights
+
+        The source strengths of the last evaluation, or *None*.
+
+    .. attribute:: potentials
+
+        The potentials of the last evaluation, or *None*.
+
+    .. automethod:: __init__
+    .. automethod:: __call__
+    .. automethod:: update
+    """
+
+    def __init__(self, traversal, wrangler):
+        """
+        :arg traversal: a :class:`boxtree.traversal.FMMTraversalInfo` on
+            the device
+        :arg wrangler: a :class:`SumpyExpansionWrangler` for the tree of
+            *traversal*
+        """
+        self.traversal = traversal
+        self.wrangler = wrangler
+        self.queue = wrangler.queue
+
+        self.src_weights = None
+        self.potentials = None
+
+    @memoize_method
+    def _host_traversal(self):
+        return self.traversal.get(queue=self.queue)
+
+    def __call__(self, src_weights):
+        """Evaluate the FMM for *src_weights* in full and remember the result
+        for subsequent calls to :meth:`update`.
+
+        :returns: the potentials, as from :func:`drive_sumpy_fmm`
+        """
+        self.potentials = drive_sumpy_fmm(
+                self.traversal, self.wrangler, src_weights)
+        self.src_weights = src_weights.copy(queue=self.queue)
+
+        return self.potentials
+
+    def update(self, src_weights, changed_source_ids=None):
+        """Evaluate the FMM for *src_weights*, which differ from those of the
+        previous evaluation only in the sources *changed_source_ids*, by
+        computing only the effect of the change.
+
+        :arg changed_source_ids: an array of source indices (in user order),
+            or *None* to find the changed sources by comparing with
+            :attr:`src_weights`
+        :returns: the potentials, as from :func:`drive_sumpy_fmm`
+        """
+        if self.src_weights is None:
+            return self(src_weights)
+
+        from sumpy.tools import _to_host
+
+        delta_weights = src_weights - self.src_weights
+
+        trav = self._host_traversal()
+        tree = trav.tree
+
+        if changed_source_ids is None:
+            changed = _to_host(delta_weights, self.queue) != 0
+        else:
+            changed = np.zeros(tree.nsources, dtype=np.bool_)
+            changed[_to_host(changed_source_ids, self.queue)] = True
+
+        if not changed.any():
+            self.src_weights = src_weights.copy(queue=self.queue)
+            return self.potentials
+
+        delta_potentials = self._get_delta_potentials(
+                delta_weights, changed[tree.user_source_ids])
+
+        self.potentials = self.potentials + delta_potentials
+        self.src_weights = src_weights.copy(queue=self.queue)
+
+        return self.potentials
+
+    def _get_delta_potentials(self, delta_weights, changed):
+        """
+        :arg changed: a boolean array flagging the changed sources in tree
+            order
+        """
+        wrangler = self.wrangler
+        trav = self._host_traversal()
+        tree = trav.tree
+
+        def to_device(ary):
+            return cl.array.to_device(self.queue, ary)
+
+        # {{{ find affected boxes
+
+        # sources changed in a box itself, as used by P2M, P2L and P2P
+        changed_boxes = _flagged_particle_boxes(
+                tree.box_source_starts, tree.box_source_counts_nonchild, changed)
+
+        # boxes whose multipole expansions change
+        changed_mpole_boxes = _flagged_particle_boxes(
+                tree.box_source_starts, tree.box_source_counts_cumul, changed)
+
+        # }}}
+
+        delta_weights = wrangler.reorder_sources(delta_weights)
+        pot = wrangler.output_zeros()
+
+        # {{{ upward pass
+
+        level_starts, source_boxes = _restrict_boxes(
+                trav.level_start_source_box_nrs, trav.source_boxes,
+                changed_boxes[trav.source_boxes])
+        mpole_exps, _ = wrangler.form_multipoles(
+                level_starts, to_device(source_boxes), delta_weights)
+
+        level_starts, source_parent_boxes = _restrict_boxes(
+                trav.level_start_source_parent_box_nrs, trav.source_parent_boxes,
+                changed_mpole_boxes[trav.source_parent_boxes])
+        if len(source_parent_boxes):
+            mpole_exps, _ = wrangler.coarsen_multipoles(
+                    level_starts, to_device(source_parent_boxes), mpole_exps)
+
+        # }}}
+
+        # {{{ interactions with target boxes
+
+        ttp_boxes = trav.target_or_target_parent_boxes
+        ttp_level_starts = trav.level_start_target_or_target_parent_box_nrs
+        local_exps = wrangler.local_expansion_zeros()
+        changed_local_boxes = np.zeros(tree.nboxes, dtype=np.bool_)
+
+        for stage, starts, lists, source_flags in [
+                ("m2l", trav.from_sep_siblings_starts,
+                    trav.from_sep_siblings_lists, changed_mpole_boxes),
+                ("p2l", trav.from_sep_bigger_starts,
+                    trav.from_sep_bigger_lists, changed_boxes),
+                ]:
+            row_mask, boxes, starts, lists = _restrict_interactions(
+                    ttp_boxes, starts, lists, source_flags)
+            if not len(boxes):
+                continue
+
+            changed_local_boxes[boxes] = True
+
+            level_starts, _ = _restrict_boxes(
+                    ttp_level_starts, ttp_boxes, row_mask)
+
+            if stage == "m2l":
+                local_exps, _ = wrangler.multipole_to_local(
+                        level_starts, to_device(boxes),
+                        to_device(starts), to_device(lists), mpole_exps,
+                        output=local_exps)
+            else:
+                local_exps, _ = wrangler.form_locals(
+                        level_starts, to_device(boxes),
+                        to_device(starts), to_device(lists), delta_weights,
+                        output=local_exps, potentials=pot)
+
+        target_boxes_by_source_level = []
+        from_sep_smaller_by_level = []
+        for isrc_level, ssn in enumerate(trav.from_sep_smaller_by_level):
+            _, boxes, starts, lists = _restrict_interactions(
+                    trav.target_boxes_sep_smaller_by_source_level[isrc_level],
+                    ssn.starts, ssn.lists, changed_mpole_boxes)
+            target_boxes_by_source_level.append(to_device(boxes))
+            from_sep_smaller_by_level.append(
+                    _InteractionList(to_device(starts), to_device(lists)))
+
+        pot, _ = wrangler.eval_multipoles(
+                target_boxes_by_source_level, from_sep_smaller_by_level,
+                mpole_exps, output=pot, src_weights=delta_weights)
+
+        for starts, lists in [
+                (getattr(trav, "from_sep_close_smaller_starts", None),
+                    getattr(trav, "from_sep_close_smaller_lists", None)),
+                (getattr(trav, "from_sep_close_bigger_starts", None),
+                    getattr(trav, "from_sep_close_bigger_lists", None)),
+                ]:
+            if starts is None:
+                continue
+
+            _, boxes, starts, lists = _restrict_interactions(
+                    trav.target_boxes, starts, lists, changed_boxes)
+            if len(boxes):
+                pot, _ = wrangler.eval_direct(
+                        to_device(boxes), to_device(starts), to_device(lists),
+                        delta_weights, output=pot)
+
+        # }}}
+
+        # {{{ downward pass
+
+        box_parent_ids = tree.box_parent_ids
+        for lev in range(1, tree.nlevels):
+            start, stop = tree.level_start_box_nrs[lev:lev+2]
+            changed_local_boxes[start:stop] |= \
+                    changed_local_boxes[box_parent_ids[start:stop]]
+
+        refined_boxes = np.zeros(tree.nboxes, dtype=np.bool_)
+        refined_boxes[1:] = changed_local_boxes[box_parent_ids[1:]]
+
+        level_starts, boxes = _restrict_boxes(
+                ttp_level_starts, ttp_boxes, refined_boxes[ttp_boxes])
+        if len(boxes):
+            local_exps, _ = wrangler.refine_locals(
+                    level_starts, to_device(boxes), local_exps)
+
+        # List 1 is passed along with the boxes to evaluate local expansions
+        # in, so that wranglers fusing both stages can do so.
+        row_mask, target_boxes, starts, lists = _restrict_interactions(
+                trav.target_boxes,
+                trav.neighbor_source_boxes_starts,
+                trav.neighbor_source_boxes_lists,
+                changed_boxes, changed_local_boxes)
+        level_starts, _ = _restrict_boxes(
+                trav.level_start_target_box_nrs, trav.target_boxes,
+                row_mask)
+        target_boxes = to_device(target_boxes)
+
+        if wrangler.code.fused_l2p_p2p:
+            if len(target_boxes):
+                pot, _ = wrangler.eval_locals_and_direct(
+                        level_starts, target_boxes,
+                        to_device(starts), to_device(lists), delta_weights,
+                        local_exps, output=pot)
+        else:
+            if len(lists):
+                pot, _ = wrangler.eval_direct(
+                        target_boxes, to_device(starts), to_device(lists),
+                        delta_weights, output=pot)
+
+            if len(target_boxes):
+                pot, _ = wrangler.eval_locals(
+                        level_starts, target_boxes, local_exps, output=pot)
+
+        # }}}
+
+        return wrangler.finalize_potentials(wrangler.reorder_potentials(pot))
+
+# }}}
+
 # vim: foldmethod=marker
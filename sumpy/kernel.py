@@ -106,6 +106,7 @@ class Kernel(object):
     .. automethod:: prepare_loopy_kernel
     .. automethod:: get_code_transformer
     .. automethod:: get_expression
+    .. automethod:: get_recurrence_derivative_taker
     .. attribute:: has_efficient_scale_adjustment
     .. automethod:: adjust_for_kernel_scaling
     .. automethod:: postprocess_at_source
@@ -176,6 +177,15 @@ class Kernel(object):
         r"""Return a :mod:`sympy` expression for the kernel."""
         raise NotImplementedError
 
+    def get_recurrence_derivative_taker(self, dist_vec, sac=None):
+        """Return an object with a ``diff(mi)`` method returning derivatives
+        of :meth:`get_expression` with respect to *dist_vec*, computed by a
+        numeric recurrence (see
+        :class:`sumpy.tools.TaylorRecurrenceMiDerivativeTaker`), or *None*
+        if no such recurrence is known for this kernel.
+        """
+        return None
+
     has_efficient_scale_adjustment = False
 
     def adjust_for_kernel_scaling(self, expr, rscale, nderivatives):
@@ -404,6 +414,10 @@ class LaplaceKernel(ExpressionKernel):
 
     has_efficient_scale_adjustment = True
 
+    def get_recurrence_derivative_taker(self, dist_vec, sac=None):
+        from sumpy.tools import LaplaceDerivativeTaker
+        return LaplaceDerivativeTaker(self, dist_vec, sac)
+
     def adjust_for_kernel_scaling(self, expr, rscale, nderivatives):
         if self.dim == 2:
             if nderivatives == 0:
@@ -504,6 +518,13 @@ class HelmholtzKernel(ExpressionKernel):
         return "HelmKnl%dD(%s)" % (
                 self.dim, self.helmholtz_k_name)
 
+    def get_recurrence_derivative_taker(self, dist_vec, sac=None):
+        if self.dim != 3:
+            return None
+
+        from sumpy.tools import HelmholtzDerivativeTaker
+        return HelmholtzDerivativeTaker(self, dist_vec, sac)
+
     def prepare_loopy_kernel(self, loopy_knl):
         from sumpy.codegen import (bessel_preamble_generator, bessel_mangler)
         loopy_knl = lp.register_function_manglers(loopy_knl,
@@ -22,14 +22,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import six
 from six.moves import range
 
 import numpy as np
 import loopy as lp
 from loopy.version import MOST_RECENT_LANGUAGE_VERSION
 
-from sumpy.tools import KernelCacheWrapper
+from pytools import memoize_method
+from sumpy.tools import KernelCacheWrapper, get_accumulation_term
 
 import logging
 logger = logging.getLogger(__name__)
@@ -43,6 +43,7 @@ Particle-to-expansion
 .. autoclass:: P2EBase
 .. autoclass:: P2EFromSingleBox
 .. autoclass:: P2EFromCSR
+.. autoclass:: P2EMatrixFromSingleBox
 
 """
 
@@ -50,14 +51,36 @@ Particle-to-expansion
 # {{{ P2E base class
 
 class P2EBase(KernelCacheWrapper):
+    expansion_prefixes = ("tgt",)
+
     def __init__(self, ctx, expansion,
-            options=[], name=None, device=None):
+            options=[], name=None, device=None, coeff_indices=None,
+            strengths_in_user_order=False, compact_expansions=False,
+            expansion_layout="box_major", accumulate_output=False):
         """
         :arg expansion: a subclass of :class:`sympy.expansion.ExpansionBase`
         :arg strength_usage: A list of integers indicating which expression
           uses which source strength indicator. This implicitly specifies the
           number of strength arrays that need to be passed.
           Default: all kernels use the same strength.
+        :arg coeff_indices: if not *None*, a tuple of indices of the
+          coefficients to which the generated kernel is restricted. By
+          default, all coefficients are computed. In either case, the work is
+          split among several kernels if the generated code is too large (see
+          :func:`sumpy.set_max_kernel_insns`).
+        :arg strengths_in_user_order: if *True*, the strengths are passed in
+          user source order and read through the tree permutation
+          *user_source_ids* (see :class:`boxtree.Tree`), which the generated
+          kernel takes as an additional argument.
+        :arg compact_expansions: if *True*, the expansion of box *ibox* is
+          written to row ``tgt_box_slots[ibox]`` of *tgt_expansions* instead
+          of to row ``ibox - tgt_base_ibox``, with *tgt_box_slots* an
+          additional argument of the generated kernel. See
+          :func:`sumpy.tools.get_expansion_row_rules`.
+        :arg expansion_layout: the memory layout of *tgt_expansions*, see
+          :func:`sumpy.tools.parse_expansion_layout`.
+        :arg accumulate_output: if *True*, the generated kernel adds into
+          *tgt_expansions* instead of overwriting it.
         """
 
         if device is None:
@@ -72,10 +95,53 @@ class P2EBase(KernelCacheWrapper):
         self.options = options
         self.name = name or self.default_name
         self.device = device
+        self.coeff_indices = coeff_indices
+        self.strengths_in_user_order = strengths_in_user_order
+        self.compact_expansions = compact_expansions
+        self.expansion_layout = expansion_layout
+        self.accumulate_output = accumulate_output
 
         self.dim = expansion.dim
 
-    def get_loopy_instructions(self):
+    def get_strength_index(self, isrc):
+        """Return the (textual) index into *strengths* of the source with
+        tree index *isrc*.
+        """
+        if self.strengths_in_user_order:
+            return "user_source_ids[%s]" % isrc
+        return isrc
+
+    def get_reordering_arguments(self):
+        if self.strengths_in_user_order:
+            return [lp.GlobalArg("user_source_ids", None, shape=None)]
+        return []
+
+    def get_expansion_row_rules(self):
+        from sumpy.tools import get_expansion_row_rules
+        return get_expansion_row_rules(
+                self.expansion_prefixes, self.compact_expansions)
+
+    def get_expansion_slot_arguments(self):
+        from sumpy.tools import get_expansion_slot_arguments
+        return get_expansion_slot_arguments(
+                self.expansion_prefixes, self.compact_expansions)
+
+    def apply_expansion_layout(self, knl):
+        from sumpy.tools import apply_expansion_layout
+        return apply_expansion_layout(
+                knl, self.expansion_prefixes, self.expansion_layout)
+
+    def get_expansion_layout_kwargs(self, knl, kwargs):
+        from sumpy.tools import get_expansion_layout_kwargs
+        return get_expansion_layout_kwargs(
+                knl, self.expansion_prefixes, self.expansion_layout, kwargs)
+
+    def get_coeff_indices(self):
+        if self.coeff_indices is None:
+            return tuple(range(len(self.expansion)))
+        return self.coeff_indices
+
+    def get_assignments(self):
         from sumpy.symbolic import make_sym_vector
         avec = make_sym_vector("a", self.dim)
 
@@ -85,16 +151,30 @@ class P2EBase(KernelCacheWrapper):
         from sumpy.assignment_collection import SymbolicAssignmentCollection
         sac = SymbolicAssignmentCollection()
 
+        coeffs = self.expansion.coefficients_from_source(
+                avec, None, rscale, sac=sac)
         coeff_names = [
-                sac.assign_unique("coeff%d" % i, coeff_i)
-                for i, coeff_i in enumerate(
-                    self.expansion.coefficients_from_source(avec, None, rscale))]
+                sac.assign_unique("coeff%d" % i, coeff)
+                for i, coeff in enumerate(coeffs)]
+
+        return sac, coeff_names
+
+    def get_loopy_instructions(self):
+        # The symbolic work is done (and cached) once for all coefficients,
+        # and shared by all restrictions to a subset of them.
+        from sumpy.tools import get_cached_post_cse_assignments
+        assignments, coeff_names = get_cached_post_cse_assignments(
+                ("p2e", self.expansion), self.get_assignments)
 
-        sac.run_global_cse()
+        if self.coeff_indices is not None:
+            coeff_names = [coeff_names[i] for i in self.coeff_indices]
+
+            from sumpy.tools import restrict_assignments
+            assignments = restrict_assignments(assignments, coeff_names)
 
         from sumpy.codegen import to_loopy_insns
         return to_loopy_insns(
-                six.iteritems(sac.assignments),
+                assignments,
                 vector_names=set(["a"]),
                 pymbolic_expr_maps=[self.expansion.get_code_transformer()],
                 retain_names=coeff_names,
@@ -102,7 +182,51 @@ class P2EBase(KernelCacheWrapper):
                 )
 
     def get_cache_key(self):
-        return (type(self).__name__, self.name, self.expansion)
+        return (type(self).__name__, self.name, self.expansion,
+                self.coeff_indices, self.strengths_in_user_order,
+                self.compact_expansions, self.expansion_layout,
+                self.accumulate_output)
+
+    def get_chunks(self):
+        """Return a list of P2E objects that, run one after the other,
+        compute the same result as *self*. Each computes a subset of the
+        coefficients in a separate kernel, so that none has more than about
+        :data:`sumpy.MAX_KERNEL_INSNS` instructions.
+        """
+        from sumpy import MAX_KERNEL_INSNS
+        return self._get_chunks(MAX_KERNEL_INSNS)
+
+    @memoize_method
+    def _get_chunks(self, max_insns):
+        coeff_indices = self.get_coeff_indices()
+
+        from sumpy.tools import get_kernel_output_chunks
+        chunks = get_kernel_output_chunks(self, max_insns, len(coeff_indices))
+        if len(chunks) == 1:
+            return [self]
+
+        return [
+                type(self)(self.ctx, self.expansion,
+                    options=self.options,
+                    name="%s_chunk%d" % (self.name, ichunk),
+                    device=self.device,
+                    coeff_indices=tuple(coeff_indices[i] for i in chunk_indices),
+                    strengths_in_user_order=self.strengths_in_user_order,
+                    compact_expansions=self.compact_expansions,
+                    expansion_layout=self.expansion_layout,
+                    accumulate_output=self.accumulate_output)
+                for ichunk, (chunk_indices, _) in enumerate(chunks)]
+
+    def run_chunks(self, queue, **kwargs):
+        """Run the kernels of :meth:`get_chunks` with the keyword arguments
+        *kwargs*, which must include the (shared) target expansion array.
+        """
+        for chunk in self.get_chunks():
+            knl = chunk.get_cached_optimized_kernel()
+            kwargs.update(chunk.get_expansion_layout_kwargs(knl, kwargs))
+            evt, result = knl(queue, **kwargs)
+
+        return evt, result
 
 # }}}
 
@@ -121,7 +245,7 @@ class P2EFromSingleBox(P2EBase):
                     "{[isrc_box]: 0<=isrc_box<nsrc_boxes}",
                     "{[isrc,idim]: isrc_start<=isrc<isrc_end and 0<=idim<dim}",
                     ],
-                ["""
+                self.get_expansion_row_rules() + ["""
                 for isrc_box
                     <> src_ibox = source_boxes[isrc_box]
                     <> isrc_start = box_source_starts[src_ibox]
@@ -132,14 +256,16 @@ class P2EFromSingleBox(P2EBase):
                     for isrc
                         <> a[idim] = center[idim] - sources[idim, isrc] {dup=idim}
 
-                        <> strength = strengths[isrc]
-                        """] + self.get_loopy_instructions() + ["""
+                        """] + [
+                        "<> strength = strengths[%s]"
+                        % self.get_strength_index("isrc")
+                        ] + self.get_loopy_instructions() + ["""
                     end
                     """] + ["""
-                    tgt_expansions[src_ibox-tgt_base_ibox, {coeffidx}] = \
+                    tgt_expansions[tgt_row(src_ibox), {coeffidx}] = \
                             simul_reduce(sum, isrc, strength*coeff{coeffidx}) \
                             {{id_prefix=write_expn}}
-                    """.format(coeffidx=i) for i in range(ncoeffs)] + ["""
+                    """.format(coeffidx=i) for i in self.get_coeff_indices()] + ["""
                 end
                 """],
                 [
@@ -155,7 +281,9 @@ class P2EFromSingleBox(P2EBase):
                     lp.ValueArg("nboxes,aligned_nboxes,tgt_base_ibox", np.int32),
                     lp.ValueArg("nsources", np.int32),
                     "..."
-                ] + gather_loopy_source_arguments([self.expansion]),
+                ] + self.get_reordering_arguments()
+                + self.get_expansion_slot_arguments()
+                + gather_loopy_source_arguments([self.expansion]),
                 name=self.name,
                 assumptions="nsrc_boxes>=1",
                 silenced_warnings="write_race(write_expn*)",
@@ -166,7 +294,7 @@ class P2EFromSingleBox(P2EBase):
         loopy_knl = self.expansion.prepare_loopy_kernel(loopy_knl)
         loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
 
-        return loopy_knl
+        return self.apply_expansion_layout(loopy_knl)
 
     def get_optimized_kernel(self):
         # FIXME
@@ -191,9 +319,7 @@ class P2EFromSingleBox(P2EBase):
         # meaningfully inferred. Make the type of rscale explicit.
         rscale = centers.dtype.type(kwargs.pop("rscale"))
 
-        knl = self.get_cached_optimized_kernel()
-
-        return knl(queue, centers=centers, rscale=rscale, **kwargs)
+        return self.run_chunks(queue, centers=centers, rscale=rscale, **kwargs)
 
 # }}}
 
@@ -223,7 +349,9 @@ class P2EFromCSR(P2EBase):
                         np.int32),
                     lp.ValueArg("nsources", np.int32),
                     "..."
-                ] + gather_loopy_source_arguments([self.expansion]))
+                ] + self.get_reordering_arguments()
+                + self.get_expansion_slot_arguments()
+                + gather_loopy_source_arguments([self.expansion]))
 
         loopy_knl = lp.make_kernel(
                 [
@@ -232,7 +360,7 @@ class P2EFromCSR(P2EBase):
                     "{[isrc]: isrc_start<=isrc<isrc_end}",
                     "{[idim]: 0<=idim<dim}",
                     ],
-                ["""
+                self.get_expansion_row_rules() + ["""
                 for itgt_box
                     <> tgt_ibox = target_boxes[itgt_box]
 
@@ -250,16 +378,22 @@ class P2EFromCSR(P2EBase):
                             <> a[idim] = center[idim] - sources[idim, isrc] \
                                     {dup=idim}
 
-                            <> strength = strengths[isrc]
-                            """] + self.get_loopy_instructions() + ["""
+                            """] + [
+                            "<> strength = strengths[%s]"
+                            % self.get_strength_index("isrc")
+                            ] + self.get_loopy_instructions() + ["""
                         end
                     end
                     """] + ["""
-                    tgt_expansions[tgt_ibox - tgt_base_ibox, {coeffidx}] = \
-                            simul_reduce(sum, (isrc_box, isrc),
+                    tgt_expansions[tgt_row(tgt_ibox), {coeffidx}] = \
+                            {prev}simul_reduce(sum, (isrc_box, isrc),
                                 strength*coeff{coeffidx}) \
                             {{id_prefix=write_expn}}
-                    """.format(coeffidx=i) for i in range(ncoeffs)] + ["""
+                    """.format(coeffidx=i,
+                        prev=get_accumulation_term(
+                            "tgt_expansions[tgt_row(tgt_ibox), %d]" % i,
+                            self.accumulate_output))
+                    for i in self.get_coeff_indices()] + ["""
                 end
                 """],
                 arguments,
@@ -273,7 +407,7 @@ class P2EFromCSR(P2EBase):
         loopy_knl = self.expansion.prepare_loopy_kernel(loopy_knl)
         loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
 
-        return loopy_knl
+        return self.apply_expansion_layout(loopy_knl)
 
     def get_optimized_kernel(self):
         # FIXME
@@ -292,14 +426,102 @@ class P2EFromCSR(P2EBase):
         :arg strengths:
         :arg rscale:
         """
-        knl = self.get_cached_optimized_kernel()
+        centers = kwargs.pop("centers")
+        # "1" may be passed for rscale, which won't have its type
+        # meaningfully inferred. Make the type of rscale explicit.
+        rscale = centers.dtype.type(kwargs.pop("rscale"))
+
+        return self.run_chunks(queue, centers=centers, rscale=rscale, **kwargs)
+
+# }}}
+
+
+# {{{ P2E matrix of single box
+
+class P2EMatrixFromSingleBox(P2EBase):
+    """Computes, for each source in the boxes *source_boxes*, the expansion
+    coefficients it contributes to its box for unit strength, i.e. the
+    matrix of the linear map from source strengths to the expansions
+    :class:`P2EFromSingleBox` computes.
+
+    The result is written to the first ``len(expansion)`` columns of
+    *p2e_matrix*, an array of shape ``(nsources, p2e_matrix_ncoeffs)``, so
+    that expansions of different orders can share one matrix.
+    """
+
+    default_name = "p2e_matrix_from_single_box"
+
+    def get_kernel(self):
+        from sumpy.tools import gather_loopy_source_arguments
+        loopy_knl = lp.make_kernel(
+                [
+                    "{[isrc_box]: 0<=isrc_box<nsrc_boxes}",
+                    "{[isrc,idim]: isrc_start<=isrc<isrc_end and 0<=idim<dim}",
+                    ],
+                ["""
+                for isrc_box
+                    <> src_ibox = source_boxes[isrc_box]
+                    <> isrc_start = box_source_starts[src_ibox]
+                    <> isrc_end = isrc_start+box_source_counts_nonchild[src_ibox]
 
+                    <> center[idim] = centers[idim, src_ibox] {id=fetch_center}
+
+                    for isrc
+                        <> a[idim] = center[idim] - sources[idim, isrc] {dup=idim}
+                        """] + self.get_loopy_instructions() + ["""
+                        p2e_matrix[isrc, {coeffidx}] = coeff{coeffidx} \
+                                {{id_prefix=write_matrix}}
+                        """.format(coeffidx=i) for i in self.get_coeff_indices()]
+                + ["""
+                    end
+                end
+                """],
+                [
+                    lp.GlobalArg("sources", None, shape=(self.dim, "nsources"),
+                        dim_tags="sep,c"),
+                    lp.GlobalArg("box_source_starts,box_source_counts_nonchild",
+                        None, shape=None),
+                    lp.GlobalArg("centers", None, shape="dim, aligned_nboxes"),
+                    lp.ValueArg("rscale", None),
+                    lp.GlobalArg("p2e_matrix", None,
+                        shape="nsources, p2e_matrix_ncoeffs"),
+                    lp.ValueArg("aligned_nboxes,p2e_matrix_ncoeffs", np.int32),
+                    lp.ValueArg("nsources", np.int32),
+                    "..."
+                ] + gather_loopy_source_arguments([self.expansion]),
+                name=self.name,
+                assumptions="nsrc_boxes>=1",
+                default_offset=lp.auto,
+                fixed_parameters=dict(dim=self.dim),
+                lang_version=MOST_RECENT_LANGUAGE_VERSION)
+
+        loopy_knl = self.expansion.prepare_loopy_kernel(loopy_knl)
+        loopy_knl = lp.tag_inames(loopy_knl, "idim*:unr")
+
+        return loopy_knl
+
+    def get_optimized_kernel(self):
+        knl = self.get_kernel()
+        knl = lp.tag_inames(knl, dict(isrc_box="g.0"))
+        knl = lp.split_iname(knl, "isrc", 32, inner_tag="l.0")
+        return knl
+
+    def __call__(self, queue, **kwargs):
+        """
+        :arg p2e_matrix:
+        :arg source_boxes:
+        :arg box_source_starts:
+        :arg box_source_counts_nonchild:
+        :arg centers:
+        :arg sources:
+        :arg rscale:
+        """
         centers = kwargs.pop("centers")
         # "1" may be passed for rscale, which won't have its type
         # meaningfully inferred. Make the type of rscale explicit.
         rscale = centers.dtype.type(kwargs.pop("rscale"))
 
-        return knl(queue, centers=centers, rscale=rscale, **kwargs)
+        return self.run_chunks(queue, centers=centers, rscale=rscale, **kwargs)
 
 # }}}
 
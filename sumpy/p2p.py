@@ -58,26 +58,38 @@ Particle-to-particle
 class P2PBase(KernelComputation, KernelCacheWrapper):
     def __init__(self, ctx, kernels, exclude_self, strength_usage=None,
             value_dtypes=None,
-            options=[], name=None, device=None):
+            options=[], name=None, device=None,
+            strengths_in_user_order=False, result_in_user_order=False):
         """
         :arg kernels: list of :class:`sumpy.kernel.Kernel` instances
         :arg strength_usage: A list of integers indicating which expression
           uses which source strength indicator. This implicitly specifies the
           number of strength arrays that need to be passed.
           Default: all kernels use the same strength.
+        :arg strengths_in_user_order: if *True*, the strengths are passed in
+          user source order and read through the tree permutation
+          *user_source_ids*, which the generated kernel takes as an
+          additional argument. Only supported by :class:`P2PFromCSR`.
+        :arg result_in_user_order: if *True*, the potentials are written to
+          *result* in user target order, through the array *user_target_ids*
+          (see :class:`sumpy.e2p.E2PBase`). Only supported by
+          :class:`P2PFromCSR`.
         """
         KernelComputation.__init__(self, ctx, kernels, strength_usage,
                 value_dtypes,
                 name, options, device)
 
         self.exclude_self = exclude_self
+        self.strengths_in_user_order = strengths_in_user_order
+        self.result_in_user_order = result_in_user_order
 
         from pytools import single_valued
         self.dim = single_valued(knl.dim for knl in self.kernels)
 
     def get_cache_key(self):
         return (type(self).__name__, tuple(self.kernels), self.exclude_self,
-                tuple(self.strength_usage), tuple(self.value_dtypes))
+                tuple(self.strength_usage), tuple(self.value_dtypes),
+                self.strengths_in_user_order, self.result_in_user_order)
 
     def get_loopy_insns_and_result_names(self):
         from sumpy.symbolic import make_sym_vector
@@ -96,6 +108,7 @@ class P2PBase(KernelComputation, KernelCacheWrapper):
                     )
                 for i, knl in enumerate(self.kernels)]
 
+        sac.eliminate_dead_assignments(result_names)
         sac.run_global_cse()
 
         from sumpy.codegen import to_loopy_insns
@@ -109,7 +122,16 @@ class P2PBase(KernelComputation, KernelCacheWrapper):
 
         return loopy_insns, result_names
 
+    def get_reordering_arguments(self):
+        return (
+                ([lp.GlobalArg("user_source_ids", None, shape=None)]
+                    if self.strengths_in_user_order else [])
+                + ([lp.GlobalArg("user_target_ids", None, shape=None)]
+                    if self.result_in_user_order else []))
+
     def get_strength_or_not(self, isrc, kernel_idx):
+        if self.strengths_in_user_order:
+            isrc = var("user_source_ids").index(isrc)
         return var("strength").index((self.strength_usage[kernel_idx], isrc))
 
     def get_kernel_exprs(self, result_names):
@@ -434,7 +456,7 @@ class P2PFromCSR(P2PBase):
                 lp.GlobalArg("result", None,
                     shape="nkernels, ntargets", dim_tags="sep,C"),
                 "..."
-            ])
+            ] + self.get_reordering_arguments())
 
         loopy_knl = lp.make_kernel([
             "{[itgt_box]: 0 <= itgt_box < ntgt_boxes}",
@@ -469,10 +491,12 @@ class P2PFromCSR(P2PBase):
             + loopy_insns + kernel_exprs
             + ["    end"]
             + ["""
-                    result[{i}, itgt] = result[{i}, itgt] + \
+                    result[{i}, {itgt}] = result[{i}, {itgt}] + \
                         knl_{i}_scaling * simul_reduce(sum, isrc, pair_result_{i}) \
                         {{id_prefix=write_csr}}
-                """.format(i=iknl)
+                """.format(i=iknl, itgt=(
+                    "user_target_ids[itgt]" if self.result_in_user_order
+                    else "itgt"))
                 for iknl in range(len(self.kernels))]
             + ["""
                     end
@@ -119,6 +119,7 @@ class LayerPotentialBase(KernelComputation, KernelCacheWrapper):
 
         logger.info("compute expansion expressions: done")
 
+        sac.eliminate_dead_assignments(result_names)
         sac.run_global_cse()
 
         from sumpy.codegen import to_loopy_insns
@@ -119,6 +119,13 @@ else:
         return sym.Pow(a, b, evaluate=False)
 
 
+def get_backend_version():
+    """Return a tuple identifying the symbolic backend in use and its version,
+    for use in keys of caches of symbolic results.
+    """
+    return ("symengine" if USE_SYMENGINE else "sympy", sym.__version__)
+
+
 # {{{ debugging of sympy CSE via Maxima
 
 class _DerivativeKiller(IdentityMapperBase):
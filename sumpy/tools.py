@@ -67,13 +67,165 @@ def mi_power(vector, mi, evaluate=True):
     return result
 
 
+def mi_scaled_powers(vector, mis, sac=None):
+    """Return a list of ``mi_power(vector, mi) / mi_factorial(mi)`` for each
+    *mi* in *mis*.
+
+    Each entry is obtained from the one with one fewer power of its last
+    nonzero axis by a single multiplication. If *sac* is given, each entry is
+    assigned to a new variable in it, so that the shared products need not be
+    rediscovered by common subexpression elimination.
+    """
+    table = {}
+
+    def get_entry(mi):
+        try:
+            return table[mi]
+        except KeyError:
+            pass
+
+        # Find the missing predecessors first, to keep the recursion shallow.
+        missing = [mi]
+        while True:
+            iaxis = max(i for i, mi_i in enumerate(missing[-1]) if mi_i)
+            pred = tuple(mi_i - 1 if i == iaxis else mi_i
+                    for i, mi_i in enumerate(missing[-1]))
+            if pred in table or not any(pred):
+                break
+            missing.append(pred)
+
+        for missing_mi in reversed(missing):
+            iaxis = max(i for i, mi_i in enumerate(missing_mi) if mi_i)
+            pred = tuple(mi_i - 1 if i == iaxis else mi_i
+                    for i, mi_i in enumerate(missing_mi))
+            table[missing_mi] = add_to_sac(sac,
+                    table.get(pred, 1)
+                    * vector[iaxis] / missing_mi[iaxis], "mi_power")
+
+        return table[mi]
+
+    return [get_entry(mi) if any(mi) else 1 for mi in mis]
+
+
+def mi_taylor_polynomial(coeffs, mis, vector):
+    """Return ``sum(coeff * mi_power(vector, mi) / mi_factorial(mi))`` over
+    *coeffs* and the corresponding *mis*, in nested Horner form with the
+    factorials folded into the multipliers, e.g. in one dimension::
+
+        c0 + x/1 * (c1 + x/2 * (c2 + x/3 * c3))
+    """
+    def horner(terms, iaxis):
+        if iaxis == len(vector):
+            return sym.Add(*[coeff for _, coeff in terms])
+
+        by_power = {}
+        for mi, coeff in terms:
+            by_power.setdefault(mi[iaxis], []).append((mi, coeff))
+
+        max_power = max(by_power)
+        result = horner(by_power[max_power], iaxis + 1)
+        for power in range(max_power - 1, -1, -1):
+            result = result * vector[iaxis] / (power + 1)
+            if power in by_power:
+                result = horner(by_power[power], iaxis + 1) + result
+
+        return result
+
+    terms = [(mi, coeff) for mi, coeff in zip(mis, coeffs) if coeff != 0]
+    if not terms:
+        return 0
+
+    return horner(terms, 0)
+
+
+# {{{ shared derivative cache
+
+class DerivativeCache(object):
+    """A process-wide store of symbolic derivatives shared by all instances of
+    :class:`MiDerivativeTaker` that differentiate the same expression with
+    respect to the same variables, so that expansions of different orders (and
+    P2L, M2L, M2P of the same kernel) reuse each other's work.
+
+    Derivatives are grouped into families, one per derivative taker key,
+    each a :class:`dict` mapping multi-indices to expressions. Once the total
+    number of stored derivatives exceeds *max_size*, the least recently used
+    families are evicted. Takers holding on to an evicted family keep using
+    it; it is merely no longer shared.
+
+    .. automethod:: get_family
+    .. automethod:: clear
+    """
+
+    def __init__(self, max_size):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self.families = OrderedDict()
+
+    def get_family(self, key, expr, var_list):
+        """Return the (mutable) derivative cache for *key*, creating it with
+        *expr* as its zeroth derivative if needed.
+        """
+        try:
+            family = self.families.pop(key)
+        except KeyError:
+            empty_mi = (0,) * len(var_list)
+            family = {empty_mi: expr}
+
+        self.families[key] = family
+        self.evict()
+        return family
+
+    def evict(self):
+        if self.max_size is None:
+            return
+
+        # The most recently used family is never evicted.
+        size = sum(len(family) for family in six.itervalues(self.families))
+        while len(self.families) > 1 and size > self.max_size:
+            _, family = self.families.popitem(last=False)
+            size -= len(family)
+
+    def clear(self):
+        self.families.clear()
+
+
+def _get_default_derivative_cache_size():
+    import os
+    return int(os.environ.get("SUMPY_DERIVATIVE_CACHE_SIZE", "50000")) or None
+
+
+derivative_cache = DerivativeCache(_get_default_derivative_cache_size())
+
+# }}}
+
+
 class MiDerivativeTaker(object):
+    """Takes (and caches) derivatives of *expr* with respect to *var_list*,
+    indexed by multi-index.
+
+    If *use_shared_cache* is *True*, the derivative cache is shared via
+    :data:`derivative_cache` with other takers for the same expression and
+    variables.
+
+    Cached derivatives are looked up on the multi-index lattice: a missing
+    derivative is obtained from the nearest cached one found by decrementing
+    one axis at a time, so that a lookup in the common case (one of the
+    immediate lattice parents is already cached) costs :math:`O(d)`.
+    """
 
-    def __init__(self, expr, var_list):
+    def __init__(self, expr, var_list, use_shared_cache=True):
         assert isinstance(expr, sym.Basic)
         self.var_list = var_list
-        empty_mi = (0,) * len(var_list)
-        self.cache_by_mi = {empty_mi: expr}
+
+        if use_shared_cache:
+            self.cache_by_mi = derivative_cache.get_family(
+                    self.get_cache_key(expr), expr, var_list)
+        else:
+            empty_mi = (0,) * len(var_list)
+            self.cache_by_mi = {empty_mi: expr}
+
+    def get_cache_key(self, expr):
+        return (type(self).__name__, expr, tuple(self.var_list))
 
     def mi_dist(self, a, b):
         return np.array(a, dtype=int) - np.array(b, dtype=int)
@@ -93,18 +245,37 @@ class MiDerivativeTaker(object):
         return expr
 
     def get_derivative_taking_sequence(self, start_mi, end_mi):
-        current_mi = np.array(start_mi, dtype=int)
-        for idx, (mi_i, vec_i) in enumerate(
-                zip(self.mi_dist(end_mi, start_mi), self.var_list)):
-            for i in range(1, 1 + mi_i):
+        current_mi = list(start_mi)
+        for idx, vec_i in enumerate(self.var_list):
+            for i in range(end_mi[idx] - start_mi[idx]):
                 current_mi[idx] += 1
                 yield vec_i, tuple(current_mi)
 
     def get_closest_cached_mi(self, mi):
-        return min((other_mi
-                for other_mi in self.cache_by_mi.keys()
-                if (np.array(mi) >= np.array(other_mi)).all()),
-            key=lambda other_mi: sum(self.mi_dist(mi, other_mi)))
+        """Return the cached multi-index *other_mi* with ``other_mi <= mi``
+        (componentwise) closest to *mi*, by searching the lattice downward
+        from *mi* one decrement at a time.
+        """
+        frontier = [tuple(mi)]
+        seen = set(frontier)
+
+        while True:
+            next_frontier = []
+            for cand_mi in frontier:
+                if cand_mi in self.cache_by_mi:
+                    return cand_mi
+
+                for iaxis in range(len(cand_mi)):
+                    if cand_mi[iaxis] == 0:
+                        continue
+                    parent_mi = (cand_mi[:iaxis] + (cand_mi[iaxis] - 1,)
+                            + cand_mi[iaxis+1:])
+                    if parent_mi not in seen:
+                        seen.add(parent_mi)
+                        next_frontier.append(parent_mi)
+
+            # The empty multi-index is always cached, so this terminates.
+            frontier = next_frontier
 
 
 class LinearRecurrenceBasedMiDerivativeTaker(MiDerivativeTaker):
@@ -113,10 +284,16 @@ class LinearRecurrenceBasedMiDerivativeTaker(MiDerivativeTaker):
     :class:`sumpy.expansion.LinearRecurrenceBasedDerivativeWrangler`
     """
 
-    def __init__(self, expr, var_list, wrangler):
-        super(LinearRecurrenceBasedMiDerivativeTaker, self).__init__(
-                expr, var_list)
+    def __init__(self, expr, var_list, wrangler, use_shared_cache=True):
         self.wrangler = wrangler
+        super(LinearRecurrenceBasedMiDerivativeTaker, self).__init__(
+                expr, var_list, use_shared_cache)
+
+    def get_cache_key(self, expr):
+        # Derivatives may be expressed in terms of each other through the
+        # wrangler's recurrences, so only share among matching recurrences.
+        return (super(LinearRecurrenceBasedMiDerivativeTaker, self)
+                .get_cache_key(expr) + (self.wrangler.get_recurrence_key(),))
 
     @memoize_method
     def diff(self, mi):
@@ -156,6 +333,195 @@ class LinearRecurrenceBasedMiDerivativeTaker(MiDerivativeTaker):
 # }}}
 
 
+# {{{ recurrence-based kernel derivatives
+
+def add_to_sac(sac, expr, name_base="expr"):
+    """If *sac* is not *None*, assign *expr* to a new variable in *sac* and
+    return a symbol referring to it. Otherwise, return *expr*.
+    """
+    if sac is None:
+        return expr
+
+    return sym.Symbol(sac.assign_unique(name_base, expr))
+
+
+class TaylorRecurrenceMiDerivativeTaker(object):
+    r"""Takes derivatives of a kernel :math:`G` by evaluating a recurrence
+    for its Taylor coefficients :math:`a_k = \partial^k G / k!`, rather than by
+    symbolic differentiation.
+
+    Each Taylor coefficient is a small expression in its predecessors.
+    If *sac* is given, each is assigned to a new variable in it, so that the
+    generated code evaluates the recurrence numerically, and the size of the
+    expressions only grows linearly with the number of derivatives.
+
+    The recurrences follow from multiplying the first-order equations
+    satisfied by :math:`G` by :math:`|x|^2` and matching Taylor coefficients.
+
+    .. automethod:: diff
+    """
+
+    def __init__(self, kernel, dist_vec, sac=None):
+        self.kernel = kernel
+        self.dist_vec = dist_vec
+        self.sac = sac
+        self.dim = len(dist_vec)
+
+        self.rsquared = add_to_sac(sac,
+                sum(dist_vec_i**2 for dist_vec_i in dist_vec), "kernel_rsq")
+        self.taylor_coeff_cache = {}
+
+    def diff(self, mi):
+        """
+        :arg mi: a multi-index (tuple) indicating how many x/y derivatives are
+            to be taken.
+        """
+        return mi_factorial(mi) * self.get_taylor_coefficient(tuple(mi))
+
+    def get_taylor_coefficient(self, mi):
+        try:
+            return self.taylor_coeff_cache[mi]
+        except KeyError:
+            pass
+
+        result = add_to_sac(self.sac,
+                self.compute_taylor_coefficient(mi), "kernel_deriv")
+        self.taylor_coeff_cache[mi] = result
+        return result
+
+    def get_neighbor_sums(self, get_coefficient, mi):
+        r"""Return :math:`\sum_i x_i c_{k-e_i}` and
+        :math:`\sum_i c_{k-2e_i}`, where :math:`c` is given by
+        *get_coefficient* and terms with negative indices are omitted.
+        """
+        first_sum = 0
+        second_sum = 0
+
+        for iaxis, dist_vec_i in enumerate(self.dist_vec):
+            if mi[iaxis] >= 1:
+                first_sum += dist_vec_i * get_coefficient(
+                        _shift_mi(mi, iaxis, -1))
+            if mi[iaxis] >= 2:
+                second_sum += get_coefficient(_shift_mi(mi, iaxis, -2))
+
+        return first_sum, second_sum
+
+    def compute_taylor_coefficient(self, mi):
+        raise NotImplementedError
+
+
+def _shift_mi(mi, iaxis, amount):
+    return tuple(
+            mi_i + amount if i == iaxis else mi_i
+            for i, mi_i in enumerate(mi))
+
+
+class LaplaceDerivativeTaker(TaylorRecurrenceMiDerivativeTaker):
+    r"""Derivatives of :math:`\log|x|` in 2D and :math:`1/|x|` in 3D,
+    computed from the recurrences
+
+    .. math::
+
+        n |x|^2 a_k + (2n - 2) \sum_i x_i a_{k-e_i} + (n - 2) \sum_i a_{k-2e_i}
+        = f_k \quad(\text{2D}),
+
+        n |x|^2 a_k + (2n - 1) \sum_i x_i a_{k-e_i} + (n - 1) \sum_i a_{k-2e_i}
+        = 0 \quad(\text{3D}),
+
+    where :math:`n = |k|`, and :math:`f_k` is :math:`x_i` for
+    :math:`k = e_i`, 1 for :math:`k = 2e_i` and 0 otherwise.
+    """
+
+    def compute_taylor_coefficient(self, mi):
+        order = sum(mi)
+        if order == 0:
+            return self.kernel.get_expression(self.dist_vec)
+
+        first_sum, second_sum = self.get_neighbor_sums(
+                self.get_taylor_coefficient, mi)
+
+        if self.dim == 2:
+            rhs = 0
+            if order <= 2 and max(mi) == order:
+                iaxis = mi.index(order)
+                rhs = self.dist_vec[iaxis] if order == 1 else 1
+
+            return (
+                    -(2*order - 2) * first_sum
+                    - (order - 2) * second_sum
+                    + rhs) / (order * self.rsquared)
+
+        elif self.dim == 3:
+            return (
+                    -(2*order - 1) * first_sum
+                    - (order - 1) * second_sum) / (order * self.rsquared)
+
+        else:
+            raise NotImplementedError("unsupported dimensionality")
+
+
+class HelmholtzDerivativeTaker(TaylorRecurrenceMiDerivativeTaker):
+    r"""Derivatives of :math:`e^{ik|x|}/|x|` in 3D, computed from the
+    coupled recurrences
+
+    .. math::
+
+        n |x|^2 a_k + (2n - 1) \sum_i x_i a_{k-e_i} + (n - 1) \sum_i a_{k-2e_i}
+        + \kappa \left(\sum_i x_i b_{k-e_i} + \sum_i b_{k-2e_i}\right) = 0,
+
+        n b_k + \kappa \left(\sum_i x_i a_{k-e_i} + \sum_i a_{k-2e_i}\right)
+        = 0,
+
+    where :math:`n = |k|`, :math:`\kappa = -ik` and :math:`b_k` are the Taylor
+    coefficients of :math:`e^{ik|x|}`.
+    """
+
+    def __init__(self, kernel, dist_vec, sac=None):
+        if len(dist_vec) != 3:
+            raise NotImplementedError("unsupported dimensionality")
+
+        super(HelmholtzDerivativeTaker, self).__init__(kernel, dist_vec, sac)
+
+        self.kappa = -sym.I * sym.Symbol(kernel.helmholtz_k_name)
+        self.exp_taylor_coeff_cache = {}
+
+    def get_exp_taylor_coefficient(self, mi):
+        try:
+            return self.exp_taylor_coeff_cache[mi]
+        except KeyError:
+            pass
+
+        order = sum(mi)
+        if order == 0:
+            result = sym.exp(-self.kappa * sym.sqrt(self.rsquared))
+        else:
+            first_sum, second_sum = self.get_neighbor_sums(
+                    self.get_taylor_coefficient, mi)
+            result = -self.kappa * (first_sum + second_sum) / order
+
+        result = add_to_sac(self.sac, result, "kernel_exp_deriv")
+        self.exp_taylor_coeff_cache[mi] = result
+        return result
+
+    def compute_taylor_coefficient(self, mi):
+        order = sum(mi)
+        if order == 0:
+            return self.kernel.get_expression(self.dist_vec)
+
+        first_sum, second_sum = self.get_neighbor_sums(
+                self.get_taylor_coefficient, mi)
+        exp_first_sum, exp_second_sum = self.get_neighbor_sums(
+                self.get_exp_taylor_coefficient, mi)
+
+        return (
+                -(2*order - 1) * first_sum
+                - (order - 1) * second_sum
+                - self.kappa * (exp_first_sum + exp_second_sum)
+                ) / (order * self.rsquared)
+
+# }}}
+
+
 def build_matrix(op, dtype=None, shape=None):
     dtype = dtype or op.dtype
     from pytools import ProgressBar
@@ -667,6 +1033,272 @@ class KernelCacheWrapper(object):
         return knl
 
 
+# {{{ symbolic result caching
+
+def get_cached_post_cse_assignments(cache_key, build):
+    """Return the assignments and result names built by *build*, after dead
+    assignment elimination and common subexpression elimination, using
+    :data:`sumpy.symbolic_cache` to avoid repeating the symbolic work.
+
+    :arg cache_key: a hashable, persistently hashable key identifying the
+        symbolic computation (e.g. the expansions and kernels involved). It
+        should not include anything that only affects code generation.
+    :arg build: a callable returning a tuple ``(sac, result_names)`` of a
+        :class:`sumpy.assignment_collection.SymbolicAssignmentCollection`
+        before CSE and the names of its assignments holding the results.
+    :returns: a tuple ``(assignments, result_names)``, where *assignments*
+        is a list of ``(name, expr)`` tuples.
+    """
+    from sumpy import symbolic_cache, CACHING_ENABLED
+
+    if CACHING_ENABLED:
+        from sumpy.symbolic import get_backend_version
+        cache_key = cache_key + get_backend_version()
+
+        try:
+            result = symbolic_cache[cache_key]
+            logger.debug("symbolic cache hit [key=%s]" % (cache_key,))
+            return result
+        except KeyError:
+            pass
+
+    sac, result_names = build()
+    sac.eliminate_dead_assignments(result_names)
+    sac.run_global_cse()
+    result = (list(six.iteritems(sac.assignments)), list(result_names))
+
+    if CACHING_ENABLED:
+        symbolic_cache.store_if_not_present(cache_key, result)
+
+    return result
+
+
+def restrict_assignments(assignments, result_names, zero_names=()):
+    """Return the part of *assignments* (a list of ``(name, expr)`` tuples,
+    as returned by :func:`get_cached_post_cse_assignments`) needed to
+    compute *result_names*, with the external variables *zero_names* set to
+    zero. This derives kernels computing a subset of the results, or a
+    subset of the terms of each, from the symbolic work done once for all
+    of them.
+    """
+    zero_symbols = dict(
+            (sym.Symbol(name), sym.sympify(0)) for name in zero_names)
+
+    from sumpy.assignment_collection import SymbolicAssignmentCollection
+    sac = SymbolicAssignmentCollection(dict(
+            (name, expr.xreplace(zero_symbols) if zero_symbols else expr)
+            for name, expr in assignments))
+    sac.eliminate_dead_assignments(result_names)
+
+    return [
+            (name, sac.assignments[name])
+            for name, _ in assignments
+            if name in sac.assignments]
+
+# }}}
+
+
+# {{{ kernel splitting
+
+def split_outputs_into_chunks(ninsns, noutputs, max_insns):
+    """Partition the *noutputs* outputs of a kernel with *ninsns* instructions
+    into contiguous chunks such that a kernel computing one chunk can be
+    expected to have no more than about *max_insns* instructions.
+
+    :arg max_insns: *None* to disable splitting.
+    :returns: a list of tuples of output indices.
+    """
+    if max_insns is None or ninsns <= max_insns or noutputs <= 1:
+        return [tuple(range(noutputs))]
+
+    nchunks = min(noutputs, -(-ninsns // max_insns))
+    return [
+            tuple(int(i) for i in chunk)
+            for chunk in np.array_split(np.arange(noutputs), nchunks)]
+
+
+def split_outputs_and_terms_into_chunks(ninsns, noutputs, nterms, max_insns):
+    """Like :func:`split_outputs_into_chunks`, but for a kernel whose
+    outputs are each a sum of *nterms* terms. If splitting the outputs alone
+    does not bring the chunks down to about *max_insns* instructions, the
+    terms of each output are split, too, and the partial sums of one output
+    must be added up.
+
+    :returns: a list of tuples *(output_indices, term_indices)*.
+    """
+    output_chunks = split_outputs_into_chunks(ninsns, noutputs, max_insns)
+
+    nterm_chunks = 1
+    if max_insns is not None and nterms > 1:
+        nchunks = -(-ninsns // max_insns)
+        nterm_chunks = min(nterms, -(-nchunks // len(output_chunks)))
+
+    term_chunks = [
+            tuple(int(i) for i in chunk)
+            for chunk in np.array_split(np.arange(nterms), nterm_chunks)]
+
+    return [
+            (output_indices, term_indices)
+            for output_indices in output_chunks
+            for term_indices in term_chunks]
+
+
+def get_kernel_output_chunks(kernel_cache_wrapper, max_insns, noutputs,
+        nterms=1):
+    """Decide whether the kernel of *kernel_cache_wrapper* is too large
+    according to *max_insns* (usually :data:`sumpy.MAX_KERNEL_INSNS`), and if
+    so, how its *noutputs* outputs (and the *nterms* terms of each) should
+    be split among several kernels.
+
+    :returns: a list of tuples *(output_indices, term_indices)*, as returned
+        by :func:`split_outputs_and_terms_into_chunks`.
+    """
+    if max_insns is None:
+        return [(tuple(range(noutputs)), tuple(range(nterms)))]
+
+    knl = kernel_cache_wrapper.get_cached_optimized_kernel()
+    chunks = split_outputs_and_terms_into_chunks(
+            len(knl.instructions), noutputs, nterms, max_insns)
+
+    if len(chunks) > 1:
+        logger.info("%s: %d instructions, splitting into %d kernels" % (
+            kernel_cache_wrapper.name, len(knl.instructions), len(chunks)))
+
+    return chunks
+
+# }}}
+
+
+# {{{ expansion storage
+
+def get_expansion_row_rules(prefixes, compact_expansions):
+    """Return loopy substitution rules ``<prefix>_row(ibox)``, one for each
+    of *prefixes* (``"src"`` or ``"tgt"``), that give the row of the array
+    ``<prefix>_expansions`` holding the expansion of box *ibox*.
+
+    By default, the expansion array holds a row for every box of a level,
+    and the row is ``ibox - <prefix>_base_ibox``. If *compact_expansions* is
+    *True*, only boxes that carry an expansion have a row, and the row is
+    looked up in the array ``<prefix>_box_slots``, which kernels using the
+    rules take as an additional argument (see
+    :func:`get_expansion_slot_arguments`).
+    """
+    if compact_expansions:
+        template = "{prefix}_row(ibox) := {prefix}_box_slots[ibox]"
+    else:
+        template = "{prefix}_row(ibox) := ibox - {prefix}_base_ibox"
+
+    return [template.format(prefix=prefix) for prefix in prefixes]
+
+
+def get_expansion_slot_arguments(prefixes, compact_expansions):
+    """Return the kernel arguments needed by the rules of
+    :func:`get_expansion_row_rules`.
+    """
+    if compact_expansions:
+        return [lp.GlobalArg("%s_box_slots" % prefix, None, shape=None)
+                for prefix in prefixes]
+    return []
+
+
+DEFAULT_EXPANSION_BLOCK_SIZE = 16
+
+
+def get_accumulation_term(output, accumulate_output):
+    """Return the (textual) start of the new value of *output* in a kernel
+    writing it: ``"output + "`` if *accumulate_output* is set, else the empty
+    string.
+    """
+    if accumulate_output:
+        return "%s + " % output
+    return ""
+
+
+def parse_expansion_layout(layout):
+    """Return a tuple *(kind, block_size)* describing the memory layout
+    *layout* of an array of expansions, one row per box. *layout* is one of
+
+    * ``"box_major"``: the coefficients of each box are contiguous
+      (row-major storage, the default),
+    * ``"coeff_major"``: each coefficient is contiguous across boxes
+      (column-major storage),
+    * ``"blocked"`` or ``"blocked:<n>"``: boxes are grouped into blocks of
+      *n* (default :data:`DEFAULT_EXPANSION_BLOCK_SIZE`) consecutive rows,
+      which are stored one after the other, each in column-major order.
+
+    *block_size* is *None* unless *kind* is ``"blocked"``.
+    """
+    if layout in ["box_major", "coeff_major"]:
+        return layout, None
+
+    if layout == "blocked":
+        return layout, DEFAULT_EXPANSION_BLOCK_SIZE
+
+    if layout.startswith("blocked:"):
+        block_size = int(layout[len("blocked:"):])
+        if block_size < 1:
+            raise ValueError("invalid expansion block size: %d" % block_size)
+        return "blocked", block_size
+
+    raise ValueError("unknown expansion layout: '%s'" % layout)
+
+
+def apply_expansion_layout(knl, prefixes, layout):
+    """Return *knl* with the arrays ``<prefix>_expansions``, for each of
+    *prefixes*, stored in the layout *layout*.
+
+    The arrays are still indexed as ``(row, coefficient)`` in the kernel. In
+    the blocked layout, they become three-dimensional with the shape
+    ``(nblocks, block_size, ncoeffs)`` for the caller, and their number of
+    rows can no longer be found from the array shape, see
+    :func:`get_expansion_layout_kwargs`.
+    """
+    kind, block_size = parse_expansion_layout(layout)
+    array_names = ["%s_expansions" % prefix for prefix in prefixes]
+
+    if kind == "box_major":
+        return knl
+
+    elif kind == "coeff_major":
+        return lp.tag_array_axes(knl, array_names, "N0,N1")
+
+    elif kind == "blocked":
+        knl = lp.expand_subst(knl)
+        knl = lp.split_array_axis(knl, array_names, 0, block_size)
+        return lp.tag_array_axes(knl, array_names, "N2,N0,N1")
+
+    else:
+        raise ValueError("unknown expansion layout: '%s'" % kind)
+
+
+def get_expansion_layout_kwargs(knl, prefixes, layout, kwargs):
+    """Return the additional arguments that *knl*, transformed by
+    :func:`apply_expansion_layout`, needs when invoked with the arguments
+    *kwargs*: in the blocked layout, the number of rows of each expansion
+    array (as many as the blocks of the array passed in hold).
+    """
+    kind, block_size = parse_expansion_layout(layout)
+    if kind != "blocked":
+        return {}
+
+    from loopy.symbolic import get_dependencies
+
+    result = {}
+    for prefix in prefixes:
+        ary = kwargs.get("%s_expansions" % prefix)
+        if ary is None:
+            continue
+
+        nrows_name, = get_dependencies(
+                knl.arg_dict["%s_expansions" % prefix].shape[0])
+        if nrows_name not in kwargs:
+            result[nrows_name] = ary.shape[0] * block_size
+
+    return result
+
+# }}}
+
+
 def my_syntactic_subs(expr, subst_dict):
     # Workaround for differing substitution semantics between sympy and symengine.
     # FIXME: This is a hack.
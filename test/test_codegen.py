@@ -61,6 +61,40 @@ def test_kill_trivial_assignments():
         ('u2', _s(6*x, 1))]
 
 
+def test_expression_rewriter():
+    from pymbolic import var
+    from pymbolic.primitives import Quotient
+    from sumpy.codegen import (
+            ExpressionRewriter, BesselGetter, BesselSubstitutor,
+            VectorComponentRewriter, PowerRewriter, FractionKiller,
+            SumSignGrouper, BigIntegerKiller, ComplexRewriter)
+
+    x, a0, a1 = [var(s) for s in "x a0 a1".split()]
+
+    exprs = [
+            x**3 - 2*a0*x,
+            Quotient(6, 3) * x**(-2) + Quotient(1, 3),
+            2**70 * a1 + 123000000j,
+            a0**Quotient(-1, 2) * var("hankel_1")(1, x*a1),
+            ]
+
+    def rewrite_sequentially(expr):
+        for mapper in [
+                BesselSubstitutor(BesselGetter({})),
+                VectorComponentRewriter(["a"]),
+                PowerRewriter(),
+                FractionKiller(),
+                SumSignGrouper(),
+                BigIntegerKiller(),
+                ComplexRewriter()]:
+            expr = mapper(expr)
+        return expr
+
+    rewriter = ExpressionRewriter(BesselGetter({}), ["a"])
+    for expr in exprs:
+        assert rewriter(expr) == rewrite_sequentially(expr)
+
+
 def test_symbolic_assignment_name_uniqueness():
     # https://gitlab.tiker.net/inducer/sumpy/issues/13
     from sumpy.assignment_collection import SymbolicAssignmentCollection
@@ -78,6 +112,68 @@ def test_symbolic_assignment_name_uniqueness():
     assert len(sac.assignments) == 3
 
 
+def test_chunked_cse():
+    from sumpy.assignment_collection import SymbolicAssignmentCollection
+    import sumpy.symbolic as sym
+
+    x, y, z = sym.symbols("x y z")
+    common = sym.exp(x*y) + sym.sin(z)
+    exprs = [common**i + sym.cos(common + i) for i in range(1, 5)]
+
+    def resolve(sac, expr):
+        while True:
+            new_expr = expr.xreplace(dict(
+                (sym.Symbol(name), value)
+                for name, value in sac.assignments.items()))
+            if new_expr == expr:
+                return expr
+            expr = new_expr
+
+    results = {}
+    for max_chunk_size in [None, 1]:
+        sac = SymbolicAssignmentCollection()
+        names = [sac.assign_unique("result", expr) for expr in exprs]
+        sac.assign_unique("dep", sym.Symbol(names[0]) * 2)
+        extra, = sac.run_global_cse(
+                extra_exprs=[common * 3], max_chunk_size=max_chunk_size)
+
+        for name, expr in zip(names, exprs):
+            assert (resolve(sac, sac.assignments[name]) - expr).expand() == 0
+        assert (resolve(sac, extra) - common * 3).expand() == 0
+
+        results[max_chunk_size] = sac
+
+    # The subexpression from the first chunk is reused in the others.
+    chunked_sac = results[1]
+    common_names = [
+            name for name, value in chunked_sac.assignments.items()
+            if resolve(chunked_sac, value) == common]
+    assert len(common_names) == 1
+
+
+def test_eliminate_dead_assignments():
+    from sumpy.assignment_collection import SymbolicAssignmentCollection
+    import sumpy.symbolic as sym
+
+    x, y = sym.symbols("x y")
+
+    sac = SymbolicAssignmentCollection()
+    a = sac.assign_unique("a", x*y)
+    b = sac.assign_unique("b", sym.Symbol(a) + 1)
+    zero = sac.assign_unique("zero", x - x)
+    unused = sac.assign_unique("unused", sym.Symbol(a) * 3)
+    c = sac.assign_unique("c",
+            sym.Symbol(b) + sym.Symbol(zero) * sym.sin(y) + sym.Symbol(zero))
+    d = sac.assign_unique("d", sym.Symbol(zero))
+
+    assert sac.eliminate_dead_assignments([c, d]) == 2
+
+    assert set(sac.assignments) == set([a, b, c, d])
+    assert sac.assignments[c] == sym.Symbol(b)
+    assert sac.assignments[d] == 0
+    assert unused not in sac.user_symbols
+
+
 def test_line_taylor_coeff_growth():
     # Regression test for LineTaylorLocalExpansion.
     # See https://gitlab.tiker.net/inducer/pytential/merge_requests/12
@@ -375,6 +375,21 @@ def test_recursive_matching():
         ([(x1, x**2), (x3, x1*y), (x4, w*x3)], [2*x1, x3, x4, x0*x4, x2*x4])
 
 
+def test_deep_expression():
+    # Deeper than the default recursion limit
+    f = Function("f")
+    expr = x
+    for i in range(3 * sys.getrecursionlimit()):
+        expr = f(expr)
+        # Keep sympy's own (recursive) hashing and assumption queries shallow.
+        hash(expr)
+        expr.is_commutative
+
+    substitutions, reduced = cse([expr + 1, expr + 2])
+    assert substitutions == [(x0, expr)]
+    assert reduced == [x0 + 1, x0 + 2]
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         exec(sys.argv[1])
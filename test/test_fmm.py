@@ -30,7 +30,8 @@ import numpy.linalg as la
 import pyopencl as cl
 from pyopencl.tools import (  # noqa
         pytest_generate_tests_for_pyopencl as pytest_generate_tests)
-from sumpy.kernel import LaplaceKernel, HelmholtzKernel, YukawaKernel
+from sumpy.kernel import (LaplaceKernel, HelmholtzKernel, YukawaKernel,
+        AxisTargetDerivative)
 from sumpy.expansion.multipole import (
     VolumeTaylorMultipoleExpansion,
     H2DMultipoleExpansion, Y2DMultipoleExpansion,
@@ -176,8 +177,7 @@ def test_sumpy_fmm(ctx_getter, knl, local_expn_class, mpole_expn_class):
                 partial(mpole_expn_class, knl),
                 partial(local_expn_class, knl),
                 out_kernels)
-        wrangler = wcc.get_wrangler(queue, tree, dtype,
-                fmm_level_to_order=lambda kernel, kernel_args, tree, lev: order,
+        wrangler = _get_test_wrangler(wcc, queue, tree, order, dtype,
                 kernel_extra_kwargs=extra_kwargs)
 
         from boxtree.fmm import drive_fmm
@@ -327,6 +327,490 @@ def test_sumpy_fmm_exclude_self(ctx_getter):
     assert np.isclose(rel_err, 0, atol=1e-7)
 
 
+# {{{ shared setup for the wrangler feature tests
+
+def _get_test_tree(ctx, queue, nsources, dim=2, dtype=np.float64):
+    """Return a tuple *(sources, tree, traversal)* for *nsources* normally
+    distributed points in *dim* dimensions, serving as both sources and
+    targets.
+    """
+    from boxtree.tools import make_normal_particle_array as p_normal
+    sources = p_normal(queue, nsources, dim, dtype, seed=15)
+
+    from boxtree import TreeBuilder
+    tb = TreeBuilder(ctx)
+    tree, _ = tb(queue, sources, max_particles_in_box=30, debug=True)
+
+    from boxtree.traversal import FMMTraversalBuilder
+    tbuild = FMMTraversalBuilder(ctx)
+    trav, _ = tbuild(queue, tree, debug=True)
+
+    return sources, tree, trav
+
+
+def _get_test_weights(queue, nsources, seed=17):
+    rng = np.random.RandomState(seed)
+    return cl.array.to_device(queue, rng.rand(nsources))
+
+
+def _get_test_code_container(ctx, knl, out_kernels=None, **kwargs):
+    """Return a :class:`sumpy.fmm.SumpyExpansionWranglerCodeContainer` with
+    Taylor expansions for *knl*, passing it *kwargs*.
+    """
+    from functools import partial
+
+    from sumpy.fmm import SumpyExpansionWranglerCodeContainer
+    return SumpyExpansionWranglerCodeContainer(
+            ctx,
+            partial(VolumeTaylorMultipoleExpansion, knl),
+            partial(VolumeTaylorLocalExpansion, knl),
+            [knl] if out_kernels is None else out_kernels,
+            **kwargs)
+
+
+def _get_test_wrangler(wcc, queue, tree, order, dtype=np.float64, **kwargs):
+    """Return a wrangler from *wcc* using *order* on all levels, passing it
+    *kwargs*.
+    """
+    return wcc.get_wrangler(queue, tree, dtype,
+            fmm_level_to_order=lambda kernel, kernel_args, tree, lev: order,
+            **kwargs)
+
+
+def _get_p2p_reference(ctx, queue, knl, sources, weights):
+    from sumpy import P2P
+    p2p = P2P(ctx, [knl], exclude_self=False)
+    evt, (ref_pot,) = p2p(queue, sources, sources, (weights,))
+    return ref_pot.get()
+
+# }}}
+
+
+@pytest.mark.parametrize(("option", "value"), [
+    ("looped_translations", True),
+    ("fused_l2p_p2p", True),
+    ("reorder_in_kernels", True),
+    ("compact_expansions", True),
+    ("expansion_layout", "coeff_major"),
+    ("expansion_layout", "blocked"),
+    ])
+def test_sumpy_fmm_wrangler_options(ctx_getter, option, value):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 500
+    knl = LaplaceKernel(2)
+    order = 10
+
+    _, tree, trav = _get_test_tree(ctx, queue, nsources)
+
+    out_kernels = [knl, AxisTargetDerivative(0, knl)]
+
+    from sumpy.fmm import drive_sumpy_fmm
+    from boxtree.fmm import drive_fmm
+
+    target_to_source = np.arange(tree.ntargets, dtype=np.int32)
+    self_extra_kwargs = {"target_to_source": target_to_source}
+
+    weights_list = [
+            _get_test_weights(queue, nsources, seed=seed)
+            for seed in [17, 18]]
+
+    pots = {}
+    for enabled in [False, True]:
+        wcc = _get_test_code_container(ctx, knl, out_kernels,
+                exclude_self=True,
+                **({option: value} if enabled else {}))
+
+        wrangler = _get_test_wrangler(wcc, queue, tree, order,
+                self_extra_kwargs=self_extra_kwargs)
+
+        # The second evaluation reuses the wrangler (and any data it
+        # precomputed) from the first. Only sumpy's driver makes use of
+        # fused stages, but both must give the same result.
+        for driver in [drive_fmm, drive_sumpy_fmm]:
+            pots[enabled, driver] = [
+                    [pot_i.get() for pot_i in driver(trav, wrangler, weights)]
+                    for weights in weights_list]
+
+    for driver in [drive_fmm, drive_sumpy_fmm]:
+        for ref_pot, pot in zip(pots[False, drive_fmm], pots[True, driver]):
+            for ref_pot_i, pot_i in zip(ref_pot, pot):
+                rel_err = la.norm(pot_i - ref_pot_i) / la.norm(ref_pot_i)
+                logger.info("relative l2 difference: %g" % rel_err)
+                assert rel_err < 1e-12
+
+
+def test_sumpy_fmm_kernel_splitting(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 500
+    knl = LaplaceKernel(2)
+    order = 10
+
+    _, tree, trav = _get_test_tree(ctx, queue, nsources)
+    weights = _get_test_weights(queue, nsources)
+
+    out_kernels = [knl, AxisTargetDerivative(0, knl)]
+
+    from sumpy.fmm import drive_sumpy_fmm
+    from boxtree.fmm import drive_fmm
+
+    wcc = _get_test_code_container(ctx, knl, out_kernels)
+    wrangler = _get_test_wrangler(wcc, queue, tree, order)
+
+    import sumpy
+    prev_max_kernel_insns = sumpy.MAX_KERNEL_INSNS
+
+    # The same wrangler is used with and without splitting, so that kernels
+    # generated before the limit is changed must follow the new limit.
+    pots = {}
+    try:
+        for max_insns in [None, 20]:
+            sumpy.set_max_kernel_insns(max_insns)
+
+            if max_insns is not None:
+                # Every stage is split, and evaluations of the local
+                # expansions are split over their coefficients, too.
+                assert len(wcc.p2m(order).get_chunks()) > 1
+                assert len(wcc.m2l(order, order).get_chunks()) > 1
+
+                l2p_chunks = wcc.l2p(order).get_chunks()
+                assert len(l2p_chunks) > len(out_kernels)
+                assert all(
+                        len(chunk.coeff_indices) < len(wcc.local_expansion(order))
+                        for _, chunk in l2p_chunks)
+
+            for driver in [drive_fmm, drive_sumpy_fmm]:
+                pots[max_insns, driver] = [
+                        pot_i.get() for pot_i in driver(trav, wrangler, weights)]
+    finally:
+        sumpy.set_max_kernel_insns(prev_max_kernel_insns)
+
+    for driver in [drive_fmm, drive_sumpy_fmm]:
+        for ref_pot_i, pot_i in zip(pots[None, drive_fmm], pots[20, driver]):
+            rel_err = la.norm(pot_i - ref_pot_i) / la.norm(ref_pot_i)
+            logger.info("relative l2 difference: %g" % rel_err)
+            assert rel_err < 1e-12
+
+
+def test_sumpy_fmm_accumulate_into_output(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 500
+    knl = LaplaceKernel(2)
+    order = 10
+
+    _, tree, trav = _get_test_tree(ctx, queue, nsources)
+    weights = _get_test_weights(queue, nsources)
+
+    wcc = _get_test_code_container(ctx, knl)
+    wrangler = _get_test_wrangler(wcc, queue, tree, order)
+
+    from boxtree.fmm import drive_fmm
+    ref_pot, = drive_fmm(trav, wrangler, weights)
+
+    # {{{ the stages of drive_fmm, accumulating into one output of each kind
+
+    src_weights = wrangler.reorder_sources(weights)
+
+    mpole_exps, _ = wrangler.form_multipoles(
+            trav.level_start_source_box_nrs, trav.source_boxes, src_weights)
+    mpole_exps, _ = wrangler.coarsen_multipoles(
+            trav.level_start_source_parent_box_nrs, trav.source_parent_boxes,
+            mpole_exps)
+
+    potentials = wrangler.output_zeros()
+    local_exps = wrangler.local_expansion_zeros()
+
+    wrangler.eval_direct(
+            trav.target_boxes,
+            trav.neighbor_source_boxes_starts,
+            trav.neighbor_source_boxes_lists,
+            src_weights, output=potentials)
+    wrangler.multipole_to_local(
+            trav.level_start_target_or_target_parent_box_nrs,
+            trav.target_or_target_parent_boxes,
+            trav.from_sep_siblings_starts,
+            trav.from_sep_siblings_lists,
+            mpole_exps, output=local_exps)
+    wrangler.eval_multipoles(
+            trav.target_boxes_sep_smaller_by_source_level,
+            trav.from_sep_smaller_by_level,
+            mpole_exps, output=potentials)
+    wrangler.form_locals(
+            trav.level_start_target_or_target_parent_box_nrs,
+            trav.target_or_target_parent_boxes,
+            trav.from_sep_bigger_starts,
+            trav.from_sep_bigger_lists,
+            src_weights, output=local_exps)
+    local_exps, _ = wrangler.refine_locals(
+            trav.level_start_target_or_target_parent_box_nrs,
+            trav.target_or_target_parent_boxes,
+            local_exps)
+    result, _ = wrangler.eval_locals(
+            trav.level_start_target_box_nrs,
+            trav.target_boxes,
+            local_exps, output=potentials)
+    assert result is potentials
+
+    pot, = wrangler.finalize_potentials(wrangler.reorder_potentials(potentials))
+
+    # }}}
+
+    ref_pot = ref_pot.get()
+    rel_err = la.norm(pot.get() - ref_pot) / la.norm(ref_pot)
+    logger.info("relative l2 difference: %g" % rel_err)
+    assert rel_err < 1e-12
+
+
+def test_sumpy_fmm_box_orders(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 1000
+    knl = LaplaceKernel(2)
+    order = 10
+
+    sources, tree, trav = _get_test_tree(ctx, queue, nsources)
+
+    # strengths spanning many orders of magnitude
+    rng = np.random.RandomState(17)
+    weights = cl.array.to_device(queue,
+            10**rng.uniform(-12, 0, nsources))
+
+    wcc = _get_test_code_container(ctx, knl)
+
+    from boxtree.fmm import drive_fmm
+    from sumpy.expansion.level_to_order import StrengthBasedBoxOrderFinder
+
+    pots = []
+    for box_order_finder in [None, StrengthBasedBoxOrderFinder()]:
+        wrangler = _get_test_wrangler(wcc, queue, tree, order,
+                box_order_finder=box_order_finder)
+
+        pot, = drive_fmm(trav, wrangler, weights)
+        pots.append(pot.get())
+
+    assert (wrangler.multipole_box_orders < order).any()
+
+    ref_pot = _get_p2p_reference(ctx, queue, knl, sources, weights)
+
+    ref_err, err = [la.norm(pot - ref_pot) / la.norm(ref_pot) for pot in pots]
+    logger.info("relative l2 error: %g (uniform orders: %g)" % (err, ref_err))
+
+    assert err < 1.5 * ref_err
+
+
+def test_sumpy_fmm_pair_orders(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 1000
+    knl = LaplaceKernel(2)
+    order = 10
+
+    sources, tree, trav = _get_test_tree(ctx, queue, nsources)
+    weights = _get_test_weights(queue, nsources)
+
+    wcc = _get_test_code_container(ctx, knl)
+
+    from boxtree.fmm import drive_fmm
+    from sumpy.expansion.level_to_order import SeparationBasedPairOrderFinder
+
+    class RecordingPairOrderFinder(SeparationBasedPairOrderFinder):
+        def __init__(self):
+            SeparationBasedPairOrderFinder.__init__(self)
+            self.orders = []
+
+        def __call__(self, *args):
+            orders = SeparationBasedPairOrderFinder.__call__(self, *args)
+            self.orders.append(orders)
+            return orders
+
+    pots = []
+    for pair_order_finder in [None, RecordingPairOrderFinder()]:
+        wrangler = _get_test_wrangler(wcc, queue, tree, order,
+                pair_order_finder=pair_order_finder)
+
+        pot, = drive_fmm(trav, wrangler, weights)
+        pots.append(pot.get())
+
+    pair_orders = np.concatenate(pair_order_finder.orders)
+    assert (pair_orders <= order).all()
+    assert (pair_orders < order).any()
+
+    # The pair orders are reused by later evaluations with the same wrangler.
+    ncalls = len(pair_order_finder.orders)
+    pot, = drive_fmm(trav, wrangler, weights)
+    assert len(pair_order_finder.orders) == ncalls
+    assert la.norm(pot.get() - pots[-1]) <= 1e-14 * la.norm(pots[-1])
+
+    ref_pot = _get_p2p_reference(ctx, queue, knl, sources, weights)
+
+    ref_err, err = [la.norm(pot - ref_pot) / la.norm(ref_pot) for pot in pots]
+    logger.info("relative l2 error: %g (uniform orders: %g)" % (err, ref_err))
+
+    assert err < 2 * ref_err
+
+
+def test_sumpy_fmm_direct_evaluation_selector(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 1000
+    knl = LaplaceKernel(2)
+    order = 10
+
+    sources, tree, trav = _get_test_tree(ctx, queue, nsources)
+    weights = _get_test_weights(queue, nsources)
+
+    wcc = _get_test_code_container(ctx, knl)
+
+    from sumpy.fmm import drive_sumpy_fmm
+    from sumpy.cost import DirectEvaluationSelector
+
+    class CountingSelector(DirectEvaluationSelector):
+        ncalls = 0
+
+        def __call__(self, *args):
+            self.ncalls += 1
+            return DirectEvaluationSelector.__call__(self, *args)
+
+    pots = []
+    for selector in [None, CountingSelector()]:
+        wrangler = _get_test_wrangler(wcc, queue, tree, order,
+                direct_evaluation_selector=selector)
+
+        pot, = drive_sumpy_fmm(trav, wrangler, weights)
+        pots.append(pot.get())
+
+    # The selection is reused by later evaluations with the same wrangler.
+    ncalls = selector.ncalls
+    assert ncalls > 0
+    pot, = drive_sumpy_fmm(trav, wrangler, weights)
+    assert selector.ncalls == ncalls
+    assert la.norm(pot.get() - pots[-1]) <= 1e-14 * la.norm(pots[-1])
+
+    ref_pot = _get_p2p_reference(ctx, queue, knl, sources, weights)
+
+    ref_err, err = [la.norm(pot - ref_pot) / la.norm(ref_pot) for pot in pots]
+    logger.info("relative l2 error: %g (expansions only: %g)" % (err, ref_err))
+
+    assert err < 2 * ref_err + 1e-12
+
+
+def test_sumpy_fmm_incremental(ctx_getter):
+    logging.basicConfig(level=logging.INFO)
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    nsources = 1000
+    knl = LaplaceKernel(2)
+    order = 10
+
+    _, tree, trav = _get_test_tree(ctx, queue, nsources)
+
+    rng = np.random.RandomState(17)
+    old_weights = rng.rand(nsources)
+
+    changed_source_ids = rng.choice(nsources, 10, replace=False)
+    new_weights = old_weights.copy()
+    new_weights[changed_source_ids] = rng.rand(len(changed_source_ids))
+
+    from sumpy.fmm import IncrementalFMMDriver
+    wcc = _get_test_code_container(ctx, knl)
+    wrangler = _get_test_wrangler(wcc, queue, tree, order)
+
+    from boxtree.fmm import drive_fmm
+    ref_pot, = drive_fmm(trav, wrangler, cl.array.to_device(queue, new_weights))
+    ref_pot = ref_pot.get()
+
+    driver = IncrementalFMMDriver(trav, wrangler)
+
+    for ids in [changed_source_ids, None]:
+        driver(cl.array.to_device(queue, old_weights))
+        pot, = driver.update(cl.array.to_device(queue, new_weights),
+                changed_source_ids=ids)
+        pot = pot.get()
+
+        rel_err = la.norm(pot - ref_pot) / la.norm(ref_pot)
+        logger.info("relative l2 difference to full evaluation: %g" % rel_err)
+
+        assert rel_err < 1e-12
+
+
+def test_sumpy_fmm_cost_model(ctx_getter, tmpdir, monkeypatch):
+    logging.basicConfig(level=logging.INFO)
+
+    # Keep calibration data out of the user's cache.
+    import sumpy.cost
+    from pytools.persistent_dict import PersistentDict
+    monkeypatch.setattr(sumpy.cost, "calibration_cache",
+            PersistentDict("sumpy-test-calibration", container_dir=str(tmpdir)))
+
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(
+            ctx,
+            properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    nsources = 500
+    knl = LaplaceKernel(2)
+    order = 4
+
+    _, tree, trav = _get_test_tree(ctx, queue, nsources)
+    weights = _get_test_weights(queue, nsources)
+
+    wcc = _get_test_code_container(ctx, knl)
+    wrangler = _get_test_wrangler(wcc, queue, tree, order)
+
+    from sumpy.cost import FMMCostModel, FMM_STAGES
+    cost_model = FMMCostModel(wcc)
+    params = cost_model.calibrate(
+            [(trav, wrangler, weights)], nruns=1, store=False)
+    assert set(params) == set(FMM_STAGES)
+
+    host_trav = trav.get(queue=queue)
+    host_tree = host_trav.tree
+
+    # Every source interacts directly with every target in its list 1.
+    op_counts = cost_model.get_box_op_counts(
+            host_tree, host_trav, wrangler.level_orders)
+    nsources_by_box = host_tree.box_source_counts_nonchild
+    starts = host_trav.neighbor_source_boxes_starts
+    lists = host_trav.neighbor_source_boxes_lists
+    ref_p2p = sum(
+            host_tree.box_target_counts_nonchild[tgt_ibox]
+            * np.sum(nsources_by_box[lists[starts[i]:starts[i+1]]])
+            for i, tgt_ibox in enumerate(host_trav.target_boxes))
+    assert np.sum(op_counts["p2p"]) == ref_p2p
+
+    stage_times = cost_model.predict_stage_times(
+            host_tree, host_trav, wrangler.level_orders)
+    box_costs = cost_model.get_box_costs(
+            host_tree, host_trav, wrangler.level_orders)
+    assert box_costs.shape == (host_tree.nboxes,)
+    assert np.isclose(np.sum(box_costs), sum(stage_times.values()))
+
+    # Only calibrate(store=True) saves the calibration.
+    assert not FMMCostModel(wcc).load_calibration(queue.device, wrangler.dtype)
+
+
 # You can test individual routines by typing
 # $ python test_fmm.py 'test_sumpy_fmm(cl.create_some_context)'
 
@@ -611,6 +611,231 @@ def test_translations(ctx_getter, knl, local_expn_class, mpole_expn_class):
         verifier()
 
 
+def test_translations_overwrite_output(ctx_getter):
+    """Check that standalone M2L and L2P, called without an output array,
+    overwrite (rather than add into) their outputs, and that only
+    *accumulate_output* makes them add.
+    """
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    np.random.seed(17)
+
+    knl = LaplaceKernel(2)
+    order = 4
+    nsources = 20
+    ntargets = 10
+
+    m_expn = VolumeTaylorMultipoleExpansion(knl, order=order)
+    l_expn = VolumeTaylorLocalExpansion(knl, order=order)
+
+    from sumpy import P2EFromSingleBox, E2PFromSingleBox, E2EFromCSR
+    p2m = P2EFromSingleBox(ctx, m_expn)
+    m2l = E2EFromCSR(ctx, m_expn, l_expn)
+    l2p = E2PFromSingleBox(ctx, l_expn, [knl])
+    l2p_acc = E2PFromSingleBox(ctx, l_expn, [knl], accumulate_output=True)
+
+    centers = np.array([[0, 5], [0, 0]], dtype=np.float64)
+    sources = 0.5*(-0.5 + np.random.rand(2, nsources))
+    targets = 0.5*(-0.5 + np.random.rand(2, ntargets)) + centers[:, 1:]
+    strengths = np.ones(nsources, dtype=np.float64)
+
+    evt, (mpoles,) = p2m(queue,
+            source_boxes=np.array([0], dtype=np.int32),
+            box_source_starts=np.array([0, 0], dtype=np.int32),
+            box_source_counts_nonchild=np.array([nsources, 0], dtype=np.int32),
+            centers=centers,
+            sources=sources,
+            strengths=strengths,
+            nboxes=2,
+            rscale=1,
+            tgt_base_ibox=0,
+            out_host=True)
+
+    m2l_kwargs = dict(
+            src_expansions=mpoles,
+            src_base_ibox=0,
+            tgt_base_ibox=0,
+            ntgt_level_boxes=2,
+            target_boxes=np.array([1], dtype=np.int32),
+            src_box_starts=np.array([0, 1], dtype=np.int32),
+            src_box_lists=np.array([0], dtype=np.int32),
+            centers=centers,
+            src_rscale=1,
+            tgt_rscale=1,
+            out_host=True)
+
+    evt, (locals1,) = m2l(queue, **m2l_kwargs)
+    evt, (locals2,) = m2l(queue,
+            tgt_expansions=np.full_like(locals1, 1e5), **m2l_kwargs)
+    assert la.norm(locals1[1]) > 0
+    assert la.norm(locals2[1] - locals1[1]) < 1e-13 * la.norm(locals1[1])
+
+    l2p_kwargs = dict(
+            src_expansions=locals1,
+            src_base_ibox=0,
+            target_boxes=np.array([1], dtype=np.int32),
+            box_target_starts=np.array([0, 0], dtype=np.int32),
+            box_target_counts_nonchild=np.array([0, ntargets], dtype=np.int32),
+            centers=centers,
+            targets=targets,
+            rscale=1,
+            out_host=True)
+
+    evt, (pot1,) = l2p(queue, **l2p_kwargs)
+    evt, (pot2,) = l2p(queue, result=np.full(ntargets, 1e5), **l2p_kwargs)
+    evt, (pot3,) = l2p_acc(queue, result=np.full(ntargets, 1e5), **l2p_kwargs)
+
+    assert la.norm(pot1) > 0
+    assert la.norm(pot2 - pot1) < 1e-13 * la.norm(pot1)
+    assert la.norm(pot3 - 1e5 - pot1) < 1e-10 * la.norm(pot1)
+
+
+def test_particle_matrices(ctx_getter):
+    """Check that the matrices of :class:`sumpy.p2e.P2EMatrixFromSingleBox`
+    and :class:`sumpy.e2p.E2PMatrixFromSingleBox` reproduce P2M and L2P.
+    """
+    ctx = ctx_getter()
+    queue = cl.CommandQueue(ctx)
+
+    np.random.seed(17)
+
+    knl = LaplaceKernel(2)
+    order = 4
+    nparticles = 20
+
+    m_expn = VolumeTaylorMultipoleExpansion(knl, order=order)
+    l_expn = VolumeTaylorLocalExpansion(knl, order=order)
+
+    from sumpy import (
+            P2EFromSingleBox, P2EMatrixFromSingleBox,
+            E2PFromSingleBox, E2PMatrixFromSingleBox)
+
+    centers = np.array([[0], [0]], dtype=np.float64)
+    particles = 0.5*(-0.5 + np.random.rand(2, nparticles))
+    box_kwargs = dict(
+            centers=centers,
+            rscale=1)
+
+    # {{{ P2M
+
+    p2m_kwargs = dict(
+            source_boxes=np.array([0], dtype=np.int32),
+            box_source_starts=np.array([0], dtype=np.int32),
+            box_source_counts_nonchild=np.array([nparticles], dtype=np.int32),
+            sources=particles,
+            out_host=True,
+            **box_kwargs)
+
+    strengths = np.random.rand(nparticles)
+    evt, (mpoles,) = P2EFromSingleBox(ctx, m_expn)(queue,
+            strengths=strengths, nboxes=1, tgt_base_ibox=0, **p2m_kwargs)
+
+    evt, (p2m_matrix,) = P2EMatrixFromSingleBox(ctx, m_expn)(queue,
+            p2e_matrix=np.zeros((nparticles, len(m_expn))), **p2m_kwargs)
+
+    assert la.norm(mpoles[0]) > 0
+    assert (la.norm(p2m_matrix.T.dot(strengths) - mpoles[0])
+            < 1e-13 * la.norm(mpoles[0]))
+
+    # }}}
+
+    # {{{ L2P
+
+    l2p_kwargs = dict(
+            target_boxes=np.array([0], dtype=np.int32),
+            box_target_starts=np.array([0], dtype=np.int32),
+            box_target_counts_nonchild=np.array([nparticles], dtype=np.int32),
+            targets=particles,
+            out_host=True,
+            **box_kwargs)
+
+    local_exps = np.random.rand(1, len(l_expn))
+    evt, (pot,) = E2PFromSingleBox(ctx, l_expn, [knl])(queue,
+            src_expansions=local_exps, src_base_ibox=0, **l2p_kwargs)
+
+    l2p_matrix = E2PMatrixFromSingleBox(ctx, l_expn, [knl])
+
+    import sumpy
+    prev_max_kernel_insns = sumpy.MAX_KERNEL_INSNS
+
+    assert la.norm(pot) > 0
+
+    try:
+        # With a small limit, the matrix is computed by several kernels,
+        # each writing the rows of some of the coefficients.
+        for max_insns in [None, 20]:
+            sumpy.set_max_kernel_insns(max_insns)
+
+            chunks = l2p_matrix.get_chunks()
+            if max_insns is not None:
+                assert len(chunks) > 1
+                written_coeffs = sorted(
+                        icoeff
+                        for _, chunk in chunks
+                        for icoeff in chunk.coeff_indices)
+                assert written_coeffs == list(range(len(l_expn)))
+
+            evt, (matrix,) = l2p_matrix(queue,
+                    result=[np.zeros((len(l_expn), nparticles))], **l2p_kwargs)
+
+            assert (la.norm(local_exps[0].dot(matrix) - pot)
+                    < 1e-13 * la.norm(pot))
+    finally:
+        sumpy.set_max_kernel_insns(prev_max_kernel_insns)
+
+    # }}}
+
+
+@pytest.mark.parametrize("dim", [2, 3])
+@pytest.mark.parametrize("use_rscale", [True, False])
+@pytest.mark.parametrize("expn_class", [
+    VolumeTaylorMultipoleExpansion,
+    LaplaceConformingVolumeTaylorMultipoleExpansion,
+    VolumeTaylorLocalExpansion,
+    LaplaceConformingVolumeTaylorLocalExpansion,
+    ])
+def test_translation_term_table(dim, use_rscale, expn_class):
+    import sumpy.symbolic as sym
+
+    expn = expn_class(LaplaceKernel(dim), 3, use_rscale)
+    ncoeffs = len(expn)
+
+    src_coeff_exprs = [sym.Symbol("src_coeff%d" % i) for i in range(ncoeffs)]
+    dvec = sym.make_sym_vector("d", dim)
+    src_rscale = sym.Symbol("src_rscale")
+    tgt_rscale = sym.Symbol("tgt_rscale")
+
+    rng = np.random.RandomState(17)
+    src_coeffs = rng.rand(ncoeffs)
+    d = rng.rand(dim) - 0.5
+    src_rscale_val = 0.7
+    tgt_rscale_val = 0.3
+
+    subs = dict(zip(src_coeff_exprs, src_coeffs))
+    subs.update(zip(dvec, d))
+    subs[src_rscale] = src_rscale_val
+    subs[tgt_rscale] = tgt_rscale_val
+
+    ref = np.array([
+        float(sym.sympify(expr).subs(subs).doit())
+        for expr in expn.translate_from(
+            expn, src_coeff_exprs, src_rscale, dvec, tgt_rscale)])
+
+    table = expn.get_translation_term_table(expn)
+    term_values = (
+            table.coefficients
+            * (src_rscale_val ** table.src_rscale_exponents.astype(np.float64)
+                * src_coeffs)[table.src_indices]
+            * np.prod(d[:, np.newaxis] ** table.d_exponents, axis=0))
+    result = np.array([
+        np.sum(term_values[table.term_starts[i]:table.term_starts[i+1]])
+        for i in range(ncoeffs)])
+    result *= tgt_rscale_val ** table.tgt_rscale_exponents.astype(np.float64)
+
+    assert la.norm(result - ref) / la.norm(ref) < 1e-13
+
+
 # You can test individual routines by typing
 # $ python test_kernels.py 'test_p2p(cl.create_some_context)'
 
@@ -161,6 +161,362 @@ def test_fmmlib_order_finder(knl):
     assert (np.diff(orders) <= 0).all()
 
 
+@pytest.mark.parametrize("knl", [
+        LaplaceKernel(2), HelmholtzKernel(2),
+        LaplaceKernel(3)])
+def test_empirical_order_finder(ctx_getter, knl):
+    from sumpy.expansion.level_to_order import EmpiricalExpansionOrderFinder
+
+    tol = 1e-5
+    ofind = EmpiricalExpansionOrderFinder(ctx_getter(), tol)
+
+    tree = FakeTree(knl.dim, 10, 0.1)
+    if isinstance(knl, HelmholtzKernel):
+        kernel_args = (("k", 5),)
+    else:
+        kernel_args = ()
+
+    orders = [
+        ofind(knl, frozenset(kernel_args), tree, level)
+        for level in range(2, 6)]
+    print(orders)
+
+    # Order should not increase with level
+    assert (np.diff(orders) <= 0).all()
+
+    # Only the three-dimensional Laplace kernel is calibrated for unit boxes.
+    if isinstance(knl, LaplaceKernel) and knl.dim == 3:
+        size = 1.
+    else:
+        size = tree.root_extent / 2**5
+
+    # The order found meets the tolerance, the one below does not.
+    assert ofind.get_translation_error(
+            knl, kernel_args, size, orders[-1], tree.stick_out_factor) < tol
+    if orders[-1] > 1:
+        assert ofind.get_translation_error(
+                knl, kernel_args, size, orders[-1] - 1,
+                tree.stick_out_factor) >= tol
+
+    # Targets sticking out of their boxes are harder to reach.
+    assert (
+            ofind.get_translation_error(knl, kernel_args, size, 3, 0.25)
+            > ofind.get_translation_error(knl, kernel_args, size, 3, 0))
+
+
+def test_strength_based_box_order_finder():
+    from sumpy.expansion.level_to_order import StrengthBasedBoxOrderFinder
+
+    # a root box with four children, one source in each child
+    class FakeLevelTree:
+        dimensions = 2
+        root_extent = 1.
+        nsources = 4
+        nboxes = 5
+        nlevels = 2
+        level_start_box_nrs = np.array([0, 1, 5])
+        box_levels = np.array([0, 1, 1, 1, 1])
+        box_centers = np.array([
+            [0.5, 0.25, 0.75, 0.25, 0.75],
+            [0.5, 0.25, 0.25, 0.75, 0.75]])
+        box_source_starts = np.array([0, 0, 1, 2, 3])
+        box_source_counts_cumul = np.array([4, 1, 1, 1, 1])
+
+    strengths = np.array([1, 1e-3, 1e-12, 0])
+
+    ofind = StrengthBasedBoxOrderFinder(separation_ratio=0.1, ninteractions=1)
+    mpole_orders, local_orders = ofind(FakeLevelTree(), [10, 10], strengths)
+
+    # Each factor of ten in relative strength lowers the order by one.
+    assert list(mpole_orders) == [10, 10, 7, 1, 1]
+
+    # All sources are colleagues of every box, none are in the far field.
+    assert (local_orders == 1).all()
+
+    # Splitting the error among 6**2 - 3**2 = 27 interactions uses up
+    # (almost) two of the factors of ten.
+    ofind = StrengthBasedBoxOrderFinder(separation_ratio=0.1)
+    mpole_orders, _ = ofind(FakeLevelTree(), [10, 10], strengths)
+    assert list(mpole_orders) == [10, 10, 9, 1, 1]
+
+
+def test_separation_based_pair_order_finder():
+    from sumpy.expansion.level_to_order import SeparationBasedPairOrderFinder
+
+    # three boxes of size 1/4: a target box, and a well-separated source box
+    # near it and far from it
+    class FakeLevelTree:
+        dimensions = 2
+        root_extent = 1.
+        box_levels = np.array([2, 2, 2])
+        box_centers = np.array([
+            [0.125, 0.625, 0.875],
+            [0.125, 0.125, 0.875]])
+
+        def __init__(self, stick_out_factor):
+            self.stick_out_factor = stick_out_factor
+
+    ofind = SeparationBasedPairOrderFinder()
+    args = (10, np.array([0]), np.array([0, 2]), np.array([1, 2]))
+
+    orders = ofind(FakeLevelTree(0), *args)
+    assert orders[0] == 10
+    assert 1 <= orders[1] < 10
+
+    # Targets sticking out of the target box bring the closest
+    # well-separated source box closer, which the level order accounts for.
+    # Relative to that, the far source box gains less, so its order drops.
+    stick_out_orders = ofind(FakeLevelTree(0.25), *args)
+    assert stick_out_orders[0] == 10
+    assert stick_out_orders[1] < orders[1]
+
+
+def test_direct_evaluation_selector():
+    from sumpy.cost import DirectEvaluationSelector
+
+    class FakeCountTree:
+        box_source_counts_cumul = np.array([100, 2, 50])
+        box_target_counts_cumul = np.array([100, 50, 2])
+
+    select = DirectEvaluationSelector()
+
+    # target box 0 interacts with source boxes 1 and 2
+    args = (np.array([0]), np.array([0, 2]), np.array([1, 2]))
+    assert list(select(FakeCountTree(), "m2p", 10, *args)) == [True, False]
+    assert list(select(FakeCountTree(), "p2l", 10, *args)) == [False, False]
+
+    # target boxes 1 and 2 interact with source box 0
+    args = (np.array([1, 2]), np.array([0, 1, 2]), np.array([0, 0]))
+    assert list(select(FakeCountTree(), "p2l", 10, *args)) == [False, True]
+
+
+@pytest.mark.parametrize(("ninsns", "noutputs", "max_insns", "nchunks"), [
+    (100, 10, None, 1),
+    (100, 10, 1000, 1),
+    (2500, 10, 1000, 3),
+    (2500, 2, 1000, 2),
+    (2500, 1, 1000, 1),
+    ])
+def test_split_outputs_into_chunks(ninsns, noutputs, max_insns, nchunks):
+    from sumpy.tools import split_outputs_into_chunks
+    chunks = split_outputs_into_chunks(ninsns, noutputs, max_insns)
+
+    assert len(chunks) == nchunks
+    assert sum(chunks, ()) == tuple(range(noutputs))
+
+
+@pytest.mark.parametrize(("ninsns", "noutputs", "nterms", "max_insns",
+        "nchunks"), [
+    (100, 2, 10, None, 1),
+    (100, 2, 10, 1000, 1),
+    (2500, 3, 10, 1000, 3),
+    (2500, 2, 10, 1000, 4),
+    (2500, 1, 10, 1000, 3),
+    (2500, 1, 2, 1000, 2),
+    ])
+def test_split_outputs_and_terms_into_chunks(ninsns, noutputs, nterms,
+        max_insns, nchunks):
+    from sumpy.tools import split_outputs_and_terms_into_chunks
+    chunks = split_outputs_and_terms_into_chunks(
+            ninsns, noutputs, nterms, max_insns)
+
+    assert len(chunks) == nchunks
+
+    # each term of each output is computed exactly once
+    computed = sorted(
+            (iout, iterm)
+            for output_indices, term_indices in chunks
+            for iout in output_indices
+            for iterm in term_indices)
+    assert computed == [
+            (iout, iterm) for iout in range(noutputs) for iterm in range(nterms)]
+
+
+def test_parse_expansion_layout():
+    from sumpy.tools import parse_expansion_layout, DEFAULT_EXPANSION_BLOCK_SIZE
+
+    assert parse_expansion_layout("box_major") == ("box_major", None)
+    assert parse_expansion_layout("coeff_major") == ("coeff_major", None)
+    assert parse_expansion_layout("blocked") == (
+            "blocked", DEFAULT_EXPANSION_BLOCK_SIZE)
+    assert parse_expansion_layout("blocked:32") == ("blocked", 32)
+
+    for layout in ["soa", "blocked:0"]:
+        with pytest.raises(ValueError):
+            parse_expansion_layout(layout)
+
+
+def test_mi_derivative_taker_closest_cached_mi():
+    import sumpy.symbolic as sym
+    from sumpy.tools import MiDerivativeTaker
+
+    dist_vec = sym.make_sym_vector("d", 3)
+    taker = MiDerivativeTaker(LaplaceKernel(3).get_expression(dist_vec),
+            dist_vec)
+
+    assert taker.get_closest_cached_mi((2, 1, 0)) == (0, 0, 0)
+    taker.diff((1, 1, 0))
+    assert taker.get_closest_cached_mi((2, 1, 0)) == (1, 1, 0)
+    assert taker.get_closest_cached_mi((1, 1, 1)) == (1, 1, 0)
+    assert taker.get_closest_cached_mi((0, 2, 0)) == (0, 0, 0)
+
+    expr = taker.diff((2, 1, 1))
+    assert expr == taker.cache_by_mi[(2, 1, 1)]
+    assert (2, 1, 0) in taker.cache_by_mi
+
+
+def test_shared_derivative_cache():
+    import sumpy.symbolic as sym
+    from sumpy.tools import DerivativeCache, MiDerivativeTaker
+    from sumpy.expansion import LaplaceDerivativeWrangler
+
+    dist_vec = sym.make_sym_vector("d", 2)
+    expr = LaplaceKernel(2).get_expression(dist_vec)
+
+    taker_a = MiDerivativeTaker(expr, dist_vec)
+    taker_a.diff((2, 1))
+    taker_b = MiDerivativeTaker(expr, dist_vec)
+    assert taker_b.cache_by_mi is taker_a.cache_by_mi
+    assert (2, 1) in taker_b.cache_by_mi
+
+    # Recurrence-based takers express derivatives in terms of each other.
+    rec_taker_lo = LaplaceDerivativeWrangler(3, 2).get_derivative_taker(
+            expr, dist_vec)
+    rec_taker_hi = LaplaceDerivativeWrangler(8, 2).get_derivative_taker(
+            expr, dist_vec)
+    assert rec_taker_lo.cache_by_mi is rec_taker_hi.cache_by_mi
+    assert rec_taker_lo.cache_by_mi is not taker_a.cache_by_mi
+
+    cache = DerivativeCache(max_size=3)
+    family_a = cache.get_family("a", expr, dist_vec)
+    family_a[(1, 0)] = expr.diff(dist_vec[0])
+    family_a[(0, 1)] = expr.diff(dist_vec[1])
+    cache.get_family("b", expr, dist_vec)
+    assert list(cache.families) == ["b"]
+    assert cache.get_family("a", expr, dist_vec) is not family_a
+
+
+def test_cached_post_cse_assignments():
+    import sumpy.symbolic as sym
+    from sumpy import CacheMode
+    from sumpy.assignment_collection import SymbolicAssignmentCollection
+    from sumpy.tools import get_cached_post_cse_assignments
+
+    nbuilds = [0]
+
+    def build():
+        nbuilds[0] += 1
+        x = sym.Symbol("x")
+        sac = SymbolicAssignmentCollection()
+        names = [sac.assign_unique("result", (x+1)**2 + (x+1)**3)]
+        return sac, names
+
+    from uuid import uuid4
+    cache_key = ("test_cached_post_cse_assignments", str(uuid4()))
+
+    with CacheMode(True):
+        assignments, names = get_cached_post_cse_assignments(cache_key, build)
+        assert get_cached_post_cse_assignments(cache_key, build) == (
+                assignments, names)
+    assert nbuilds[0] == 1
+
+    assert names == ["result"]
+    assert len(assignments) > 1
+
+    with CacheMode(False):
+        get_cached_post_cse_assignments(cache_key, build)
+    assert nbuilds[0] == 2
+
+
+@pytest.mark.parametrize("wrangler_args", [
+    ("LaplaceDerivativeWrangler", (6, 3)),
+    ("HelmholtzDerivativeWrangler", (6, 2, "k")),
+    ])
+def test_derivative_wrangler_coeff_matrix(wrangler_args):
+    import sumpy.expansion as expn
+    from sumpy import CacheMode
+
+    cls_name, args = wrangler_args
+    wrangler_cls = getattr(expn, cls_name)
+    with CacheMode(False):
+        ref_ids, ref_mat = wrangler_cls(*args)._get_stored_ids_and_coeff_mat()
+    with CacheMode(True):
+        wrangler_cls(*args)._get_stored_ids_and_coeff_mat()
+        ids, mat = wrangler_cls(*args)._get_stored_ids_and_coeff_mat()
+
+    assert ids == ref_ids
+    assert dict(mat) == dict(ref_mat)
+
+    # Every derivative is a combination of the stored ones.
+    wrangler = wrangler_cls(*args)
+    full_ids = wrangler.get_full_coefficient_identifiers()
+    assert sorted(mat) == list(range(len(full_ids)))
+    for irow, row in mat.items():
+        if full_ids[irow] in ids:
+            assert row == [(ids.index(full_ids[irow]), 1)]
+
+
+@pytest.mark.parametrize("knl", [
+    LaplaceKernel(2), LaplaceKernel(3), HelmholtzKernel(3)])
+def test_recurrence_derivative_taker(knl, order=4):
+    import sumpy.symbolic as sym
+    from pytools import generate_nonnegative_integer_tuples_summing_to_at_most
+
+    dist_vec = sym.make_sym_vector("d", knl.dim)
+    taker = knl.get_recurrence_derivative_taker(dist_vec)
+    expr = knl.get_expression(dist_vec)
+
+    rng = np.random.RandomState(17)
+    subs = dict(zip(dist_vec, rng.rand(knl.dim) + 0.5))
+    subs[sym.Symbol("k")] = 1.3
+
+    for mi in generate_nonnegative_integer_tuples_summing_to_at_most(
+            order, knl.dim):
+        ref = expr
+        for iaxis, n in enumerate(mi):
+            ref = ref.diff(dist_vec[iaxis], n)
+
+        ref_val = complex(sym.sympify(ref).subs(subs).doit().evalf())
+        val = complex(sym.sympify(taker.diff(mi)).subs(subs).doit().evalf())
+        assert abs(val - ref_val) <= 1e-12 * max(1, abs(ref_val)), mi
+
+
+def test_mi_taylor_polynomial_and_scaled_powers(dim=3, order=5):
+    import sumpy.symbolic as sym
+    from sumpy.assignment_collection import SymbolicAssignmentCollection
+    from sumpy.tools import (
+            mi_power, mi_factorial, mi_taylor_polynomial, mi_scaled_powers)
+    from pytools import generate_nonnegative_integer_tuples_summing_to_at_most
+
+    mis = list(generate_nonnegative_integer_tuples_summing_to_at_most(
+        order, dim))
+    vec = sym.make_sym_vector("x", dim)
+    coeffs = [sym.Symbol("c%d" % i) for i in range(len(mis))]
+
+    ref_powers = [mi_power(vec, mi) / mi_factorial(mi) for mi in mis]
+
+    rng = np.random.RandomState(17)
+    subs = dict(zip(vec, rng.rand(dim)))
+    subs.update(zip(coeffs, rng.rand(len(coeffs))))
+
+    ref = sum(coeff * power for coeff, power in zip(coeffs, ref_powers))
+    poly = mi_taylor_polynomial(coeffs, mis, vec)
+    assert abs(float((poly - ref).subs(subs))) < 1e-13
+
+    sac = SymbolicAssignmentCollection()
+    powers = mi_scaled_powers(vec, mis, sac)
+    sac_subs = dict(
+            (sym.Symbol(name), sym.sympify(value))
+            for name, value in sac.assignments.items())
+    for power, ref_power in zip(powers, ref_powers):
+        while sym.sympify(power).free_symbols & set(sac_subs):
+            power = sym.sympify(power).xreplace(sac_subs)
+        assert (power - ref_power).expand() == 0
+
+    # one product per entry
+    assert len(sac.assignments) == len(mis) - 1
+
+
 # {{{ expansion toys p2e2e2p test cases
 
 def approx_convergence_factor(orders, errors):